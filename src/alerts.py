@@ -0,0 +1,348 @@
+"""Threshold alerts on warehouse fill ratios and product stock.
+
+Rules are stored per warehouse in the alert_rules table with a firing
+flag holding whether their condition held at the last evaluation. Every
+change of a warehouse evaluates just the rules of that warehouse, in the
+same transaction, with one UPDATE flipping the rules whose condition
+changed. A rule therefore alerts once when its threshold is crossed and
+once when it is crossed back, not on every change.
+
+Alerts are held until the transaction commits and then handed to an
+AlertDispatcher, which delivers them to its sinks (log, webhook,
+Server-Sent Events) from a background thread through a bounded queue,
+so writers never wait for the sinks.
+"""
+import json
+import logging
+import queue
+import threading
+import urllib.request
+from collections import namedtuple
+from contextlib import contextmanager
+from quantity import SCALE, from_units, to_units
+from queue_worker import QueueWorker
+
+logger = logging.getLogger(__name__)
+
+# 'fill_above': balance / capacity above the threshold ratio,
+# 'stock_below': quantity of a product below the threshold
+KINDS = ('fill_above', 'stock_below')
+# Maximum number of alerts waiting for delivery (per SSE client)
+QUEUE_SIZE = 1000
+WEBHOOK_TIMEOUT = 5.0
+# Seconds between keepalive comments of idle SSE streams
+KEEPALIVE_SECONDS = 15.0
+
+# firing is True when the threshold was crossed, False when crossed back
+Alert = namedtuple('Alert', ('rule_id', 'warehouse_id', 'kind', 'product',
+                             'threshold', 'value', 'firing'))
+
+# The table is not aliased: RETURNING subqueries cannot see an alias
+_STOCK = """COALESCE((
+    SELECT p.quantity FROM products p
+    WHERE p.warehouse_id = alert_rules.warehouse_id
+        AND p.product_id = alert_rules.product_id
+), 0)"""
+# Whether the condition of a rule holds, compared exactly in milli-units
+_CONDITION = f"""CASE alert_rules.kind
+    WHEN 'fill_above' THEN (
+        SELECT w.balance * {SCALE} > alert_rules.threshold * w.capacity
+        FROM warehouses w WHERE w.id = alert_rules.warehouse_id)
+    ELSE {_STOCK} < alert_rules.threshold
+END"""
+_EVALUATE = f"""UPDATE alert_rules SET firing = NOT firing
+    WHERE warehouse_id = ? AND firing != ({_CONDITION})
+    RETURNING id, warehouse_id, kind, threshold, firing,
+        (SELECT c.name FROM catalog c WHERE c.id = alert_rules.product_id)
+            AS product,
+        CASE alert_rules.kind
+            WHEN 'fill_above' THEN (
+                SELECT CAST(w.balance AS REAL) / w.capacity
+                FROM warehouses w WHERE w.id = alert_rules.warehouse_id)
+            ELSE {_STOCK}
+        END AS value"""
+
+
+def format_alert(alert):
+    """Describe an alert in one line."""
+    if alert.kind == 'fill_above':
+        subject = f"fill {alert.value:.1%}"
+        limit = f"{alert.threshold:.1%}"
+    else:
+        subject = f"{alert.product} stock {alert.value}"
+        limit = alert.threshold
+    direction = 'above' if (alert.kind == 'fill_above') == alert.firing \
+        else 'below'
+    return (f"Warehouse {alert.warehouse_id}: {subject} is {direction} "
+            f"{limit} (rule {alert.rule_id})")
+
+
+def _alert(row):
+    """Build an alert from a row returned by the evaluation."""
+    value = row['value']
+    if row['kind'] == 'stock_below':
+        value = from_units(value)
+    return Alert(row['id'], row['warehouse_id'], row['kind'], row['product'],
+                 from_units(row['threshold']), value, bool(row['firing']))
+
+
+class AlertEngine:
+    """Stores threshold rules and evaluates them on warehouse changes.
+
+    The managers call evaluate() for each changed warehouse inside their
+    transactions, wrapped in collect() so the alerts are only dispatched
+    once the transaction has committed.
+    """
+
+    def __init__(self, get_connection, catalog, dispatcher=None,
+                 read_connection=None):
+        """Initialize with a connection factory and the product catalog.
+
+        rules() opens its connections with read_connection if given, with
+        get_connection otherwise.
+        """
+        self._get_connection = get_connection
+        self._read_connection = read_connection or get_connection
+        self._catalog = catalog
+        self.dispatcher = dispatcher if dispatcher is not None \
+            else AlertDispatcher()
+        self._local = threading.local()
+
+    def add_rule(self, warehouse_id, kind, threshold, product_name=None):
+        """Add a threshold rule to a warehouse, returning its id.
+
+        'fill_above' rules alert when balance / capacity rises above the
+        threshold ratio (e.g. 0.95), 'stock_below' rules when the quantity
+        of product_name falls below the threshold. A new rule starts in
+        the current state, so only later crossings alert. Raises
+        ValueError for an invalid kind or product; returns None if the
+        warehouse does not exist.
+        """
+        if kind not in KINDS:
+            raise ValueError(f"Unknown alert kind: {kind}")
+        if (kind == 'stock_below') != bool(product_name):
+            raise ValueError("Stock rules, and only they, need a product")
+        product_id = self._catalog.intern(product_name) if product_name \
+            else None
+        conn = self._get_connection()
+        try:
+            return self._insert_rule(conn, warehouse_id, kind,
+                                     to_units(threshold), product_id)
+        finally:
+            conn.close()
+
+    def _insert_rule(self, conn, warehouse_id, kind, threshold, product_id):
+        """Insert a rule in its current state, None if no warehouse."""
+        rule = conn.execute(
+            """INSERT INTO alert_rules (warehouse_id, product_id, kind,
+                                        threshold)
+               SELECT id, ?, ?, ? FROM warehouses WHERE id = ?
+               RETURNING id""",
+            (product_id, kind, threshold, warehouse_id)
+        ).fetchone()
+        if rule is None:
+            return None
+        conn.execute(
+            f"UPDATE alert_rules SET firing = {_CONDITION} WHERE id = ?",
+            (rule['id'],)
+        )
+        conn.commit()
+        return rule['id']
+
+    def remove_rule(self, rule_id):
+        """Remove a rule, returning False if it does not exist."""
+        conn = self._get_connection()
+        try:
+            with conn:
+                deleted = conn.execute("DELETE FROM alert_rules WHERE id = ?",
+                                       (rule_id,)).rowcount
+        finally:
+            conn.close()
+        return deleted > 0
+
+    def rules(self, warehouse_id=None):
+        """Get the rules of a warehouse, or of all warehouses, as dicts."""
+        conn = self._read_connection()
+        try:
+            rows = conn.execute(
+                """SELECT r.id, r.warehouse_id, r.kind, c.name AS product,
+                          r.threshold, r.firing
+                   FROM alert_rules r
+                   LEFT JOIN catalog c ON c.id = r.product_id
+                   WHERE ?1 IS NULL OR r.warehouse_id = ?1
+                   ORDER BY r.warehouse_id, r.id""",
+                (warehouse_id,)
+            ).fetchall()
+        finally:
+            conn.close()
+        return [dict(row, threshold=from_units(row['threshold']),
+                     firing=bool(row['firing'])) for row in rows]
+
+    def evaluate(self, conn, warehouse_id):
+        """Update the rules of a changed warehouse in its transaction.
+
+        Alerts of rules whose condition changed are held for collect().
+        """
+        rows = conn.execute(_EVALUATE, (warehouse_id,)).fetchall()
+        if rows:
+            self._pending().extend(_alert(row) for row in rows)
+
+    def _pending(self):
+        """Get the alerts held for the current thread's transaction."""
+        if not hasattr(self._local, 'alerts'):
+            self._local.alerts = []
+        return self._local.alerts
+
+    @contextmanager
+    def savepoint(self):
+        """Drop the alerts evaluated in the block if it raises.
+
+        For changes rolled back to a savepoint inside collect().
+        """
+        pending = self._pending()
+        mark = len(pending)
+        try:
+            yield
+        except BaseException:
+            del pending[mark:]
+            raise
+
+    @contextmanager
+    def collect(self):
+        """Dispatch the alerts evaluated in the block if it completes.
+
+        The block must commit its transaction; if it raises, its alerts
+        are dropped along with the rolled back changes.
+        """
+        self._local.alerts = []
+        try:
+            yield
+        except BaseException:
+            self._local.alerts = []
+            raise
+        alerts, self._local.alerts = self._local.alerts, []
+        if alerts:
+            self.dispatcher.submit(alerts)
+
+
+class AlertDispatcher(QueueWorker):
+    """Delivers alerts to sinks from a background thread.
+
+    submit() only puts alerts on a bounded queue, so it never waits for
+    the sinks. When the queue is full, new alerts are dropped, logged
+    and counted in dropped. The thread starts on the first submit().
+    """
+
+    def __init__(self, sinks=None, maxsize=QUEUE_SIZE):
+        """Initialize with sinks (a LogSink by default)."""
+        super().__init__('alert-dispatcher', maxsize)
+        self.sinks = [LogSink()] if sinks is None else list(sinks)
+        self.dropped = 0
+
+    def submit(self, alerts):
+        """Queue alerts for delivery without blocking."""
+        self.start()
+        for alert in alerts:
+            try:
+                self.queue.put_nowait(alert)
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+                logger.warning("Alert queue full, dropped: %s",
+                               format_alert(alert))
+
+    def wait(self):
+        """Wait until all queued alerts have been delivered."""
+        self.queue.join()
+
+    def _run(self):
+        """Deliver queued alerts until the None stop marker."""
+        for alert in iter(self.queue.get, None):
+            self._deliver(alert)
+            self.queue.task_done()
+        self.queue.task_done()
+
+    def _deliver(self, alert):
+        """Send an alert to every sink."""
+        for sink in self.sinks:
+            try:
+                sink.send(alert)
+            # A failing sink must not stop delivery to the others
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Alert sink %r failed", sink)
+
+
+class LogSink:  # pylint: disable=too-few-public-methods
+    """Logs alerts as warnings."""
+
+    def send(self, alert):
+        """Log an alert."""
+        logger.warning("Alert: %s", format_alert(alert))
+
+
+class WebhookSink:  # pylint: disable=too-few-public-methods
+    """POSTs each alert as a JSON object to a URL."""
+
+    def __init__(self, url, timeout=WEBHOOK_TIMEOUT):
+        """Initialize with the URL and a timeout in seconds."""
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, alert):
+        """POST an alert, raising OSError if the request fails."""
+        request = urllib.request.Request(
+            self.url, data=json.dumps(alert._asdict()).encode(),
+            headers={'Content-Type': 'application/json'}, method='POST'
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as reply:
+            reply.read()
+
+
+class SSESink:
+    """Streams alerts to Server-Sent Events clients.
+
+    Each client has a bounded queue; a client that cannot keep up loses
+    alerts instead of holding up the dispatcher.
+    """
+
+    def __init__(self, maxsize=QUEUE_SIZE, keepalive=KEEPALIVE_SECONDS):
+        """Initialize without clients."""
+        self._maxsize = maxsize
+        self.keepalive = keepalive
+        self._clients = set()
+        self._lock = threading.Lock()
+
+    def send(self, alert):
+        """Queue an alert as an SSE event for every client."""
+        event = f"data: {json.dumps(alert._asdict())}\n\n"
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.put_nowait(event)
+            except queue.Full:
+                pass
+
+    def stream(self):
+        """Generate the SSE events of a new client until closed.
+
+        A comment is sent after keepalive idle seconds, so a closed
+        connection is noticed.
+        """
+        client = queue.Queue(self._maxsize)
+        with self._lock:
+            self._clients.add(client)
+        try:
+            while True:
+                yield _next_event(client, self.keepalive)
+        finally:
+            with self._lock:
+                self._clients.discard(client)
+
+
+def _next_event(client, timeout):
+    """Wait for the next event of an SSE client, or a keepalive comment."""
+    try:
+        return client.get(timeout=timeout)
+    except queue.Empty:
+        return ": keepalive\n\n"
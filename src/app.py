@@ -1,20 +1,275 @@
 """Flask web application for warehouse management."""
-from flask import Flask, render_template, request, redirect, url_for, flash
-from warehouse_manager import WarehouseManager
+import math
+import os
+import threading
+from functools import partial
+from itertools import chain, islice
+import click
+from flask import (Flask, Response, current_app, render_template, request,
+                   redirect, url_for, flash, get_flashed_messages, jsonify,
+                   stream_template)
+from flask.cli import with_appcontext
+from warehouse_manager import (CONFLICT, VERIFY_BATCH_SIZE, ConflictError,
+                               WarehouseManager)
+from memory_store import MemoryWarehouseManager
+from sharding import ShardedWarehouseManager, import_sharded_snapshot
+from group_commit import GroupCommitManager
+from profiler import RequestProfiler
+from alerts import SSESink, WebhookSink
+from quantity import MAX_QUANTITY, format_quantity
+from history import DAY, MAX_POINTS
+from search import FACETS, PER_PAGE
+from replica import READ_POOL_SIZE
+from snapshot import import_snapshot
+
+SECRET_KEY = 'warehouse-secret-key-12345'
+
+# Extension key under which the app's WarehouseManager is stored
+MANAGER_EXTENSION = 'warehouse_manager'
+
+DEFAULT_CONFIG = {
+    # Database path, None for warehouse.db next to warehouse_manager.py
+    'DATABASE': None,
+    # 'sqlite' reads and writes the database directly, 'memory' serves
+    # from memory and writes behind every FLUSH_INTERVAL seconds, 'sharded'
+    # spreads warehouses over SHARDS databases next to DATABASE
+    'STORAGE': 'sqlite',
+    'SHARDS': 4,
+    'FLUSH_INTERVAL': 1.0,
+    'FLUSH_BATCH_SIZE': 100,
+    # With 'sqlite' storage, commit bursts of product additions in groups
+    # of up to GROUP_COMMIT_BATCH, waiting GROUP_COMMIT_DELAY seconds for
+    # more, see group_commit.py
+    'GROUP_COMMIT': False,
+    'GROUP_COMMIT_BATCH': 200,
+    'GROUP_COMMIT_DELAY': 0.002,
+    # With 'sqlite' storage, queries use up to READ_POOL_SIZE idle read-only
+    # connections; with READ_REPLICA_STALENESS seconds they read a copy of
+    # the database refreshed that often instead, see replica.py
+    'READ_POOL_SIZE': READ_POOL_SIZE,
+    'READ_REPLICA_STALENESS': None,
+    # Seconds between capacity history compactions, None to not compact
+    'HISTORY_COMPACT_INTERVAL': 60.0,
+    # URL receiving each alert as a JSON POST, None to not send webhooks
+    'ALERT_WEBHOOK_URL': None,
+}
+
+# Maximum number of product names returned by the catalog search
+CATALOG_SEARCH_LIMIT = 20
+# Days of capacity history returned when not given
+HISTORY_DEFAULT_DAYS = 7
+# Most days of history returned: daily points are kept forever, and a
+# query returns at most MAX_POINTS of them
+HISTORY_MAX_DAYS = MAX_POINTS
+# Maximum number of warehouses on a page of search results
+SEARCH_MAX_PER_PAGE = 100
+# Number of product facet values (most held first) returned by searches
+SEARCH_PRODUCT_FACETS = 10
+# Largest id SQLite can store, larger ids in requests are invalid
+MAX_ID = 2 ** 63 - 1
+# Highest page of search results, so the offset of its rows fits in an
+# SQLite integer
+SEARCH_MAX_PAGE = MAX_ID // SEARCH_MAX_PER_PAGE
+# Characters of a streamed page sent at once
+STREAM_CHUNK_SIZE = 16384
+
+# Routes recorded by @_route and registered on each app by create_app
+_ROUTES = []
+_manager_lock = threading.Lock()
+
+
+def _route(rule, **options):
+    """Record a view function to be registered by create_app."""
+    def decorator(view):
+        _ROUTES.append((rule, view, options))
+        return view
+    return decorator
+
+
+def create_app(config=None, manager=None):
+    """Create and configure a Flask application.
+
+    The WarehouseManager (and with it the database) is created lazily on
+    first use unless one is given, so creating the app stays cheap.
+    """
+    flask_app = Flask(__name__)
+    flask_app.secret_key = SECRET_KEY
+    flask_app.config.update(DEFAULT_CONFIG)
+    flask_app.config.update(config or {})
+    if manager is not None:
+        flask_app.extensions[MANAGER_EXTENSION] = manager
+
+    _register(flask_app)
+
+    # Opt-in request profiling (X-Profile header or ?profile=1)
+    RequestProfiler(flask_app, get_manager)
+    return flask_app
+
+
+def _register(flask_app):
+    """Register the routes, template filter and CLI commands on an app."""
+    flask_app.add_template_filter(format_quantity, 'quantity')
+    for rule, view, options in _ROUTES:
+        flask_app.add_url_rule(rule, view_func=view, **options)
+    flask_app.cli.add_command(verify_command)
+    flask_app.cli.add_command(export_snapshot_command)
+    flask_app.cli.add_command(import_snapshot_command)
+
+
+def get_manager():
+    """Get the current app's WarehouseManager, creating it on first use."""
+    manager = current_app.extensions.get(MANAGER_EXTENSION)
+    if manager is None:
+        manager = _create_manager()
+    return manager
+
+
+def _create_manager():
+    """Create the app's WarehouseManager once, even under concurrency."""
+    extensions = current_app.extensions
+    with _manager_lock:
+        if MANAGER_EXTENSION not in extensions:
+            extensions[MANAGER_EXTENSION] = _build_manager(current_app.config)
+        return extensions[MANAGER_EXTENSION]
+
+
+def _build_manager(config):
+    """Build the WarehouseManager and start its background work."""
+    manager = _create_storage(config)
+    if config['HISTORY_COMPACT_INTERVAL']:
+        manager.history.start_compactor(config['HISTORY_COMPACT_INTERVAL'])
+    _add_alert_sinks(manager.alerts.dispatcher.sinks, config)
+    return manager
+
+
+def _create_storage(config):
+    """Create the WarehouseManager for the configured storage mode."""
+    if config['STORAGE'] == 'memory':
+        return MemoryWarehouseManager(
+            config['DATABASE'],
+            flush_interval=config['FLUSH_INTERVAL'],
+            batch_size=config['FLUSH_BATCH_SIZE']
+        )
+    if config['STORAGE'] == 'sharded':
+        return ShardedWarehouseManager(config['DATABASE'], config['SHARDS'])
+    if config['GROUP_COMMIT']:
+        manager = GroupCommitManager(config['DATABASE'],
+                                     config['GROUP_COMMIT_BATCH'],
+                                     config['GROUP_COMMIT_DELAY'])
+    else:
+        manager = WarehouseManager(config['DATABASE'])
+    manager.reads.size = config['READ_POOL_SIZE']
+    manager.reads.max_staleness = config['READ_REPLICA_STALENESS']
+    return manager
+
+
+def _add_alert_sinks(sinks, config):
+    """Add the SSE stream and the configured webhook to the alert sinks."""
+    sinks.append(SSESink())
+    if config['ALERT_WEBHOOK_URL']:
+        sinks.append(WebhookSink(config['ALERT_WEBHOOK_URL']))
+
+
+@click.command('verify')
+@click.option('--repair', is_flag=True,
+              help='Set mismatched balances to their product sums.')
+@click.option('--batch-size', default=VERIFY_BATCH_SIZE, show_default=True,
+              type=click.IntRange(min=1),
+              help='Warehouses checked per transaction.')
+@click.option('--pause', default=0.0, show_default=True,
+              type=click.FloatRange(min=0.0),
+              help='Seconds to sleep between batches.')
+@with_appcontext
+def verify_command(repair, batch_size, pause):
+    """Check warehouse balances against the sums of their products.
+
+    Exits with status 1 if mismatches remain unrepaired.
+    """
+    report = get_manager().verify_and_repair(repair, batch_size, pause)
+    for warehouse_id, (balance, total) in sorted(report['mismatches'].items()):
+        click.echo(f"Warehouse {warehouse_id}: balance "
+                   f"{format_quantity(balance)}, products "
+                   f"{format_quantity(total)}")
+    click.echo(f"Checked {report['checked']} warehouses, "
+               f"{len(report['mismatches'])} mismatched, "
+               f"{report['repaired']} repaired.")
+    if len(report['mismatches']) > report['repaired']:
+        raise SystemExit(1)
+
+
+def _echo_counts(counts):
+    """Echo the number of rows of each table of a snapshot."""
+    click.echo(', '.join(f"{rows} {table}" for table, rows in counts.items()))
+
+
+@click.command('export-snapshot')
+@click.argument('path')
+@click.option('--compress', is_flag=True,
+              help='Compress the snapshot with zlib.')
+@with_appcontext
+def export_snapshot_command(path, compress):
+    """Write a binary snapshot of all warehouses to PATH.
+
+    With sharded storage each shard is written to its own file, named
+    like the shard databases (PATH with .shard0 and so on before its
+    extension); import them with import-snapshot --shards.
+    """
+    _echo_counts(get_manager().export_snapshot(path, compress))
+
+
+@click.command('import-snapshot')
+@click.argument('path')
+@click.argument('database')
+@click.option('--shards', type=click.IntRange(min=1),
+              help='Import a snapshot of sharded storage with this many '
+                   'shards into the directory database DATABASE and its '
+                   'shards.')
+def import_snapshot_command(path, database, shards):
+    """Create a new database file DATABASE from the snapshot at PATH."""
+    try:
+        _echo_counts(import_snapshot(path, database) if shards is None
+                     else import_sharded_snapshot(path, database, shards))
+    except (OSError, ValueError) as error:
+        raise click.ClickException(str(error)) from error
 
-app = Flask(__name__)
-app.secret_key = 'warehouse-secret-key-12345'
 
-# Global warehouse manager instance
-manager = WarehouseManager()
+def _parse_float(value):
+    """Parse a float value from form input, returning None on failure.
 
+    Non-finite values and values too large to store as milli-units fail.
+    """
+    try:
+        number = float(value) if value else None
+    except (ValueError, TypeError):
+        return None
+    if number is None or not math.isfinite(number):
+        return None
+    return number if abs(number) <= MAX_QUANTITY else None
 
-def _parse_float(value):
-    """Parse a float value from form input, returning None on failure."""
+
+def _parse_id(value):
+    """Parse a positive integer id, returning None if invalid.
+
+    Ids SQLite cannot store are invalid too.
+    """
     try:
-        return float(value) if value else None
+        number = int(value)
     except (ValueError, TypeError):
         return None
+    return number if 0 < number <= MAX_ID else None
+
+
+def _parse_ids(values):
+    """Parse integer ids from form input, skipping invalid values."""
+    return [number for number in map(_parse_id, values) if number is not None]
+
+
+def _parse_version():
+    """Parse the warehouse version the submitted form was based on."""
+    try:
+        return int(request.form['version'])
+    except (KeyError, ValueError):
+        return None
 
 
 def _handle_create_post():
@@ -27,7 +282,7 @@ def _handle_create_post():
         flash('Invalid warehouse data!', 'error')
         return None
 
-    wh_id = manager.create_warehouse(name, capacity, warehouse_type)
+    wh_id = get_manager().create_warehouse(name, capacity, warehouse_type)
     if wh_id:
         flash('Warehouse created successfully!', 'success')
         return redirect(url_for('index'))
@@ -36,14 +291,38 @@ def _handle_create_post():
     return None
 
 
-@app.route('/')
+@_route('/')
 def index():
-    """Display all warehouses."""
-    warehouses = manager.get_all_warehouses()
-    return render_template('index.html', warehouses=warehouses)
-
-
-@app.route('/create', methods=['GET', 'POST'])
+    """Display all warehouses.
+
+    The page is streamed while the warehouses are read, so its memory use
+    does not grow with their number.
+    """
+    warehouses = get_manager().iter_warehouses()
+    first = next(warehouses, None)
+    if first is not None:
+        warehouses = chain([first], warehouses)
+    # Flashed messages are taken from the session before the headers go
+    get_flashed_messages(with_categories=True)
+    return Response(_chunked(stream_template(
+        'index.html', warehouses=warehouses if first is not None else None
+    )), mimetype='text/html')
+
+
+def _chunked(pieces, size=STREAM_CHUNK_SIZE):
+    """Join the small pieces of a streamed template into chunks of size."""
+    chunk, length = [], 0
+    for piece in pieces:
+        chunk.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+@_route('/create', methods=['GET', 'POST'])
 def create_warehouse():
     """Create a new warehouse."""
     if request.method == 'POST':
@@ -73,31 +352,59 @@ def _handle_warehouse_update(warehouse_id):
 
     if not (name and capacity and capacity > 0):
         flash('Invalid warehouse data!', 'error')
-        return
+        return None
 
-    success, message = manager.update_warehouse(warehouse_id, name, capacity)
+    success, message = get_manager().update_warehouse(
+        warehouse_id, name, capacity, _parse_version()
+    )
+    if message == CONFLICT:
+        return _conflict(warehouse_id)
     _flash_update_result(success, message)
+    return None
+
+
+def _conflict(warehouse_id):
+    """Respond to a conflicting concurrent change with the current state."""
+    flash('The warehouse was changed by someone else meanwhile. '
+          'Check the current values and try again.', 'error')
+    return _render_warehouse(warehouse_id, 409)
+
+
+def _warehouse_not_found():
+    """Flash a not found message and redirect to the index page."""
+    flash('Warehouse not found!', 'error')
+    return redirect(url_for('index'))
 
 
-@app.route('/warehouse/<int:warehouse_id>', methods=['GET', 'POST'])
+@_route('/warehouse/<int:warehouse_id>', methods=['GET', 'POST'])
 def view_warehouse(warehouse_id):
     """View warehouse details, edit capacity, and manage products."""
-    warehouse = manager.get_warehouse(warehouse_id)
+    if request.method == 'POST' and 'update_warehouse' in request.form:
+        # Only existence matters before updating and redirecting
+        if not get_manager().get_warehouse(warehouse_id, projection=('id',)):
+            return _warehouse_not_found()
+        return _handle_warehouse_update(warehouse_id) or redirect(
+            url_for('view_warehouse', warehouse_id=warehouse_id)
+        )
 
-    if not warehouse:
-        flash('Warehouse not found!', 'error')
-        return redirect(url_for('index'))
+    return _render_warehouse(warehouse_id)
 
-    if request.method == 'POST' and 'update_warehouse' in request.form:
-        _handle_warehouse_update(warehouse_id)
-        return redirect(url_for('view_warehouse', warehouse_id=warehouse_id))
 
-    available_products = WarehouseManager.AVAILABLE_PRODUCTS
+def _render_warehouse(warehouse_id, status=200):
+    """Render the warehouse page with the current state."""
+    warehouse = get_manager().get_warehouse(warehouse_id)
+    if not warehouse:
+        return _warehouse_not_found()
+
+    available_products = get_manager().catalog.suggested()
     warehouse_type = warehouse.get('type', 'fruit')
     return render_template('view_warehouse.html',
                            warehouse=warehouse,
                            available_products=available_products,
-                           warehouse_type=warehouse_type)
+                           warehouse_type=warehouse_type,
+                           alert_rules=get_manager().alerts.rules(
+                               warehouse_id
+                           )), status
 
 
 def _get_product_name(warehouse):
@@ -109,37 +416,148 @@ def _get_product_name(warehouse):
 
 
 def _handle_add_product(warehouse_id, product_name, quantity):
-    """Handle product addition and flash result."""
-    if manager.add_product(warehouse_id, product_name, quantity):
+    """Handle product addition and flash result.
+
+    Returns a conflict response if the warehouse changed meanwhile.
+    """
+    try:
+        added = get_manager().add_product(warehouse_id, product_name,
+                                          quantity, _parse_version())
+    except ConflictError:
+        return _conflict(warehouse_id)
+    if added:
         flash(f'Added {quantity} units of {product_name}!', 'success')
     else:
         flash('Could not add product. Check warehouse capacity!', 'error')
+    return None
 
 
-@app.route('/warehouse/<int:warehouse_id>/add_product', methods=['POST'])
+@_route('/warehouse/<int:warehouse_id>/add_product', methods=['POST'])
 def add_product(warehouse_id):
     """Add a product to a warehouse."""
-    warehouse = manager.get_warehouse(warehouse_id)
+    warehouse = get_manager().get_warehouse(warehouse_id, projection=('type',))
     if not warehouse:
-        flash('Warehouse not found!', 'error')
-        return redirect(url_for('index'))
+        return _warehouse_not_found()
 
     product_name = _get_product_name(warehouse)
     quantity = _parse_float(request.form.get('quantity'))
 
     if product_name and quantity and quantity > 0:
-        _handle_add_product(warehouse_id, product_name, quantity)
+        conflict = _handle_add_product(warehouse_id, product_name, quantity)
+        if conflict:
+            return conflict
     else:
         flash('Invalid product data!', 'error')
 
     return redirect(url_for('view_warehouse', warehouse_id=warehouse_id))
 
 
-@app.route('/warehouse/<int:warehouse_id>/remove_product/<product_name>',
+@_route('/catalog/search')
+def catalog_search():
+    """Search the product catalog for the add product form."""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify(products=[])
+
+    catalog = get_manager().catalog
+    names = catalog.search(query, CATALOG_SEARCH_LIMIT)
+    if not names:
+        names = catalog.fuzzy_search(query, CATALOG_SEARCH_LIMIT)
+    return jsonify(products=names)
+
+
+def _run_search():
+    """Search warehouses with the q, facet, page and per_page arguments.
+
+    Raises ValueError for invalid facet values.
+    """
+    query = request.args.get('q', '').strip()
+    filters = {facet: request.args.get(facet, '') for facet in FACETS}
+    page = min(max(request.args.get('page', 1, type=int), 1),
+               SEARCH_MAX_PAGE)
+    per_page = min(max(request.args.get('per_page', PER_PAGE, type=int), 1),
+                   SEARCH_MAX_PER_PAGE)
+    found = get_manager().search_warehouses(query, filters, page, per_page)
+    facets = found['facets']
+    facets['product'] = dict(islice(facets['product'].items(),
+                                    SEARCH_PRODUCT_FACETS))
+    found.update(query=query, filters=filters, page=page, per_page=per_page,
+                 pages=max(math.ceil(found['total'] / per_page), 1))
+    return found
+
+
+def _search_url(found, **changes):
+    """Get the URL of a search with some of its arguments changed."""
+    args = {'q': found['query'], **found['filters'], 'page': found['page'],
+            'per_page': found['per_page'] != PER_PAGE and found['per_page']}
+    args.update(changes)
+    return url_for('search', **{key: value for key, value in args.items()
+                                if value})
+
+
+@_route('/search')
+def search():
+    """Search warehouses by name and products, narrowed down by facets."""
+    try:
+        found = _run_search()
+    except ValueError as error:
+        flash(str(error), 'error')
+        return redirect(url_for('search'))
+    return render_template('search.html', found=found,
+                           search_url=partial(_search_url, found))
+
+
+@_route('/warehouses/search')
+def search_json():
+    """Search warehouses like /search, returning JSON."""
+    try:
+        found = _run_search()
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+    return jsonify(
+        total=found['total'], page=found['page'], pages=found['pages'],
+        warehouses=[{
+            'id': warehouse['id'], 'name': warehouse['name'],
+            'type': warehouse['type'],
+            'balance': warehouse['varasto'].saldo,
+            'capacity': warehouse['varasto'].tilavuus,
+        } for warehouse in found['warehouses']],
+        facets=found['facets']
+    )
+
+
+@_route('/warehouse/<int:warehouse_id>/history')
+def warehouse_history(warehouse_id):
+    """Get the capacity history of a warehouse as JSON for charts.
+
+    The ?days= argument selects how far back the history goes, up to
+    HISTORY_MAX_DAYS. Missing or invalid values give HISTORY_DEFAULT_DAYS.
+    """
+    if not get_manager().get_warehouse(warehouse_id, projection=('id',)):
+        return jsonify(error='Warehouse not found'), 404
+
+    days = _parse_float(request.args.get('days'))
+    if days is None or days <= 0:
+        days = HISTORY_DEFAULT_DAYS
+    days = min(days, HISTORY_MAX_DAYS)
+    history = get_manager().history
+    end = int(history.clock()) + 1
+    points = history.query(end - int(days * DAY), end, [warehouse_id])
+    return jsonify(points=[
+        point._asdict() for point in points.get(warehouse_id, [])
+    ])
+
+
+@_route('/warehouse/<int:warehouse_id>/remove_product/<product_name>',
            methods=['POST'])
 def remove_product(warehouse_id, product_name):
     """Remove a product from a warehouse."""
-    if manager.remove_product(warehouse_id, product_name):
+    try:
+        removed = get_manager().remove_product(warehouse_id, product_name,
+                                               _parse_version())
+    except ConflictError:
+        return _conflict(warehouse_id)
+    if removed:
         flash(f'Removed {product_name}!', 'success')
     else:
         flash('Could not remove product!', 'error')
@@ -147,10 +565,175 @@ def remove_product(warehouse_id, product_name):
     return redirect(url_for('view_warehouse', warehouse_id=warehouse_id))
 
 
-@app.route('/warehouse/<int:warehouse_id>/delete', methods=['POST'])
+@_route('/warehouse/<int:warehouse_id>/remove_products', methods=['POST'])
+def remove_products(warehouse_id):
+    """Remove the selected products of a warehouse in one transaction."""
+    try:
+        removed = get_manager().remove_products(
+            warehouse_id, request.form.getlist('product_names'),
+            _parse_version()
+        )
+    except ConflictError:
+        return _conflict(warehouse_id)
+    if removed:
+        flash(f'Removed {removed} products!', 'success')
+    else:
+        flash('Could not remove products!', 'error')
+
+    return redirect(url_for('view_warehouse', warehouse_id=warehouse_id))
+
+
+@_route('/warehouse/<int:warehouse_id>/move_products', methods=['POST'])
+def move_products(warehouse_id):
+    """Move the selected products to another warehouse in one transaction."""
+    target_id = _parse_ids([request.form.get('target_id')])
+    if not target_id:
+        flash('Invalid target warehouse!', 'error')
+        return redirect(url_for('view_warehouse', warehouse_id=warehouse_id))
+
+    success, message = get_manager().move_products(
+        warehouse_id, target_id[0], request.form.getlist('product_names'),
+        _parse_version()
+    )
+    if message == CONFLICT:
+        return _conflict(warehouse_id)
+    if success:
+        flash(f'Moved products to warehouse #{target_id[0]}!', 'success')
+    else:
+        flash(f'Could not move products: {message}!', 'error')
+
+    return redirect(url_for('view_warehouse', warehouse_id=warehouse_id))
+
+
+def _parse_alert_rule():
+    """Parse the kind, threshold and product of a submitted alert rule.
+
+    Fill thresholds are entered in percent. Returns None if invalid.
+    """
+    kind = request.form.get('kind')
+    threshold = _parse_float(request.form.get('threshold'))
+    if threshold is None or threshold < 0:
+        return None
+    if kind == 'fill_above':
+        return kind, threshold / 100, None
+    return kind, threshold, request.form.get('product_name', '').strip()
+
+
+@_route('/warehouse/<int:warehouse_id>/alerts', methods=['POST'])
+def add_alert_rule(warehouse_id):
+    """Add a threshold alert rule to a warehouse."""
+    rule = _parse_alert_rule()
+    try:
+        rule_id = rule and get_manager().alerts.add_rule(warehouse_id, *rule)
+    except ValueError:
+        rule_id = None
+    if rule_id is not None:
+        flash('Alert added!', 'success')
+    else:
+        flash('Invalid alert rule!', 'error')
+
+    return redirect(url_for('view_warehouse', warehouse_id=warehouse_id))
+
+
+@_route('/warehouse/<int:warehouse_id>/alerts/<int:rule_id>/delete',
+        methods=['POST'])
+def remove_alert_rule(warehouse_id, rule_id):
+    """Remove an alert rule of a warehouse."""
+    if get_manager().alerts.remove_rule(rule_id):
+        flash('Alert removed!', 'success')
+    else:
+        flash('Could not remove alert!', 'error')
+
+    return redirect(url_for('view_warehouse', warehouse_id=warehouse_id))
+
+
+@_route('/alerts/stream')
+def alert_stream():
+    """Stream alerts as Server-Sent Events."""
+    sinks = get_manager().alerts.dispatcher.sinks
+    sink = next((sink for sink in sinks if isinstance(sink, SSESink)), None)
+    if sink is None:
+        return jsonify(error='Alert stream not enabled'), 404
+    return Response(sink.stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@_route('/warehouse/<int:warehouse_id>/transfer', methods=['POST'])
+def transfer_product(warehouse_id):
+    """Transfer a quantity of a product to another warehouse."""
+    target_id = _parse_ids([request.form.get('target_id')])
+    quantity = _parse_quantity(request.form.get('quantity'))
+    product_name = request.form.get('product_name')
+    if target_id and quantity and product_name:
+        _flash_transfer(warehouse_id, target_id[0], product_name, quantity)
+    else:
+        flash('Invalid transfer!', 'error')
+
+    return redirect(url_for('view_warehouse', warehouse_id=warehouse_id))
+
+
+def _flash_transfer(source_id, target_id, product_name, quantity):
+    """Make a transfer and flash its result."""
+    success, message = get_manager().transfer(source_id, target_id,
+                                              product_name, quantity)
+    if success:
+        flash(f'Transferred {quantity} units of {product_name} to '
+              f'warehouse #{target_id}!', 'success')
+    else:
+        flash(f'Could not transfer: {message}!', 'error')
+
+
+def _parse_transfers(data):
+    """Parse the transfers of a /transfers request body.
+
+    Returns (source id, target id, product name, quantity) tuples, or
+    None if the body is invalid. Ids must be JSON integers SQLite can
+    store and quantities positive numbers.
+    """
+    items = data.get('transfers') if isinstance(data, dict) else None
+    try:
+        transfers = [(_parse_json_id(item['source_id']),
+                      _parse_json_id(item['target_id']),
+                      str(item['product']), _parse_quantity(item['quantity']))
+                     for item in items]
+    except (KeyError, TypeError):
+        return None
+    if any(None in transfer for transfer in transfers):
+        return None
+    return transfers
+
+
+def _parse_json_id(value):
+    """Parse an id given as a JSON integer, returning None if invalid."""
+    if isinstance(value, bool) or not isinstance(value, int):
+        return None
+    return _parse_id(value)
+
+
+def _parse_quantity(value):
+    """Parse a positive quantity, returning None if invalid."""
+    quantity = _parse_float(value)
+    return quantity if quantity is not None and quantity > 0 else None
+
+
+@_route('/transfers', methods=['POST'])
+def transfers_json():
+    """Make a batch of transfers atomically from a JSON body.
+
+    The body is {"transfers": [{"source_id", "target_id", "product",
+    "quantity"}, ...]}. Responds 409 if the batch could not be made.
+    """
+    transfers = _parse_transfers(request.get_json(silent=True))
+    if transfers is None:
+        return jsonify(error='Invalid transfers'), 400
+    success, message = get_manager().transfer_many(transfers)
+    return jsonify(success=success, message=message), 200 if success else 409
+
+
+@_route('/warehouse/<int:warehouse_id>/delete', methods=['POST'])
 def delete_warehouse(warehouse_id):
     """Delete a warehouse."""
-    if manager.delete_warehouse(warehouse_id):
+    if get_manager().delete_warehouse(warehouse_id):
         flash('Warehouse deleted successfully!', 'success')
     else:
         flash('Could not delete warehouse!', 'error')
@@ -158,7 +741,23 @@ def delete_warehouse(warehouse_id):
     return redirect(url_for('index'))
 
 
+@_route('/warehouses/delete', methods=['POST'])
+def delete_warehouses():
+    """Delete the selected warehouses in one transaction."""
+    warehouse_ids = _parse_ids(request.form.getlist('warehouse_ids'))
+    if warehouse_ids:
+        deleted = get_manager().delete_warehouses(warehouse_ids)
+        flash(f'Deleted {deleted} warehouses!', 'success')
+    else:
+        flash('No warehouses selected!', 'error')
+
+    return redirect(url_for('index'))
+
+
+# Default application used by `flask --app app run` and `python app.py`
+app = create_app()
+
+
 if __name__ == '__main__':  # pragma: no cover
-    import os
     debug_mode = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
     app.run(debug=debug_mode)
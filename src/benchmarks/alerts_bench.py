@@ -0,0 +1,70 @@
+"""Benchmark the write latency added by alert rules.
+
+Times add_product / remove_product pairs on a warehouse without rules,
+with rules that never cross, and with a rule crossed by every write
+whose alerts go to a sink taking 10 ms per alert.
+
+Usage (from src/): python -m benchmarks.alerts_bench [writes] [rules]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from warehouse_manager import WarehouseManager
+
+# Seconds the slow sink takes per alert
+SINK_DELAY = 0.01
+
+
+class SlowSink:  # pylint: disable=too-few-public-methods
+    """Sink taking SINK_DELAY seconds per alert."""
+
+    def send(self, _alert):
+        """Wait instead of sending."""
+        time.sleep(SINK_DELAY)
+
+
+def time_writes(manager, warehouse_id, writes):
+    """Time add/remove pairs, returning microseconds per write."""
+    started = time.perf_counter()
+    for _ in range(writes):
+        manager.add_product(warehouse_id, "Pear", 6.0)
+        manager.remove_product(warehouse_id, "Pear")
+    return (time.perf_counter() - started) / (2 * writes) * 1e6
+
+
+def add_rules(manager, warehouse_id, rules, crossed):
+    """Add rules that are never crossed, and one crossed if crossed."""
+    for number in range(rules):
+        manager.alerts.add_rule(warehouse_id, 'stock_below', 1.0 + number,
+                                f"Item {number}")
+    if crossed:
+        manager.alerts.add_rule(warehouse_id, 'fill_above', 0.5)
+
+
+def time_case(manager, label, writes, rules, crossed):
+    """Time writes to a new warehouse with rules and print them."""
+    warehouse_id = manager.create_warehouse(label, 10.0)
+    add_rules(manager, warehouse_id, rules, crossed)
+    micros = time_writes(manager, warehouse_id, writes)
+    print(f"{label:20} {micros:8.1f} us/write"
+          f"  {manager.alerts.dispatcher.dropped} dropped")
+
+
+def main(writes=500, rules=20):
+    """Time writes without rules, with quiet rules and with alerts."""
+    temp_dir = tempfile.mkdtemp()
+    manager = WarehouseManager(os.path.join(temp_dir, 'alerts.db'))
+    manager.alerts.dispatcher.sinks = [SlowSink()]
+    try:
+        time_case(manager, 'no rules', writes, 0, False)
+        time_case(manager, f'{rules} quiet rules', writes, rules, False)
+        time_case(manager, 'alert per write', writes, 0, True)
+    finally:
+        manager.alerts.dispatcher.stop()
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,124 @@
+"""Benchmark optimistic concurrency control against a global lock.
+
+Threads run a mixed workload (reads, stock increments and warehouse
+updates) on a small set of hot warehouses. The optimistic manager uses
+the compare-and-swap updates of WarehouseManager; the baseline serializes
+every operation with one global lock. Reports throughput and, for the
+optimistic manager, the number of lost compare-and-swap races retried.
+
+Usage (from src/):
+    python -m benchmarks.contention_bench [threads] [warehouses] [ops]
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from warehouse_manager import ConflictError, WarehouseManager
+
+# Share of reads and increments, the rest are warehouse updates
+READS, INCREMENTS = 0.7, 0.25
+
+
+class CountingManager(WarehouseManager):
+    """WarehouseManager counting lost compare-and-swap races."""
+
+    def __init__(self, db_path):
+        """Initialize the manager with a zero conflict count."""
+        super().__init__(db_path)
+        self.conflicts = 0
+        self._count_lock = threading.Lock()
+
+    def _swap(self, conn, row, **changes):
+        """Swap and count conflicts, see WarehouseManager._swap."""
+        try:
+            super()._swap(conn, row, **changes)
+        except ConflictError:
+            with self._count_lock:
+                self.conflicts += 1
+            raise
+
+
+class GlobalLockManager(WarehouseManager):
+    """WarehouseManager serializing every operation with a global lock."""
+
+    def __init__(self, db_path):
+        """Initialize the manager and its global lock."""
+        super().__init__(db_path)
+        self.conflicts = 0
+        self._global_lock = threading.Lock()
+
+    def get_warehouse(self, warehouse_id, projection='full'):
+        """Get a warehouse holding the global lock."""
+        with self._global_lock:
+            return super().get_warehouse(warehouse_id, projection)
+
+    def get_products(self, warehouse_id):
+        """Get the products of a warehouse holding the global lock."""
+        with self._global_lock:
+            return super().get_products(warehouse_id)
+
+    def add_product(self, warehouse_id, product_name, quantity,
+                    expected_version=None):
+        """Add a product holding the global lock."""
+        with self._global_lock:
+            return super().add_product(warehouse_id, product_name,
+                                       quantity, expected_version)
+
+    def update_warehouse(self, warehouse_id, name, capacity,
+                         expected_version=None):
+        """Update a warehouse holding the global lock."""
+        with self._global_lock:
+            return super().update_warehouse(warehouse_id, name, capacity,
+                                            expected_version)
+
+
+def operate(manager, warehouse_ids, ops, seed):
+    """Run ops random operations on the hot warehouses."""
+    rng = random.Random(seed)
+    for _ in range(ops):
+        warehouse_id = rng.choice(warehouse_ids)
+        roll = rng.random()
+        if roll < READS:
+            dict(manager.get_warehouse(warehouse_id)['products'])
+        elif roll < READS + INCREMENTS:
+            manager.add_product(warehouse_id, rng.choice('ABCDE'), 0.5)
+        else:
+            manager.update_warehouse(warehouse_id, f"Hot {warehouse_id}",
+                                     1_000_000)
+
+
+def run(manager_class, threads, warehouses, ops):
+    """Time the workload with a fresh database, return (ops/s, conflicts)."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        manager = manager_class(os.path.join(temp_dir, 'bench.db'))
+        ids = [manager.create_warehouse(f"Hot {number}", 1_000_000)
+               for number in range(warehouses)]
+        workers = [
+            threading.Thread(target=operate, args=(manager, ids, ops, number))
+            for number in range(threads)
+        ]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - started
+        assert not manager.find_drift(), "balances drifted"
+        return threads * ops / seconds, manager.conflicts
+
+
+def main(threads=8, warehouses=2, ops=300):
+    """Compare both managers and print their throughput."""
+    print(f"{threads} threads, {warehouses} hot warehouses, "
+          f"{ops} operations per thread")
+    for name, manager_class in (('optimistic', CountingManager),
+                                ('global lock', GlobalLockManager)):
+        throughput, conflicts = run(manager_class, threads, warehouses, ops)
+        print(f"{name:<12} {throughput:8.0f} ops/s  "
+              f"{conflicts} lost races retried")
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,73 @@
+"""Benchmark add_product bursts with and without group commit.
+
+Each burst starts one thread per addition at once, like a burst of
+POSTs served by a threaded server, and reports additions per second
+for WarehouseManager (one commit each) and GroupCommitManager.
+
+Usage (from src/): python -m benchmarks.group_commit_bench [bursts...]
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from group_commit import GroupCommitManager
+from warehouse_manager import WarehouseManager
+
+BURSTS = (1, 10, 50, 200)
+
+
+def add_after(barrier, manager, warehouse_id, number, errors):
+    """Wait for the barrier, then add a product, keeping lock errors."""
+    barrier.wait()
+    try:
+        manager.add_product(warehouse_id, f"Item {number}", 1.0)
+    except sqlite3.OperationalError as error:
+        errors.append(error)  # Typically "database is locked"
+
+
+def burst(manager, warehouse_id, size):
+    """Add size products from size threads, returning (seconds, errors)."""
+    errors = []
+    barrier = threading.Barrier(size + 1)
+    threads = [threading.Thread(target=add_after, args=(
+        barrier, manager, warehouse_id, number, errors
+    )) for number in range(size)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, len(errors)
+
+
+def time_bursts(manager, label, sizes):
+    """Time a burst of each size on a new warehouse and print them."""
+    for size in sizes:
+        warehouse_id = manager.create_warehouse(f"{label} {size}", 1e6)
+        for number in range(size):  # Catalog entries are not timed
+            manager.catalog.intern(f"Item {number}")
+        seconds, errors = burst(manager, warehouse_id, size)
+        print(f"{label:13} burst {size:4}  {size / seconds:8.0f} adds/s"
+              f"  {errors} errors")
+
+
+def main(*sizes):
+    """Time bursts of each size with both managers."""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        direct = WarehouseManager(os.path.join(temp_dir, 'direct.db'))
+        time_bursts(direct, 'direct', sizes or BURSTS)
+        grouped = GroupCommitManager(os.path.join(temp_dir, 'grouped.db'))
+        time_bursts(grouped, 'group commit', sizes or BURSTS)
+        print(f"group commit: {grouped.writer.commits} commits")
+        grouped.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
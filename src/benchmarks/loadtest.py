@@ -0,0 +1,318 @@
+"""Load test the Flask application with a mixed read/write workload.
+
+Starts the application on a local threaded WSGI server with a temporary
+database, seeds a fleet of warehouses and drives the real routes from
+concurrent clients for a fixed duration. Throughput, p50/p95/p99 latency
+and error rates are reported per route for each concurrency level, so
+the saturation point and different storage modes can be compared.
+
+Usage (from src/):
+    python -m benchmarks.loadtest [--duration S] [--concurrency 1,4,16]
+        [--warehouses N] [--write-ratio R] [--storage sqlite|memory|sharded]
+        [--shards N] [--flush-interval S] [--flush-batch-size N]
+        [--group-commit] [--group-commit-batch N] [--group-commit-delay S]
+        [--read-pool-size N] [--replica-staleness S]
+
+The storage options set the app configuration of the same names, see
+DEFAULT_CONFIG in app.py; group commit and the read pool options apply to
+sqlite storage, the flush options to memory storage.
+
+Warehouses created during a run are not deleted again; deletes only pick
+warehouses from the seeded fleet, so the fleet stays roughly constant
+when creates and deletes are equally likely.
+"""
+import argparse
+import http.client
+import itertools
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlencode
+from werkzeug.serving import make_server
+from app import DEFAULT_CONFIG, create_app, get_manager
+
+# Read routes and their relative weights within the read share
+READS = {'index': 1, 'view_warehouse': 9}
+# Write routes and their relative weights within the write share
+WRITES = {'create_warehouse': 1, 'add_product': 6, 'remove_product': 2,
+          'delete_warehouse': 1}
+PRODUCTS = ('Apple', 'Banana', 'Orange', 'Grape', 'Mango')
+# Capacity of seeded warehouses, large enough to never fill up
+SEED_CAPACITY = 1_000_000
+PERCENTILES = (50, 95, 99)
+
+
+class Fleet:
+    """Warehouse ids the clients operate on, shared between threads."""
+
+    def __init__(self, ids):
+        """Initialize with the ids of the seeded warehouses."""
+        self._ids = list(ids)
+        self._lock = threading.Lock()
+        self._names = itertools.count(1)
+
+    def pick(self, rng):
+        """Pick a random warehouse id, or None if none are left."""
+        with self._lock:
+            return rng.choice(self._ids) if self._ids else None
+
+    def take(self, rng):
+        """Remove and return a random warehouse id to delete."""
+        with self._lock:
+            if not self._ids:
+                return None
+            return self._ids.pop(rng.randrange(len(self._ids)))
+
+    def new_name(self):
+        """Return a unique name for a warehouse to create."""
+        with self._lock:
+            return f"Load {next(self._names)}"
+
+
+def _request(route, fleet, rng):
+    """Build (method, path, form) for a route, or None if not possible."""
+    if route == 'index':
+        return 'GET', '/', None
+    if route == 'create_warehouse':
+        return 'POST', '/create', {'name': fleet.new_name(),
+                                   'capacity': SEED_CAPACITY}
+    warehouse_id = (fleet.take(rng) if route == 'delete_warehouse'
+                    else fleet.pick(rng))
+    if warehouse_id is None:
+        return None
+    return _warehouse_request(route, f'/warehouse/{warehouse_id}', rng)
+
+
+def _warehouse_request(route, base, rng):
+    """Build (method, path, form) for a route of a single warehouse."""
+    if route == 'add_product':
+        return 'POST', f'{base}/add_product', {
+            'product_name': rng.choice(PRODUCTS),
+            'quantity': rng.choice((0.5, 1, 2.25))
+        }
+    if route == 'remove_product':
+        return 'POST', f'{base}/remove_product/{rng.choice(PRODUCTS)}', {}
+    if route == 'delete_warehouse':
+        return 'POST', f'{base}/delete', {}
+    return 'GET', base, None
+
+
+class Client(threading.Thread):  # pylint: disable=too-many-instance-attributes
+    """Load generating client sending requests over one connection."""
+
+    def __init__(self, address, fleet, routes, deadline, seed):
+        """Initialize the client with the (route, weight) workload."""
+        super().__init__(daemon=True)
+        self.address = address
+        self.fleet = fleet
+        self.routes, self.weights = zip(*routes.items())
+        self.deadline = deadline
+        self.rng = random.Random(seed)
+        # route -> list of latencies in seconds, and route -> error count
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._conn = None
+
+    def run(self):
+        """Send requests until the deadline."""
+        while time.monotonic() < self.deadline:
+            route = self.rng.choices(self.routes, self.weights)[0]
+            request = _request(route, self.fleet, self.rng)
+            if request is not None:
+                self._timed(route, *request)
+        if self._conn is not None:
+            self._conn.close()
+
+    def _timed(self, route, method, path, form):
+        """Send one request and record its latency or error."""
+        started = time.perf_counter()
+        try:
+            status = self._send(method, path, form)
+        except (OSError, http.client.HTTPException):
+            status = None
+            self._conn = None  # Reconnect on the next request
+        self.latencies[route].append(time.perf_counter() - started)
+        if status is None or status >= 400:
+            self.errors[route] += 1
+
+    def _send(self, method, path, form):
+        """Send a request and read the response, returning its status."""
+        if self._conn is None:
+            self._conn = http.client.HTTPConnection(*self.address)
+        body = urlencode(form) if form is not None else None
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        self._conn.request(method, path, body, headers)
+        response = self._conn.getresponse()
+        response.read()
+        return response.status
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of sorted values."""
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[rank - 1]
+
+
+def _merge(clients):
+    """Merge the per-client results into route -> (latencies, errors)."""
+    merged = defaultdict(lambda: ([], 0))
+    for client in clients:
+        for route, latencies in client.latencies.items():
+            previous, errors = merged[route]
+            merged[route] = (previous + latencies,
+                             errors + client.errors[route])
+    return merged
+
+
+def report(concurrency, duration, results):
+    """Print throughput, latency percentiles and errors per route."""
+    total = sum(len(latencies) for latencies, _ in results.values())
+    errors = sum(errors for _, errors in results.values())
+    print(f"\nconcurrency {concurrency}: {total / duration:.1f} req/s, "
+          f"{errors / max(total, 1):.2%} errors")
+    print(f"{'route':<18}{'count':>8}{'req/s':>9}"
+          + ''.join(f"{f'p{p} ms':>9}" for p in PERCENTILES)
+          + f"{'errors':>9}")
+    for route, (latencies, route_errors) in sorted(results.items()):
+        latencies.sort()
+        print(f"{route:<18}{len(latencies):>8}"
+              f"{len(latencies) / duration:>9.1f}"
+              + ''.join(f"{percentile(latencies, p) * 1000:>9.2f}"
+                        for p in PERCENTILES)
+              + f"{route_errors / len(latencies):>9.2%}")
+
+
+def seed_fleet(flask_app, warehouses):
+    """Create the warehouse fleet directly through the manager."""
+    with flask_app.app_context():
+        manager = get_manager()
+        ids = [manager.create_warehouse(f"Seed {number}", SEED_CAPACITY)
+               for number in range(warehouses)]
+        for warehouse_id in ids:
+            manager.add_product(warehouse_id, PRODUCTS[0], 1)
+    return ids
+
+
+def run_level(address, fleet, options, concurrency):
+    """Run the workload with the given number of clients and report it."""
+    routes = {route: weight * (1 - options.write_ratio)
+              for route, weight in READS.items()}
+    routes.update({route: weight * options.write_ratio
+                   for route, weight in WRITES.items()})
+    deadline = time.monotonic() + options.duration
+    clients = [Client(address, fleet, routes, deadline, number)
+               for number in range(concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    report(concurrency, options.duration, _merge(clients))
+
+
+def parse_args(argv=None):
+    """Parse command line options."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n', maxsplit=1)[0]
+    )
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds per concurrency level')
+    parser.add_argument('--concurrency', default='1,4,16',
+                        type=lambda value: [int(n) for n in value.split(',')],
+                        help='comma separated numbers of clients')
+    parser.add_argument('--warehouses', type=int, default=100,
+                        help='number of seeded warehouses')
+    parser.add_argument('--write-ratio', type=float, default=0.2,
+                        help='share of requests that write, 0 to 1')
+    _add_storage_arguments(parser)
+    _add_sqlite_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def _add_storage_arguments(parser):
+    """Add the options of the storage mode and of memory storage."""
+    parser.add_argument('--storage', choices=('sqlite', 'memory', 'sharded'),
+                        default='sqlite')
+    parser.add_argument('--shards', type=int,
+                        default=DEFAULT_CONFIG['SHARDS'],
+                        help='number of shard databases of sharded storage')
+    parser.add_argument('--flush-interval', type=float,
+                        default=DEFAULT_CONFIG['FLUSH_INTERVAL'],
+                        help='seconds between flushes of memory storage')
+    parser.add_argument('--flush-batch-size', type=int,
+                        default=DEFAULT_CONFIG['FLUSH_BATCH_SIZE'],
+                        help='warehouses per flush transaction')
+
+
+def _add_sqlite_arguments(parser):
+    """Add the group commit and read pool options of sqlite storage."""
+    parser.add_argument('--group-commit', action='store_true',
+                        help='commit product additions in groups')
+    parser.add_argument('--group-commit-batch', type=int,
+                        default=DEFAULT_CONFIG['GROUP_COMMIT_BATCH'],
+                        help='most additions per group commit')
+    parser.add_argument('--group-commit-delay', type=float,
+                        default=DEFAULT_CONFIG['GROUP_COMMIT_DELAY'],
+                        help='seconds a group commit waits for more')
+    parser.add_argument('--read-pool-size', type=int,
+                        default=DEFAULT_CONFIG['READ_POOL_SIZE'],
+                        help='idle read-only connections kept')
+    parser.add_argument('--replica-staleness', type=float,
+                        default=DEFAULT_CONFIG['READ_REPLICA_STALENESS'],
+                        help='read a replica refreshed every S seconds')
+
+
+def app_config(options, db_path):
+    """Build the app configuration of the storage options."""
+    return {
+        'DATABASE': db_path,
+        'STORAGE': options.storage,
+        'SHARDS': options.shards,
+        'FLUSH_INTERVAL': options.flush_interval,
+        'FLUSH_BATCH_SIZE': options.flush_batch_size,
+        'GROUP_COMMIT': options.group_commit,
+        'GROUP_COMMIT_BATCH': options.group_commit_batch,
+        'GROUP_COMMIT_DELAY': options.group_commit_delay,
+        'READ_POOL_SIZE': options.read_pool_size,
+        'READ_REPLICA_STALENESS': options.replica_staleness,
+    }
+
+
+def start_server(flask_app):
+    """Serve an app from a background thread on a free local port."""
+    # Per-request access logging would dominate the measurement
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(flask_app, options):
+    """Seed the fleet, serve the app and run each concurrency level."""
+    fleet = Fleet(seed_fleet(flask_app, options.warehouses))
+    server = start_server(flask_app)
+    try:
+        for concurrency in options.concurrency:
+            run_level(('127.0.0.1', server.server_port), fleet,
+                      options, concurrency)
+    finally:
+        server.shutdown()
+        with flask_app.app_context():
+            # Stop the write-behind flusher or the shard query threads
+            getattr(get_manager(), 'close', lambda: None)()
+
+
+def main(argv=None):
+    """Run the load test against an app with a temporary database."""
+    options = parse_args(argv)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        run(create_app(app_config(options,
+                                  os.path.join(temp_dir, 'load.db'))),
+            options)
+
+
+if __name__ == '__main__':
+    main()
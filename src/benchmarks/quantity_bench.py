@@ -0,0 +1,69 @@
+"""Benchmark fixed-point (integer milli-unit) quantities against floats.
+
+Runs the add/remove cycle of the warehouse hot path (capacity check and
+balance update) with float and with integer quantities and reports the
+time per cycle and the drift left after all cycles.
+
+Usage (from src/): python -m benchmarks.quantity_bench [cycles]
+"""
+import sys
+import timeit
+from quantity import to_units
+from varasto import Varasto
+
+# Quantities added and then removed again in each cycle
+ADD, REMOVE, CAPACITY = 50.7, 3.14, 1000.0
+
+
+def float_cycles(cycles):
+    """Run add/remove cycles with float quantities, return final balance."""
+    balance = 0.0
+    for _ in range(cycles):
+        if ADD <= CAPACITY - balance:
+            balance = balance + ADD
+        if REMOVE <= CAPACITY - balance:
+            balance = balance + REMOVE
+        balance = balance - ADD
+        balance = balance - REMOVE
+    return balance
+
+
+def unit_cycles(cycles):
+    """Run add/remove cycles with integer milli-units."""
+    add, remove, capacity = to_units(ADD), to_units(REMOVE), to_units(CAPACITY)
+    balance = 0
+    for _ in range(cycles):
+        if add <= capacity - balance:
+            balance = balance + add
+        if remove <= capacity - balance:
+            balance = balance + remove
+        balance = balance - add
+        balance = balance - remove
+    return balance
+
+
+def varasto_cycles(cycles):
+    """Run add/remove cycles through the Varasto unit API."""
+    varasto = Varasto(CAPACITY)
+    add, remove = to_units(ADD), to_units(REMOVE)
+    for _ in range(cycles):
+        varasto.lisaa_yksikoita(add)
+        varasto.lisaa_yksikoita(remove)
+        varasto.ota_yksikoita(add)
+        varasto.ota_yksikoita(remove)
+    return varasto.saldo_yks
+
+
+def main(cycles=1_000_000):
+    """Time each variant and print time per cycle and drift."""
+    for name, func in (('float', float_cycles),
+                       ('milli-units', unit_cycles),
+                       ('Varasto units', varasto_cycles)):
+        seconds = min(timeit.repeat(lambda f=func: f(cycles),
+                                    number=1, repeat=3))
+        print(f"{name:<14} {seconds / cycles * 1e9:8.1f} ns/cycle  "
+              f"drift {func(cycles)!r}")
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
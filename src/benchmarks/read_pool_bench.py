@@ -0,0 +1,109 @@
+"""Benchmark writes and reports running at the same time.
+
+Reader threads build the full warehouse list (like the index page)
+while one thread adds products, for a few seconds each with:
+- direct: a new read-write connection per query in rollback journal
+  mode, as before the read pool
+- pool: pooled read-only connections to the database in WAL mode
+- replica: pooled read-only connections to a replica copied every second
+Reports writes and reads per second and the writes that failed on a
+locked database.
+
+Usage (from src/):
+    python -m benchmarks.read_pool_bench [readers] [warehouses] [seconds]
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from warehouse_manager import WarehouseManager
+
+# Seconds a replica may lag behind in the replica case
+REPLICA_STALENESS = 1.0
+
+
+class DirectReadManager(WarehouseManager):
+    """WarehouseManager reading through read-write connections, no WAL."""
+
+    def _init_db(self, conn):
+        """Initialize the schema in rollback journal mode."""
+        super()._init_db(conn)
+        conn.execute("PRAGMA journal_mode = DELETE")
+
+    @contextmanager
+    def _read_connection(self):
+        """Open a read-write connection for one read."""
+        conn = self._get_connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+
+def read_until(manager, deadline, counts):
+    """Read all warehouses until the deadline, counting the reads."""
+    while time.monotonic() < deadline:
+        manager.get_all_warehouses()
+        counts['reads'] += 1
+
+
+def write_until(manager, warehouse_id, deadline, counts):
+    """Add products until the deadline, counting writes and failures."""
+    while time.monotonic() < deadline:
+        try:
+            manager.add_product(warehouse_id, "Apple", 0.001)
+            counts['writes'] += 1
+        except sqlite3.OperationalError:
+            counts['locked'] += 1  # "database is locked"
+
+
+def run_case(manager, readers, warehouses, seconds):
+    """Run readers and a writer on manager, returning the counts."""
+    ids = [manager.create_warehouse(f"Varasto {number}", 1e6)
+           for number in range(warehouses)]
+    for warehouse_id in ids:
+        manager.add_product(warehouse_id, "Pear", 1.0)
+    counts = {'reads': 0, 'writes': 0, 'locked': 0}
+    deadline = time.monotonic() + seconds
+    threads = [threading.Thread(target=read_until,
+                                args=(manager, deadline, counts))
+               for _ in range(readers)]
+    threads.append(threading.Thread(target=write_until,
+                                    args=(manager, ids[0], deadline, counts)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def time_case(label, path, readers, warehouses, seconds):
+    """Run one case on a new database at path and print its rates."""
+    manager = (DirectReadManager if label == 'direct'
+               else WarehouseManager)(path)
+    if label == 'replica':
+        manager.reads.max_staleness = REPLICA_STALENESS
+    counts = run_case(manager, readers, warehouses, seconds)
+    manager.reads.close()
+    print(f"{label:8} {counts['writes'] / seconds:8.0f} writes/s"
+          f"  {counts['reads'] / seconds:6.1f} reads/s"
+          f"  {counts['locked']} locked")
+
+
+def main(readers=4, warehouses=200, seconds=3):
+    """Run the direct, pool and replica cases and print their rates."""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for label in ('direct', 'pool', 'replica'):
+            time_case(label, os.path.join(temp_dir, f'{label}.db'),
+                      readers, warehouses, seconds)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,86 @@
+"""Benchmark warehouse search with facets.
+
+Builds a database of warehouses (5 of 200 products each, three types,
+random fill) with direct SQL and times searches with broad and narrow
+words and filters, including the facet counts.
+
+Usage (from src/): python -m benchmarks.search_bench [warehouses]
+"""
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from migrations import apply_schema, read_schema
+from search import search_warehouses
+
+PRODUCTS = ['Mango', 'Apple', 'Banana'] + [f"Item {n}" for n in range(197)]
+SITES = ('North', 'South', 'East', 'West', 'Central')
+TYPES = ('fruit', 'dry', 'cold')
+# (query, filters) timed, from no conditions to no matches
+SEARCHES = [
+    ('', {}),
+    ('', {'type': 'cold'}),
+    ('north', {}),
+    ('mango', {}),
+    ('', {'product': 'Mango'}),
+    ('ma', {}),
+    ('north mango', {'fill': 'full'}),
+    ('depot 12345', {}),
+    ('nothing', {}),
+]
+
+
+def build(db_path, warehouses):
+    """Create a database with the given number of warehouses."""
+    rnd = random.Random(1)
+    conn = sqlite3.connect(db_path)
+    apply_schema(conn, read_schema())
+    conn.executemany("INSERT INTO catalog (id, name) VALUES (?, ?)",
+                     enumerate(PRODUCTS, 1))
+    conn.executemany(
+        "INSERT INTO warehouses (id, name, capacity, balance, type)"
+        " VALUES (?, ?, ?, ?, ?)",
+        ((number, f"{rnd.choice(SITES)} depot {number}", 100_000,
+          rnd.randrange(100_001), rnd.choice(TYPES))
+         for number in range(1, warehouses + 1))
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO products (warehouse_id, product_id, quantity)"
+        " VALUES (?, ?, ?)",
+        ((number, rnd.randrange(1, len(PRODUCTS) + 1), 1000)
+         for number in range(1, warehouses + 1) for _ in range(5))
+    )
+    conn.commit()
+    conn.close()
+
+
+def time_search(conn, query, filters):
+    """Time a search, best of three, and print it."""
+    times = []
+    for _ in range(3):
+        started = time.perf_counter()
+        found = search_warehouses(conn, query, filters)
+        times.append(time.perf_counter() - started)
+    print(f"{query!r:15} {str(filters):22} {min(times) * 1000:8.1f} ms"
+          f"  {found['total']:7} matches")
+
+
+def main(warehouses=100_000):
+    """Build the database and time each search."""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(temp_dir, 'search.db')
+        build(db_path, warehouses)
+        conn = sqlite3.connect(db_path)
+        for query, filters in SEARCHES:
+            time_search(conn, query, filters)
+        conn.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
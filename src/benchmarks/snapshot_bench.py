@@ -0,0 +1,123 @@
+"""Benchmark binary snapshot export, import and scans.
+
+Builds a database of product rows (1000 products in each warehouse) with
+direct SQL, then times snapshot export and import, raw and with zlib,
+and a sum over the quantity column of a memory-mapped raw snapshot. The
+SQLite backup API and an SQL sum are timed for comparison. Reports
+rows/s and MB/s of the snapshot file (of the database file for backup
+and SQL).
+
+Usage (from src/): python -m benchmarks.snapshot_bench [rows]
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from migrations import apply_schema, read_schema
+from snapshot import SnapshotReader, export_snapshot, import_snapshot
+
+PRODUCTS_PER_WAREHOUSE = 1000
+
+
+def build(db_path, rows):
+    """Create a database with the given number of product rows."""
+    warehouses = max(1, rows // PRODUCTS_PER_WAREHOUSE)
+    conn = sqlite3.connect(db_path)
+    apply_schema(conn, read_schema())
+    conn.executemany("INSERT INTO catalog (id, name) VALUES (?, ?)",
+                     ((number, f"Product {number}")
+                      for number in range(PRODUCTS_PER_WAREHOUSE)))
+    conn.executemany(
+        "INSERT INTO warehouses (id, name, capacity, balance)"
+        " VALUES (?, ?, ?, ?)",
+        ((number, f"Warehouse {number}", 10 ** 12, 0)
+         for number in range(1, warehouses + 1))
+    )
+    conn.executemany(
+        "INSERT INTO products (warehouse_id, product_id, quantity)"
+        " VALUES (?, ?, ?)",
+        ((1 + row // PRODUCTS_PER_WAREHOUSE,
+          row % PRODUCTS_PER_WAREHOUSE, row % 9973)
+         for row in range(rows))
+    )
+    conn.commit()
+    conn.close()
+
+
+def export(db_path, snapshot_path, compress):
+    """Export a snapshot of the database."""
+    conn = sqlite3.connect(db_path)
+    try:
+        export_snapshot(conn, snapshot_path, compress)
+    finally:
+        conn.close()
+
+
+def scan(snapshot_path):
+    """Sum the product quantities of a snapshot."""
+    total = 0
+    with SnapshotReader(snapshot_path) as reader:
+        for table, columns in reader.chunks():
+            if table == 'products':
+                total += sum(columns['quantity'])
+            del columns
+    return total
+
+
+def sql_scan(db_path):
+    """Sum the product quantities with SQL."""
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT SUM(quantity) FROM products").fetchone()
+    finally:
+        conn.close()
+
+
+def backup(db_path, copy_path):
+    """Copy the database with the SQLite backup API."""
+    source, target = sqlite3.connect(db_path), sqlite3.connect(copy_path)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+
+def timed(name, rows, size_path, func, *args):
+    """Run func once and print its throughput."""
+    started = time.perf_counter()
+    func(*args)
+    seconds = time.perf_counter() - started
+    size = os.path.getsize(size_path) / 1e6
+    print(f"{name:<16} {seconds:7.2f} s  {rows / seconds / 1e6:6.2f} M rows/s"
+          f"  {size / seconds:8.1f} MB/s  ({size:.1f} MB)")
+
+
+def main(rows=1_000_000):
+    """Build the database and time each operation."""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = {name: os.path.join(temp_dir, name)
+                for name in ('db', 'raw', 'zlib', 'from_raw', 'from_zlib',
+                             'backup')}
+        build(path['db'], rows)
+        # (name, file the MB/s refer to, function, arguments)
+        for name, size_file, func, args in (
+                ('export raw', 'raw', export, ('db', 'raw', False)),
+                ('export zlib', 'zlib', export, ('db', 'zlib', True)),
+                ('import raw', 'raw', import_snapshot, ('raw', 'from_raw')),
+                ('import zlib', 'zlib', import_snapshot,
+                 ('zlib', 'from_zlib')),
+                ('backup API', 'db', backup, ('db', 'backup')),
+                ('scan mmap', 'raw', scan, ('raw',)),
+                ('scan SQL', 'db', sql_scan, ('db',))):
+            timed(name, rows, path[size_file], func,
+                  *(path.get(arg, arg) for arg in args))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,116 @@
+"""Product catalog mapping product names to integer ids."""
+import difflib
+import sys
+import threading
+from quantity import from_units, to_units
+
+# Upper bound appended to a prefix to form an index range scan
+_PREFIX_END = '\U0010ffff'
+# Candidates read from the trigram index before fuzzy ranking
+_FUZZY_CANDIDATES = 200
+
+
+class ProductCatalog:
+    """Catalog of product names stored once with integer ids.
+
+    Product rows refer to the catalog by id, so each name is stored only
+    once ("interned"). Name to id lookups are cached in memory; catalog
+    entries are never deleted, so cached ids stay valid.
+    """
+
+    def __init__(self, get_connection):
+        """Initialize with a callable returning database connections."""
+        self._get_connection = get_connection
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def _fetch(self, query, params=()):
+        """Run a query on a new connection and return all rows."""
+        conn = self._get_connection()
+        try:
+            return conn.execute(query, params).fetchall()
+        finally:
+            conn.close()
+
+    def intern(self, name):
+        """Return the id of a product name, adding it to the catalog."""
+        product_id = self._ids.get(name)
+        if product_id is None:
+            product_id = self._insert(name)
+            with self._lock:
+                self._ids[sys.intern(name)] = product_id
+        return product_id
+
+    def _insert(self, name):
+        """Insert a name into the catalog if missing and return its id."""
+        conn = self._get_connection()
+        try:
+            conn.execute("INSERT OR IGNORE INTO catalog (name) VALUES (?)",
+                         (name,))
+            conn.commit()
+            row = conn.execute("SELECT id FROM catalog WHERE name = ?",
+                               (name,)).fetchone()
+            return row['id']
+        finally:
+            conn.close()
+
+    def add_defaults(self, conn, products):
+        """Add products with suggested default quantities to the catalog."""
+        conn.executemany(
+            """INSERT INTO catalog (name, default_quantity) VALUES (?, ?)
+               ON CONFLICT(name) DO NOTHING""",
+            [(name, to_units(qty)) for name, qty in products.items()]
+        )
+
+    def suggested(self):
+        """Get products with a suggested quantity as a name to qty dict."""
+        rows = self._fetch(
+            """SELECT name, default_quantity FROM catalog
+               WHERE default_quantity IS NOT NULL ORDER BY id"""
+        )
+        return {row['name']: from_units(row['default_quantity'])
+                for row in rows}
+
+    def search(self, prefix, limit=20):
+        """Find product names starting with prefix, case-insensitively.
+
+        The lookup is a range scan over the case-insensitive name index.
+        """
+        rows = self._fetch(
+            """SELECT name FROM catalog
+               WHERE name >= ? COLLATE NOCASE
+                 AND name < ? COLLATE NOCASE
+               ORDER BY name COLLATE NOCASE LIMIT ?""",
+            (prefix, prefix + _PREFIX_END, limit)
+        )
+        return [row['name'] for row in rows]
+
+    def fuzzy_search(self, term, limit=20):
+        """Find product names similar to term, tolerating typos.
+
+        Candidates sharing trigrams with the term are read from the FTS5
+        trigram index and ranked by similarity.
+        """
+        trigrams = {term[i:i + 3].lower() for i in range(len(term) - 2)}
+        if not trigrams:
+            return self.search(term, limit)
+        query = ' OR '.join(
+            '"' + trigram.replace('"', '""') + '"' for trigram in trigrams
+        )
+        rows = self._fetch(
+            """SELECT name FROM catalog_fts WHERE catalog_fts MATCH ?
+               ORDER BY rank LIMIT ?""",
+            (query, _FUZZY_CANDIDATES)
+        )
+        names = [row['name'] for row in rows]
+        return rank_by_similarity(term, names)[:limit]
+
+
+def rank_by_similarity(term, names):
+    """Sort names by descending similarity to term."""
+    term = term.lower()
+
+    def similarity(name):
+        return difflib.SequenceMatcher(None, term, name.lower()).ratio()
+
+    return sorted(names, key=similarity, reverse=True)
@@ -0,0 +1,317 @@
+"""Atomic stock changes between warehouses of different shards.
+
+Transfers and moves within one shard are single SQLite transactions.
+Between shards, CrossShardWrites opens a write transaction (BEGIN
+IMMEDIATE) on every shard involved, in shard order so that two such
+changes never deadlock, and checks the whole change while holding them
+all. Only then is the change journaled in the directory database as
+(warehouse id, product name, milli-units) legs, which decides it, and
+the shards commit their legs one by one, each recording the journal id
+in its applied_changes table in the same transaction. The journal entry
+is removed once every shard has committed.
+
+A failed check, or any error before the first shard commits, rolls back
+every shard and drops the journal entry, so there is nothing to undo.
+If a commit fails or the process stops between the shard commits, the
+entry remains and complete() applies its legs to the shards that have
+not recorded it; the sharded manager calls it when it starts on an
+existing directory database.
+"""
+import json
+import sqlite3
+from collections import Counter
+from contextlib import ExitStack
+from quantity import to_units
+from replica import connect_read_only
+from transfers import TransferError, check_transfer, transfer_message
+from warehouse_manager import CONFLICT, ConflictError, check_version
+
+# Changes decided but possibly not committed on all of their shards
+JOURNAL_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS cross_shard_journal (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        legs TEXT NOT NULL
+    )"""
+
+
+def plan_transfers(transaction, moves):
+    """Check (source id, target id, name, milli-units) moves in order.
+
+    Each move must fit the stock and capacity left by the ones before
+    it, as in WarehouseManager.transfer_many. Returns the legs of the
+    moves; raises TransferError numbered by the failed move.
+    """
+    stock, deltas, legs = Counter(), Counter(), []
+    for number, (source_id, target_id, name, quantity) in enumerate(moves, 1):
+        try:
+            check_transfer(quantity,
+                           transaction.available(source_id, name)
+                           + stock[source_id, name],
+                           transaction.room(source_id, target_id)
+                           - deltas[target_id])
+        except TransferError as error:
+            raise TransferError(str(error), number) from None
+        for warehouse_id, change in ((source_id, -quantity),
+                                     (target_id, quantity)):
+            stock[warehouse_id, name] += change
+            deltas[warehouse_id] += change
+            legs.append((warehouse_id, name, change))
+    return legs
+
+
+def plan_move(transaction, source_id, target_id, product_names,
+              expected_version):
+    """Check a move of all unreserved stock, see plan_transfers.
+
+    Raises ConflictError if the source is not at expected_version (if
+    given) and TransferError if the move cannot be made.
+    """
+    room = transaction.room(source_id, target_id)
+    check_version(transaction.warehouse(source_id)['version'],
+                  expected_version)
+    moves = {name: transaction.available(source_id, name)
+             for name in dict.fromkeys(product_names)}
+    moves = {name: quantity for name, quantity in moves.items()
+             if quantity > 0}
+    if not moves:
+        raise TransferError("Nothing to move")
+    if sum(moves.values()) > room:
+        raise TransferError("Not enough space in target warehouse")
+    return [leg for name, quantity in moves.items()
+            for leg in ((source_id, name, -quantity),
+                        (target_id, name, quantity))]
+
+
+class ShardTransaction:
+    """Write transactions held on the shards of one cross-shard change.
+
+    The shards are locked in the given order and rolled back on exit
+    unless committed.
+    """
+
+    def __init__(self, shards, shard_for):
+        """Initialize with the shards to lock and the id to shard map."""
+        self.shards = shards
+        self._shard_for = shard_for
+        self._conns = {}
+        self._rows = {}
+
+    def __enter__(self):
+        """Take the write locks of the shards."""
+        try:
+            for shard in self.shards:
+                self._conns[shard] = shard.begin_write()
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        """Roll back what was not committed and close the connections."""
+        self.close()
+
+    def close(self):
+        """Roll back and close the connections."""
+        for conn in self._conns.values():
+            conn.rollback()
+            conn.close()
+
+    def warehouse(self, warehouse_id):
+        """Read a warehouse row once per transaction, None if missing."""
+        if warehouse_id not in self._rows:
+            shard = self._shard_for(warehouse_id)
+            self._rows[warehouse_id] = shard.warehouse_row(
+                self._conns[shard], warehouse_id
+            )
+        return self._rows[warehouse_id]
+
+    def room(self, source_id, target_id):
+        """Get the free capacity of the target of a move in milli-units.
+
+        Raises TransferError for a move to the same or a missing
+        warehouse.
+        """
+        if source_id == target_id:
+            raise TransferError("Cannot transfer to the same warehouse")
+        source, target = (self.warehouse(warehouse_id)
+                          for warehouse_id in (source_id, target_id))
+        if source is None or target is None:
+            raise TransferError("Warehouse not found")
+        return target['capacity'] - target['balance']
+
+    def available(self, warehouse_id, product_name):
+        """Get the unreserved stock of a product in milli-units."""
+        shard = self._shard_for(warehouse_id)
+        return shard.available_units(self._conns[shard], warehouse_id,
+                                     product_name)
+
+    def apply(self, journal_id, legs, oldest_id):
+        """Apply the legs of a journaled change to their shards."""
+        for shard, shard_legs in legs_by_shard(legs,
+                                               self._shard_for).items():
+            shard.apply_legs(self._conns[shard], journal_id, shard_legs,
+                             oldest_id)
+
+    def commit(self):
+        """Commit the shards one by one."""
+        for conn in self._conns.values():
+            conn.commit()
+
+
+def legs_by_shard(legs, shard_for):
+    """Group legs by the shards of their warehouses, keeping their order."""
+    grouped = {}
+    for leg in legs:
+        grouped.setdefault(shard_for(leg[0]), []).append(tuple(leg))
+    return grouped
+
+
+class CrossShardWrites:
+    """Makes transfers and moves spanning shards atomic.
+
+    See the module docstring.
+    """
+
+    def __init__(self, shards, shard_for, db_path, get_directory):
+        """Initialize with the shards in lock order, the id to shard map,
+        the directory database path and a factory of its connections.
+        """
+        self._shards = shards
+        self._shard_for = shard_for
+        self._db_path = db_path
+        self._get_directory = get_directory
+
+    def transfer_many(self, transfers):
+        """Make transfers, see WarehouseManager.transfer_many."""
+        moves = [(source_id, target_id, name, to_units(quantity))
+                 for source_id, target_id, name, quantity in transfers]
+        try:
+            self._write([warehouse_id for move in moves
+                         for warehouse_id in move[:2]],
+                        lambda transaction: plan_transfers(transaction,
+                                                           moves))
+        except TransferError as error:
+            return False, transfer_message(transfers, error)
+        return True, "Success"
+
+    def move_products(self, source_id, target_id, product_names,
+                      expected_version=None):
+        """Move the stock of products, see WarehouseManager.move_products."""
+        try:
+            self._write((source_id, target_id), lambda transaction: plan_move(
+                transaction, source_id, target_id, product_names,
+                expected_version
+            ))
+        except ConflictError:
+            return False, CONFLICT
+        except TransferError as error:
+            return False, str(error)
+        return True, "Success"
+
+    def _write(self, warehouse_ids, plan):
+        """Make the change plan(transaction) returns the legs of."""
+        involved = {self._shard_for(warehouse_id)
+                    for warehouse_id in warehouse_ids}
+        shards = [shard for shard in self._shards if shard in involved]
+        with ExitStack() as stack:
+            transaction = stack.enter_context(
+                ShardTransaction(shards, self._shard_for)
+            )
+            for shard in shards:
+                stack.enter_context(shard.alerts.collect())
+            journal_id = self._apply(transaction, plan(transaction))
+            # A failure from here on is completed by complete()
+            transaction.commit()
+        self._forget(journal_id)
+
+    def _apply(self, transaction, legs):
+        """Journal the legs of a change and apply them, uncommitted.
+
+        Returns the journal id; the entry is dropped if applying fails.
+        """
+        journal_id, oldest_id = self._journal(legs)
+        try:
+            transaction.apply(journal_id, legs, oldest_id)
+        except BaseException:
+            self._forget(journal_id)
+            raise
+        return journal_id
+
+    def _journal(self, legs):
+        """Journal the legs of a change, deciding it.
+
+        Returns its journal id and the oldest journal id still pending.
+        """
+        conn = self._get_directory()
+        try:
+            with conn:
+                journal_id = conn.execute(
+                    "INSERT INTO cross_shard_journal (legs) VALUES (?)",
+                    (json.dumps(legs),)
+                ).lastrowid
+                oldest_id = conn.execute(
+                    "SELECT MIN(id) FROM cross_shard_journal"
+                ).fetchone()[0]
+        finally:
+            conn.close()
+        return journal_id, oldest_id
+
+    def _forget(self, journal_id):
+        """Remove a change from the journal."""
+        conn = self._get_directory()
+        try:
+            with conn:
+                conn.execute("DELETE FROM cross_shard_journal WHERE id = ?",
+                             (journal_id,))
+        finally:
+            conn.close()
+
+    def _query_journal(self, query, params=()):
+        """Read rows of the journal, none if it does not exist yet.
+
+        The directory database is opened read-only, so it is not created.
+        """
+        try:
+            conn = connect_read_only(self._db_path)
+        except sqlite3.OperationalError:
+            return []  # No directory yet
+        try:
+            return conn.execute(query, params).fetchall()
+        except sqlite3.OperationalError:
+            return []  # Directory without a journal
+        finally:
+            conn.close()
+
+    def pending(self):
+        """Get the (journal id, legs) of the changes in the journal."""
+        return [(row['id'], json.loads(row['legs'])) for row in
+                self._query_journal("SELECT id, legs FROM cross_shard_journal"
+                                    " ORDER BY id")]
+
+    def complete(self):
+        """Commit the journaled changes on the shards that have not."""
+        for journal_id, legs in self.pending():
+            for shard, shard_legs in legs_by_shard(legs,
+                                                   self._shard_for).items():
+                self._complete_shard(shard, journal_id, shard_legs)
+            self._forget(journal_id)
+
+    def _complete_shard(self, shard, journal_id, legs):
+        """Apply the legs of a journaled change on a shard if it has not.
+
+        The journal is checked again once the shard is locked, as the
+        change may have been abandoned before any shard committed.
+        """
+        conn = shard.begin_write()
+        try:
+            apply = self._query_journal(
+                "SELECT 1 FROM cross_shard_journal WHERE id = ?",
+                (journal_id,)
+            ) and not shard.applied(conn, journal_id)
+            with shard.alerts.collect():
+                if apply:
+                    shard.apply_legs(conn, journal_id, legs, journal_id)
+                conn.commit()
+        finally:
+            conn.rollback()
+            conn.close()
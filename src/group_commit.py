@@ -0,0 +1,174 @@
+"""Group commit of queued writes by a single writer thread.
+
+Every direct write opens a connection and commits on its own, and
+SQLite serializes the commits, so a burst of writes is capped by the
+number of commits (and fsyncs) per second. GroupCommitWriter queues
+writes instead: its thread takes the writes waiting in the queue, up to
+max_batch of them and waiting at most max_delay seconds for more, and
+applies them in one transaction with one commit. Each write runs in its
+own savepoint, so a failing write is rolled back alone and its caller
+gets the error while the others are committed. Callers wait until the
+commit of their write, so a returned result is durable.
+"""
+import queue
+import sqlite3
+import time
+from concurrent.futures import Future
+from warehouse_manager import WarehouseManager
+from quantity import to_units
+from queue_worker import QueueWorker
+
+# Maximum number of writes committed in one transaction
+MAX_BATCH = 200
+# Seconds the writer waits for more writes before committing a batch
+MAX_DELAY = 0.002
+# Maximum number of queued writes, submit() blocks when reached
+QUEUE_SIZE = 10000
+
+
+class GroupCommitWriter(QueueWorker):
+    """Applies queued writes in batches from a background thread.
+
+    A write is a function taking a connection and its arguments, called
+    in the writer's transaction. The thread starts on the first submit().
+    """
+
+    def __init__(self, get_connection, alerts, max_batch=MAX_BATCH,
+                 max_delay=MAX_DELAY):
+        """Initialize with a connection factory and the AlertEngine."""
+        super().__init__('group-commit-writer', QUEUE_SIZE)
+        self._get_connection = get_connection
+        self._alerts = alerts
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        # Number of transactions committed, for monitoring batch sizes
+        self.commits = 0
+
+    def submit(self, function, *args):
+        """Queue function(conn, *args) and return a Future of its result.
+
+        The future completes once the write has been committed, or
+        holds the exception raised by the write or the commit.
+        """
+        self.start()
+        future = Future()
+        self.queue.put((future, function, args))
+        return future
+
+    def write(self, function, *args):
+        """Apply function(conn, *args) and return its committed result."""
+        return self.submit(function, *args).result()
+
+    def _run(self):
+        """Commit batches of queued writes until the None stop marker."""
+        batch = self._take_batch()
+        while batch:
+            self._commit(batch)
+            batch = self._take_batch()
+
+    def _take_batch(self):
+        """Wait for writes, returning an empty batch once stopped."""
+        batch = []
+        write = self.queue.get()
+        deadline = time.monotonic() + self.max_delay
+        while write:
+            batch.append(write)
+            write = len(batch) < self.max_batch and self._next_write(deadline)
+        if write is None and batch:
+            self.queue.put(None)  # Stop after committing the batch
+        return batch
+
+    def _next_write(self, deadline):
+        """Get the next write queued before deadline, False if none."""
+        try:
+            return self.queue.get(timeout=max(deadline - time.monotonic(),
+                                               0))
+        except queue.Empty:
+            return False
+
+    def _commit(self, batch):
+        """Apply a batch in one transaction and complete its futures."""
+        conn = self._get_connection()
+        try:
+            outcomes = self._write_batch(conn, batch)
+        except sqlite3.Error as error:
+            conn.rollback()
+            outcomes = [(None, error)] * len(batch)
+        finally:
+            conn.close()
+        for (future, _function, _args), outcome in zip(batch, outcomes):
+            _complete(future, *outcome)
+
+    def _write_batch(self, conn, batch):
+        """Apply and commit a batch, returning its (result, exception)s."""
+        with self._alerts.collect():
+            conn.execute("BEGIN IMMEDIATE")
+            outcomes = [self._apply(conn, function, args)
+                        for _future, function, args in batch]
+            conn.commit()
+        self.commits += 1
+        return outcomes
+
+    def _apply(self, conn, function, args):
+        """Apply a write in a savepoint, returning (result, exception).
+
+        A write raising an exception is rolled back alone, along with
+        the alerts it evaluated.
+        """
+        conn.execute("SAVEPOINT item")
+        try:
+            with self._alerts.savepoint():
+                outcome = function(conn, *args), None
+        # Raised to the caller of the write, not in the writer thread
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            conn.execute("ROLLBACK TO item")
+            outcome = None, error
+        conn.execute("RELEASE item")
+        return outcome
+
+
+def _complete(future, result, error):
+    """Set the result of a future, or its exception if error is set."""
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class GroupCommitManager(WarehouseManager):  # pylint: disable=too-many-public-methods
+    """WarehouseManager committing add_product calls in groups.
+
+    add_product is applied by a GroupCommitWriter, so bursts of
+    additions share commits. Other changes are written directly; they
+    are serialized with the writer's transactions by SQLite. Call
+    close() on shutdown to commit the queued additions.
+    """
+
+    def __init__(self, db_path=None, max_batch=MAX_BATCH,
+                 max_delay=MAX_DELAY):
+        """Initialize the manager and its (not yet started) writer."""
+        super().__init__(db_path)
+        self.writer = GroupCommitWriter(self._get_connection, self.alerts,
+                                        max_batch, max_delay)
+
+    def close(self):
+        """Commit the queued writes, stop the threads and close the reads."""
+        self.writer.stop()
+        self.holds.stop()
+        self.alerts.dispatcher.stop()
+        self.reads.close()
+
+    def add_product(self, warehouse_id, product_name, quantity,
+                    expected_version=None):
+        """Add a product to a warehouse, see WarehouseManager.add_product.
+
+        Waits until the group containing the addition is committed. The
+        writer holds the write lock, so no attempt is retried.
+        """
+        quantity = to_units(quantity)
+        if quantity <= 0:
+            return False
+        # Interned before queueing, the catalog writes on its own connection
+        self.catalog.intern(product_name)
+        return self.writer.write(self._try_add, warehouse_id, product_name,
+                                 quantity, expected_version)
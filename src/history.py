@@ -0,0 +1,295 @@
+"""Time-series capacity history of warehouses with downsampled rollups.
+
+Each change of a warehouse records a raw sample of its balance and
+capacity, merged into one point per second. A compactor rolls closed
+buckets up into minute, hour and day points and expires old points of
+each level according to a retention policy, so long ranges are read from
+a coarse level with few points. Quantities are integer milli-units and
+timestamps are unix seconds of the bucket start.
+"""
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from collections import namedtuple
+from itertools import groupby
+from operator import itemgetter
+from quantity import SCALE
+
+logger = logging.getLogger(__name__)
+
+# Bucket sizes in seconds of the history levels, finest first
+RAW, MINUTE, HOUR, DAY = 1, 60, 3600, 86400
+LEVELS = (RAW, MINUTE, HOUR, DAY)
+# Seconds the points of each level are kept, None to keep them forever
+RETENTION = {RAW: DAY, MINUTE: 7 * DAY, HOUR: 90 * DAY, DAY: None}
+# Default maximum number of points per warehouse returned by a query
+MAX_POINTS = 500
+
+# Merges a new point into an existing point of the same bucket
+_UPSERT = """
+    ON CONFLICT (level, warehouse_id, ts) DO UPDATE SET
+        samples = samples + excluded.samples,
+        balance_sum = balance_sum + excluded.balance_sum,
+        balance_min = MIN(balance_min, excluded.balance_min),
+        balance_max = MAX(balance_max, excluded.balance_max),
+        capacity = excluded.capacity"""
+
+HistoryPoint = namedtuple(
+    'HistoryPoint', ('ts', 'balance', 'minimum', 'maximum', 'capacity')
+)
+HistoryPoint.__doc__ = """A bucket of samples in whole units.
+
+balance is the average of the samples, minimum and maximum their range.
+"""
+
+
+class CapacityHistory:
+    """Stores and queries the balance and capacity history of warehouses.
+
+    Samples are recorded in the caller's transaction. Call compact()
+    periodically, or start_compactor(), to roll points up and expire them.
+    """
+
+    def __init__(self, get_connection, retention=None, clock=time.time):
+        """Initialize with a callable returning database connections."""
+        self._get_connection = get_connection
+        self.retention = dict(RETENTION, **(retention or {}))
+        self.clock = clock
+        self._compactor = None
+
+    def record(self, conn, warehouse_id):
+        """Record the current balance and capacity of a warehouse."""
+        conn.execute(
+            """INSERT INTO capacity_history
+                   (level, warehouse_id, ts, samples, balance_sum,
+                    balance_min, balance_max, capacity)
+               SELECT ?, id, ?, 1, balance, balance, balance, capacity
+               FROM warehouses WHERE id = ?""" + _UPSERT,
+            (RAW, int(self.clock()), warehouse_id)
+        )
+
+    def compact(self):
+        """Roll closed buckets up to coarser levels and expire old points.
+
+        Runs in a single transaction. Points are only expired once they
+        have been rolled up to the next level.
+        """
+        now = int(self.clock())
+        conn = self._get_connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for source, target in zip(LEVELS, LEVELS[1:]):
+                _roll_up(conn, source, target, now)
+            self._expire(conn, now)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _expire(self, conn, now):
+        """Delete points older than the retention of their level."""
+        marks = _watermarks(conn)
+        for index, level in enumerate(LEVELS):
+            if self.retention[level] is None:
+                continue
+            coarser = LEVELS[index + 1:index + 2]
+            rolled_up = marks.get(coarser[0], 0) if coarser else sys.maxsize
+            conn.execute(
+                """DELETE FROM capacity_history
+                   WHERE level = ? AND ts < ? AND ts < ?""",
+                (level, now - self.retention[level], rolled_up)
+            )
+
+    def choose_level(self, start, end, max_points=MAX_POINTS):
+        """Get the finest level retained since start with few enough points."""
+        now = self.clock()
+        for level in LEVELS:
+            retention = self.retention[level]
+            retained = retention is None or start >= now - retention
+            if retained and (end - start) / level <= max_points:
+                return level
+        return LEVELS[-1]
+
+    def query(self, start, end, warehouse_ids=None, max_points=MAX_POINTS):
+        """Get the history between start and end (unix seconds).
+
+        Only the level chosen by choose_level() is read, plus the finer
+        points not yet rolled up to it. Returns a dict of warehouse id ->
+        list of HistoryPoint in time order.
+        """
+        level = self.choose_level(start, end, max_points)
+        conn = self._get_connection()
+        try:
+            parts = _read_level(conn, level, start // level * level, end,
+                                warehouse_ids)
+        finally:
+            conn.close()
+        history = {}
+        for rows in parts:
+            for warehouse_id, points in groupby(rows, itemgetter(0)):
+                history.setdefault(warehouse_id, []).extend(
+                    HistoryPoint._make(point[1:]) for point in points
+                )
+        return history
+
+    def start_compactor(self, interval):
+        """Start compacting in a background thread every interval seconds."""
+        if self._compactor is None:
+            self._compactor = HistoryCompactor(self, interval)
+            self._compactor.start()
+
+    def stop_compactor(self):
+        """Stop the background compactor if it is running."""
+        if self._compactor is not None:
+            self._compactor.stop()
+            self._compactor = None
+
+
+def _watermarks(conn):
+    """Get the time up to which each level has been rolled up."""
+    rows = conn.execute("SELECT level, ts FROM history_watermarks")
+    return {row['level']: row['ts'] for row in rows}
+
+
+def _roll_up(conn, source, target, now):
+    """Aggregate closed target buckets from points of the source level."""
+    start = _watermarks(conn).get(target, 0)
+    end = now // target * target
+    if end <= start:
+        return
+    conn.execute(
+        """INSERT INTO capacity_history
+               (level, warehouse_id, ts, samples, balance_sum,
+                balance_min, balance_max, capacity)
+           SELECT ?, warehouse_id, ts / ? * ? AS bucket, SUM(samples),
+                  SUM(balance_sum), MIN(balance_min), MAX(balance_max),
+                  MAX(capacity)
+           FROM capacity_history
+           WHERE level = ? AND ts >= ? AND ts < ?
+           GROUP BY warehouse_id, bucket""" + _UPSERT,
+        (target, target, target, source, start, end)
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO history_watermarks (level, ts) VALUES (?, ?)",
+        (target, end)
+    )
+
+
+def _sources(conn, level):
+    """Get (level, from, to) ranges covering all time at a level.
+
+    The level itself covers the time it has been rolled up to, each finer
+    level the time after that of the next coarser one.
+    """
+    marks = _watermarks(conn)
+    ranges = []
+    lower = 0
+    for source in reversed(LEVELS[:LEVELS.index(level) + 1]):
+        upper = marks.get(source, 0) if source != RAW else sys.maxsize
+        ranges.append((source, lower, upper))
+        lower = upper
+    return ranges
+
+
+def _whole_units(expression):
+    """SQL converting milli-units to whole units like from_units()."""
+    return f"""CASE WHEN ({expression}) % {SCALE} = 0
+                    THEN ({expression}) / {SCALE}
+                    ELSE ({expression}) / {float(SCALE)} END"""
+
+
+def _point_columns(aggregate):
+    """SQL selecting the HistoryPoint fields after ts of stored points.
+
+    With aggregate, the points of each group are combined into one.
+    Conversion to whole units is done in SQL, as converting in Python
+    dominates the time of queries reading many points.
+    """
+    def column(function, name):
+        return f"{function}({name})" if aggregate else name
+
+    average = (f"CAST(ROUND(1.0 * {column('SUM', 'balance_sum')}"
+               f" / {column('SUM', 'samples')}) AS INTEGER)")
+    return ', '.join(_whole_units(expression) for expression in (
+        average, column('MIN', 'balance_min'), column('MAX', 'balance_max'),
+        column('MAX', 'capacity')
+    ))
+
+
+_STORED_POINT = _point_columns(aggregate=False)
+_AGGREGATED_POINT = _point_columns(aggregate=True)
+
+
+def _warehouse_filter(warehouse_ids):
+    """SQL condition and parameters selecting warehouses, if given."""
+    if warehouse_ids is None:
+        return '', []
+    placeholders = ', '.join('?' * len(warehouse_ids))
+    return f" AND warehouse_id IN ({placeholders})", list(warehouse_ids)
+
+
+def _read_level(conn, level, start, end, warehouse_ids):
+    """Read points between start and end at a level.
+
+    Points already rolled up to the level are read as stored, in primary
+    key order (the unary + keeps the planner off the ts index, which
+    would need a sort); only the newer points of finer levels are
+    aggregated.
+    Returns lists of (warehouse id, *HistoryPoint fields) tuples ordered
+    by warehouse and time, the stored points first.
+    """
+    (_level, _lower, rolled_up), *finer = _sources(conn, level)
+    condition, ids = _warehouse_filter(warehouse_ids)
+    cursor = conn.cursor()
+    cursor.row_factory = None  # Plain tuples are cheaper to build
+    rows = cursor.execute(
+        f"""SELECT warehouse_id, ts, {_STORED_POINT} FROM capacity_history
+            WHERE level = ?{condition} AND +ts >= ? AND +ts < ?
+            ORDER BY warehouse_id, ts""",
+        [level, *ids, start, min(end, rolled_up)]
+    ).fetchall()
+    if not finer:
+        return [rows]
+    return [rows, _read_finer(cursor, level, finer,
+                              (max(start, rolled_up), end), (condition, ids))]
+
+
+def _read_finer(cursor, level, sources, time_range, warehouse_filter):
+    """Aggregate points of finer (level, from, to) sources to a level."""
+    condition, ids = warehouse_filter
+    params = [level, level]
+    for source in sources:
+        params.extend(source)
+    where = ' OR '.join(['(level = ? AND ts >= ? AND ts < ?)'] * len(sources))
+    return cursor.execute(
+        f"""SELECT warehouse_id, ts / ? * ? AS bucket, {_AGGREGATED_POINT}
+            FROM capacity_history
+            WHERE ({where}){condition} AND ts >= ? AND ts < ?
+            GROUP BY warehouse_id, bucket ORDER BY warehouse_id, bucket""",
+        [*params, *ids, *time_range]
+    ).fetchall()
+
+
+class HistoryCompactor(threading.Thread):
+    """Background thread periodically compacting a CapacityHistory."""
+
+    def __init__(self, history, interval):
+        """Initialize the compactor for a history and interval in seconds."""
+        super().__init__(name='history-compactor', daemon=True)
+        self.history = history
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        """Compact the history every interval until stopped."""
+        while not self._stopped.wait(self.interval):
+            try:
+                self.history.compact()
+            except sqlite3.Error:
+                logger.exception("History compaction failed, will retry")
+
+    def stop(self):
+        """Stop the thread and wait for it to finish."""
+        self._stopped.set()
+        self.join()
@@ -0,0 +1,773 @@
+"""In-memory warehouse storage with write-behind persistence to SQLite."""
+import atexit
+import heapq
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter, namedtuple
+from alerts import AlertEngine
+from quantity import from_units, to_units
+from replica import copy_database
+from reservations import HOLD_SECONDS
+from search import PER_PAGE
+from transfers import TransferError, check_transfer, transfer_message
+from varasto import Varasto
+from warehouse_manager import (CONFLICT, VERIFY_BATCH_SIZE, WarehouseManager,
+                               check_batch_size, check_version, project_row,
+                               record_verified)
+
+logger = logging.getLogger(__name__)
+
+Hold = namedtuple('Hold', ('warehouse_id', 'product_name', 'quantity',
+                           'expires_at'))
+
+
+def _timestamp():
+    """Return the current UTC time formatted like SQLite CURRENT_TIMESTAMP."""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+
+
+class WarehouseRecord:  # pylint: disable=too-many-instance-attributes
+    """Compact in-memory representation of a warehouse row.
+
+    Quantities are integer milli-units as in the database.
+    """
+    __slots__ = ('id', 'name', 'capacity', 'balance', 'type',
+                 'created_at', 'updated_at', 'version', 'products')
+
+    def __init__(self, row, products):
+        """Initialize the record from a mapping of warehouse columns."""
+        self.id = row['id']
+        self.name = row['name']
+        self.capacity = row['capacity']
+        self.balance = row['balance']
+        self.type = row['type']
+        self.created_at = row['created_at']
+        self.updated_at = row['updated_at']
+        self.version = row['version']
+        self.products = products
+
+    def header(self):
+        """Return the warehouse columns as a tuple in table order."""
+        return (self.id, self.name, self.capacity, self.balance, self.type,
+                self.created_at, self.updated_at, self.version)
+
+    def touch(self):
+        """Update the modification timestamp and version."""
+        self.updated_at = _timestamp()
+        self.version += 1
+
+    def add_product(self, name, quantity):
+        """Add quantity (milli-units) of a product."""
+        self.balance = self.balance + quantity
+        self.products[name] = self.products.get(name, 0) + quantity
+        self.touch()
+
+    def remove_product(self, name):
+        """Remove a product and its quantity from the balance."""
+        self.balance = self.balance - self.products.pop(name)
+        self.touch()
+
+    def take_product(self, name, quantity):
+        """Take quantity (milli-units) of a product, dropping it if empty."""
+        self.balance = self.balance - quantity
+        self.products[name] = self.products[name] - quantity
+        if not self.products[name]:
+            del self.products[name]
+        self.touch()
+
+
+class MemoryHolds:
+    """Stock reservations held in memory, see WarehouseManager.reserve.
+
+    Holds are not persisted. Deadlines are kept in a min-heap and expired
+    holds are dropped whenever holds are used, not by scanning them all,
+    and the quantity held of each product is kept as a running total.
+    Not thread-safe, MemoryWarehouseManager calls it holding its lock.
+    """
+
+    def __init__(self, clock=time.time):
+        """Initialize without holds."""
+        self.clock = clock
+        self._holds = {}
+        # (warehouse id, product name) -> ids and total quantity of holds
+        self._hold_ids = {}
+        self._held = Counter()
+        self._heap = []
+        self._ids = itertools.count(1)
+
+    def expire(self):
+        """Drop the holds whose deadline has passed."""
+        now = self.clock()
+        while self._heap and self._heap[0][0] <= now:
+            self._remove(heapq.heappop(self._heap)[1])
+
+    def held(self, warehouse_id, product_name):
+        """Get the quantity of a product held by active holds."""
+        self.expire()
+        return self._held[warehouse_id, product_name]
+
+    def add(self, warehouse_id, product_name, quantity, ttl):
+        """Add a hold for ttl seconds and return its id."""
+        hold_id = next(self._ids)
+        expires_at = self.clock() + ttl
+        self._holds[hold_id] = Hold(warehouse_id, product_name, quantity,
+                                    expires_at)
+        self._hold_ids.setdefault((warehouse_id, product_name),
+                                  set()).add(hold_id)
+        self._held[warehouse_id, product_name] += quantity
+        heapq.heappush(self._heap, (expires_at, hold_id))
+        return hold_id
+
+    def pop(self, hold_id):
+        """Remove and return an active hold, None if missing or expired."""
+        self.expire()
+        return self._remove(hold_id)
+
+    def drop(self, warehouse_id, product_name=None):
+        """Drop the holds of a warehouse, or of one of its products."""
+        for key in [key for key in self._hold_ids if key[0] == warehouse_id
+                    and product_name in (None, key[1])]:
+            for hold_id in self._hold_ids.pop(key):
+                del self._holds[hold_id]
+            del self._held[key]
+
+    def _remove(self, hold_id):
+        """Remove a hold and return it, None if missing."""
+        hold = self._holds.pop(hold_id, None)
+        if hold is not None:
+            key = hold[:2]
+            self._hold_ids[key].remove(hold_id)
+            self._held[key] -= hold.quantity
+            if not self._hold_ids[key]:
+                del self._hold_ids[key], self._held[key]
+        return hold
+
+
+class MemoryWarehouseManager(WarehouseManager):  # pylint: disable=too-many-public-methods
+    """WarehouseManager that keeps warehouses and products in memory.
+
+    All reads and writes are served from memory. Changed warehouses are
+    written to the SQLite database by a background write-behind flusher
+    every flush_interval seconds, at most batch_size warehouses per
+    transaction, so the database lags behind memory by roughly one
+    interval. Call flush() to persist immediately and close() on shutdown.
+    Capacity history is sampled and alert rules are evaluated when
+    changes are flushed.
+    """
+
+    def __init__(self, db_path=None, flush_interval=1.0, batch_size=100,
+                 start=True):
+        """Load the current state from SQLite and start the flusher."""
+        super().__init__(db_path)
+        self.batch_size = batch_size
+        self._lock = threading.RLock()
+        # Serializes flushes so older state never overwrites newer state
+        self._flush_lock = threading.Lock()
+        # Pending changes: warehouse id -> names of changed products
+        self._dirty = {}
+        self._warehouses, self._next_id = self._load()
+        self._flusher = WriteBehindFlusher(self, flush_interval)
+        if start:
+            self.start()
+
+    def _create_holds(self):
+        """Keep reservations in memory, see WarehouseManager._create_holds."""
+        return MemoryHolds()
+
+    def _create_alerts(self):
+        """Manage rules on flushed state, see WarehouseManager._create_alerts.
+
+        Rules are evaluated against the database as changes are flushed.
+        Adding and removing rules flushes first, so they see the current
+        warehouses; listing them reads the database as last flushed.
+        """
+        return AlertEngine(self._flushed_connection, self.catalog,
+                           read_connection=self._get_connection)
+
+    def _flushed_connection(self):
+        """Get a database connection after flushing pending changes."""
+        self.flush()
+        return self._get_connection()
+
+    def _load(self):
+        """Read all warehouses and products from the database."""
+        conn = self._get_connection()
+        try:
+            warehouses = {
+                row['id']: WarehouseRecord(row, {}) for row in
+                conn.execute("SELECT * FROM warehouses ORDER BY id")
+            }
+            for row in conn.execute(
+                """SELECT p.warehouse_id, c.name, p.quantity FROM products p
+                   JOIN catalog c ON c.id = p.product_id ORDER BY p.id"""
+            ):
+                products = warehouses[row['warehouse_id']].products
+                products[row['name']] = row['quantity']
+            row = conn.execute("""SELECT MAX(seq) FROM sqlite_sequence
+                                  WHERE name = 'warehouses'""").fetchone()
+        finally:
+            conn.close()
+        return warehouses, max([row[0] or 0, *warehouses]) + 1
+
+    def start(self):
+        """Start the background write-behind flusher."""
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def close(self):
+        """Persist pending changes, stop the threads and close the reads."""
+        if self._flusher.is_alive():
+            self._flusher.stop()
+            atexit.unregister(self.close)
+        self.flush()
+        self.alerts.dispatcher.stop()
+        self.reads.close()
+
+    @property
+    def flush_interval(self):
+        """Seconds between background flushes."""
+        return self._flusher.interval
+
+    @property
+    def pending_changes(self):
+        """Number of warehouses with changes not yet written to SQLite."""
+        with self._lock:
+            return len(self._dirty)
+
+    def _mark_dirty(self, warehouse_id, product_name=None):
+        """Record a change to be written by the next flush."""
+        changed = self._dirty.setdefault(warehouse_id, set())
+        if product_name is not None:
+            changed.add(product_name)
+
+    def _find_by_name(self, name, exclude_id=None):
+        """Find a warehouse id by case-insensitive name."""
+        name = name.lower()
+        for record in self._warehouses.values():
+            if record.name.lower() == name and record.id != exclude_id:
+                return record.id
+        return None
+
+    def name_exists(self, name, exclude_id=None):
+        """Check if a warehouse name already exists."""
+        with self._lock:
+            return self._find_by_name(name, exclude_id) is not None
+
+    def create_warehouse(self, name, capacity, warehouse_type='fruit'):
+        """Create a new warehouse with given name, capacity and type."""
+        with self._lock:
+            if self._find_by_name(name) is not None:
+                return None  # Name already exists
+            now = _timestamp()
+            record = WarehouseRecord({
+                'id': self._next_id, 'name': name,
+                'capacity': to_units(capacity), 'balance': 0,
+                'type': warehouse_type,
+                'created_at': now, 'updated_at': now, 'version': 0
+            }, {})
+            self._warehouses[record.id] = record
+            self._next_id += 1
+            self._mark_dirty(record.id)
+            return record.id
+
+    def _warehouse_dict(self, record, with_products=True):
+        """Build a warehouse dictionary from an in-memory record."""
+        warehouse = {
+            'id': record.id,
+            'name': record.name,
+            'varasto': Varasto.yksikoista(record.capacity, record.balance),
+            'type': record.type,
+            'version': record.version
+        }
+        if with_products:
+            warehouse['products'] = _products_dict(record)
+        return warehouse
+
+    def get_warehouse(self, warehouse_id, projection='full'):
+        """Get a warehouse by ID, see WarehouseManager.get_warehouse."""
+        columns = self._projection_columns(projection)
+        with self._lock:
+            record = self._warehouses.get(warehouse_id)
+            if record is None:
+                return None
+            if projection in ('full', 'header'):
+                return self._warehouse_dict(record, projection == 'full')
+            return project_row(
+                {column: getattr(record, column) for column in columns}
+            )
+
+    def get_products(self, warehouse_id):
+        """Get the products of a warehouse as a name to quantity dict."""
+        with self._lock:
+            record = self._warehouses.get(warehouse_id)
+            return _products_dict(record) if record else {}
+
+    def get_all_warehouses(self):
+        """Get all warehouses."""
+        with self._lock:
+            return [self._warehouse_dict(record)
+                    for record in self._warehouses.values()]
+
+    def iter_warehouses(self):
+        """Iterate over all warehouses, see WarehouseManager.
+
+        Each warehouse is copied when reached, skipping deleted ones.
+        """
+        with self._lock:
+            warehouse_ids = list(self._warehouses)
+        for warehouse_id in warehouse_ids:
+            warehouse = self.get_warehouse(warehouse_id)
+            if warehouse is not None:
+                yield warehouse
+
+    def update_warehouse(self, warehouse_id, name, capacity,
+                         expected_version=None):
+        """Update warehouse name and capacity, see WarehouseManager."""
+        capacity = to_units(capacity)
+        with self._lock:
+            record = self._warehouses.get(warehouse_id)
+            if record is None:
+                return False, "Warehouse not found"
+            error = self._validate_record_update(record, name, capacity,
+                                                 expected_version)
+            if error:
+                return False, error
+            record.name, record.capacity = name, capacity
+            record.touch()
+            self._mark_dirty(warehouse_id)
+            return True, "Success"
+
+    def _validate_record_update(self, record, name, capacity,
+                                expected_version):
+        """Validate an update of a record, returning an error or None."""
+        if expected_version not in (None, record.version):
+            return CONFLICT
+        if self._find_by_name(name, exclude_id=record.id) is not None:
+            return "Name already exists"
+        if capacity < record.balance:
+            return "Capacity cannot be less than current balance"
+        return None
+
+    def add_product(self, warehouse_id, product_name, quantity,
+                    expected_version=None):
+        """Add a product to a warehouse, see WarehouseManager.
+
+        Changes are serialized by a lock, so only a stale expected_version
+        conflicts.
+        """
+        quantity = to_units(quantity)
+        if quantity <= 0:
+            return False
+        with self._lock:
+            record = self._warehouses.get(warehouse_id)
+            if record is None or quantity > record.capacity - record.balance:
+                return False
+            check_version(record.version, expected_version)
+            # Keep the catalog in sync so the name is searchable right away
+            self.catalog.intern(product_name)
+            record.add_product(product_name, quantity)
+            self._mark_dirty(warehouse_id, product_name)
+            return True
+
+    def remove_product(self, warehouse_id, product_name,
+                       expected_version=None):
+        """Remove a product from a warehouse, see WarehouseManager."""
+        with self._lock:
+            record = self._warehouses.get(warehouse_id)
+            if record is None or product_name not in record.products:
+                return False
+            check_version(record.version, expected_version)
+            self._remove_from(record, product_name)
+            return True
+
+    def _remove_from(self, record, product_name):
+        """Remove a product and its holds from a record."""
+        record.remove_product(product_name)
+        self.holds.drop(record.id, product_name)
+        self._mark_dirty(record.id, product_name)
+
+    def remove_products(self, warehouse_id, product_names,
+                        expected_version=None):
+        """Remove several products, see WarehouseManager.remove_products."""
+        with self._lock:
+            record = self._warehouses.get(warehouse_id)
+            names = [name for name in dict.fromkeys(product_names)
+                     if record is not None and name in record.products]
+            if names:
+                check_version(record.version, expected_version)
+            for name in names:
+                self._remove_from(record, name)
+            return len(names)
+
+    def move_products(self, source_id, target_id, product_names,
+                      expected_version=None):
+        """Move the stock of products, see WarehouseManager.move_products."""
+        if source_id == target_id:
+            return False, "Cannot move to the same warehouse"
+        with self._lock:
+            source, target = (self._warehouses.get(warehouse_id)
+                              for warehouse_id in (source_id, target_id))
+            error = self._validate_move(source, target, expected_version)
+            if error:
+                return False, error
+            moves = self._movable_quantities(source_id, product_names)
+            if not moves:
+                return False, "Nothing to move"
+            if sum(moves.values()) > target.capacity - target.balance:
+                return False, "Not enough space in target warehouse"
+            self._move_records(source, target, moves)
+            return True, "Success"
+
+    def _validate_move(self, source, target, expected_version):
+        """Validate a move between records, returning an error or None."""
+        if source is None or target is None:
+            return "Warehouse not found"
+        if expected_version not in (None, source.version):
+            return CONFLICT
+        return None
+
+    def _movable_quantities(self, warehouse_id, product_names):
+        """Get product name -> unreserved quantity of products to move."""
+        moves = {name: self._available(warehouse_id, name)
+                 for name in dict.fromkeys(product_names)}
+        return {name: qty for name, qty in moves.items() if qty > 0}
+
+    def _move_records(self, source, target, moves):
+        """Move product name -> quantity moves between records."""
+        for name, quantity in moves.items():
+            source.take_product(name, quantity)
+            target.add_product(name, quantity)
+            self._mark_dirty(source.id, name)
+            self._mark_dirty(target.id, name)
+
+    def transfer(self, source_id, target_id, product_name, quantity):
+        """Move a quantity of a product, see WarehouseManager.transfer."""
+        return self.transfer_many([(source_id, target_id, product_name,
+                                    quantity)])
+
+    def transfer_many(self, transfers):
+        """Make transfers, see WarehouseManager.transfer_many.
+
+        All transfers are checked against the stock and balances left
+        by the ones before them before any record is changed.
+        """
+        if not transfers:
+            return False, "Nothing to transfer"
+        moves = [(source_id, target_id, name, to_units(quantity))
+                 for source_id, target_id, name, quantity in transfers]
+        with self._lock:
+            try:
+                self._check_transfers(moves)
+            except TransferError as error:
+                return False, transfer_message(transfers, error)
+            for source_id, target_id, name, quantity in moves:
+                self._move_records(self._warehouses[source_id],
+                                   self._warehouses[target_id],
+                                   {name: quantity})
+        return True, "Success"
+
+    def _check_transfers(self, moves):
+        """Raise TransferError unless all moves can be made in order."""
+        stock, deltas = Counter(), Counter()
+        for number, (source_id, target_id, name, quantity) in enumerate(
+                moves, 1):
+            try:
+                target = self._transfer_records(source_id, target_id)
+                check_transfer(
+                    quantity,
+                    self._available(source_id, name) + stock[source_id, name],
+                    target.capacity - target.balance - deltas[target_id]
+                )
+            except TransferError as error:
+                raise TransferError(str(error), number) from None
+            stock.update({(source_id, name): -quantity,
+                          (target_id, name): quantity})
+            deltas.update({source_id: -quantity, target_id: quantity})
+
+    def _transfer_records(self, source_id, target_id):
+        """Get the target record of a transfer, raising TransferError."""
+        if source_id == target_id:
+            raise TransferError("Cannot transfer to the same warehouse")
+        source, target = (self._warehouses.get(warehouse_id)
+                          for warehouse_id in (source_id, target_id))
+        if source is None or target is None:
+            raise TransferError("Warehouse not found")
+        return target
+
+    def _available(self, warehouse_id, product_name):
+        """Get the unreserved quantity of a product in milli-units."""
+        record = self._warehouses.get(warehouse_id)
+        stock = record.products.get(product_name, 0) if record else 0
+        return stock - self.holds.held(warehouse_id, product_name)
+
+    def available(self, warehouse_id, product_name):
+        """Get the quantity of a product not held by reservations."""
+        with self._lock:
+            return from_units(self._available(warehouse_id, product_name))
+
+    def reserve(self, warehouse_id, product_name, quantity, ttl=HOLD_SECONDS):
+        """Hold a quantity of a product, see WarehouseManager.reserve.
+
+        Holds are kept in memory only and are lost on restart.
+        """
+        quantity = to_units(quantity)
+        with self._lock:
+            available = self._available(warehouse_id, product_name)
+            if not 0 < quantity <= available:
+                return None
+            return self.holds.add(warehouse_id, product_name, quantity, ttl)
+
+    def confirm(self, reservation_id):
+        """Pick the held stock, see WarehouseManager.confirm."""
+        with self._lock:
+            hold = self.holds.pop(reservation_id)
+            if hold is None:
+                return False
+            self._warehouses[hold.warehouse_id].take_product(
+                hold.product_name, hold.quantity
+            )
+            self._mark_dirty(hold.warehouse_id, hold.product_name)
+            return True
+
+    def release(self, reservation_id):
+        """Release a hold, see WarehouseManager.release."""
+        with self._lock:
+            return self.holds.pop(reservation_id) is not None
+
+    def delete_warehouse(self, warehouse_id):
+        """Delete a warehouse."""
+        with self._lock:
+            if self._warehouses.pop(warehouse_id, None) is None:
+                return False
+            self.holds.drop(warehouse_id)
+            self._mark_dirty(warehouse_id)
+            return True
+
+    def delete_warehouses(self, warehouse_ids):
+        """Delete several warehouses, returning how many were deleted."""
+        with self._lock:
+            return sum(self.delete_warehouse(warehouse_id)
+                       for warehouse_id in set(warehouse_ids))
+
+    def verify_and_repair(self, repair=False, batch_size=VERIFY_BATCH_SIZE,
+                          pause=0.0):
+        """Compare balances with product sums, see WarehouseManager.
+
+        Memory is authoritative, so the in-memory records are checked and
+        repaired; repairs reach SQLite with the next flush.
+        """
+        check_batch_size(batch_size)
+        report = {'checked': 0, 'mismatches': {}, 'repaired': 0}
+        with self._lock:
+            ids = sorted(self._warehouses)
+        for start in range(0, len(ids), batch_size):
+            if start:
+                time.sleep(pause)
+            self._verify_records(report, ids[start:start + batch_size], repair)
+        return report
+
+    def _verify_records(self, report, ids, repair):
+        """Verify the records with the given ids into report."""
+        with self._lock:
+            records = [self._warehouses[wh_id] for wh_id in ids
+                       if wh_id in self._warehouses]
+            totals = [(record, sum(record.products.values()))
+                      for record in records]
+            drifted = [(record.id, record.balance, total)
+                       for record, total in totals if record.balance != total]
+            if repair:
+                for warehouse_id, _balance, total in drifted:
+                    self._repair_balance(warehouse_id, total)
+                report['repaired'] += len(drifted)
+        record_verified(report, len(records), drifted)
+
+    def _repair_balance(self, warehouse_id, total):
+        """Set a record's balance to its product total (milli-units)."""
+        record = self._warehouses[warehouse_id]
+        record.balance = total
+        record.touch()
+        self._mark_dirty(warehouse_id)
+
+    def flush(self):
+        """Write pending changes to SQLite, batch_size warehouses at a time.
+
+        Returns the number of warehouses written.
+        """
+        written = 0
+        with self._flush_lock:
+            batch = self._take_batch(self.batch_size)
+            while batch:
+                written += self._write_batch_or_all(batch)
+                batch = self._take_batch(self.batch_size)
+        return written
+
+    def _write_batch_or_all(self, batch):
+        """Write a batch, falling back to all pending changes at once."""
+        try:
+            self._write_batch(batch)
+        except sqlite3.IntegrityError:
+            # Renames spanning batches (e.g. swapped names) can only be
+            # written together, so retry with everything pending
+            batch = self._take_batch(None)
+            self._write_batch(batch)
+        return len(batch)
+
+    def _take_batch(self, size):
+        """Remove up to size pending changes and copy their current state."""
+        with self._lock:
+            ids = list(itertools.islice(self._dirty, size))
+            return [self._copy_change(wh_id, self._dirty.pop(wh_id))
+                    for wh_id in ids]
+
+    def _copy_change(self, warehouse_id, product_names):
+        """Copy the state to write for a pending change."""
+        record = self._warehouses.get(warehouse_id)
+        if record is None:
+            return warehouse_id, None, {}
+        products = {name: record.products.get(name) for name in product_names}
+        return warehouse_id, record.header(), products
+
+    def _requeue(self, batch):
+        """Mark the warehouses of a failed batch as pending again."""
+        with self._lock:
+            for warehouse_id, _header, product_names in batch:
+                self._dirty.setdefault(warehouse_id, set()).update(
+                    product_names
+                )
+
+    def _write_batch(self, batch):
+        """Write a batch of changes to SQLite in a single transaction."""
+        conn = self._get_connection()
+        try:
+            with self.alerts.collect(), conn:
+                self._persist(conn, batch)
+        except sqlite3.Error:
+            self._requeue(batch)
+            raise
+        finally:
+            conn.close()
+
+    def _persist(self, conn, batch):
+        """Write a batch, sampling history and alerts of its warehouses."""
+        _write_changes(conn, self._resolve_product_ids(batch))
+        for warehouse_id, header, _products in batch:
+            if header is not None:
+                self._changed(conn, warehouse_id)
+
+    def _resolve_product_ids(self, batch):
+        """Replace product names of a batch by their catalog ids."""
+        return [
+            (warehouse_id, header, {
+                self.catalog.intern(name): quantity
+                for name, quantity in products.items()
+            })
+            for warehouse_id, header, products in batch
+        ]
+
+    def search_warehouses(self, query='', filters=None, page=1,
+                          per_page=PER_PAGE):
+        """Flush pending changes and search the database.
+
+        See WarehouseManager.search_warehouses.
+        """
+        self.flush()
+        return super().search_warehouses(query, filters, page, per_page)
+
+    def export_snapshot(self, path, compress=False):
+        """Flush pending changes and write a binary snapshot, see snapshot.py.
+
+        Returns a dict of table -> number of rows.
+        """
+        self.flush()
+        return super().export_snapshot(path, compress)
+
+    def snapshot(self, path):
+        """Write a consistent copy of the database to path.
+
+        Pending changes are flushed first. The copy is made with the SQLite
+        backup API into a temporary file which then atomically replaces
+        path, so a crash never leaves a partially written snapshot.
+        """
+        self.flush()
+        copy_database(self.db_path, path)
+
+
+def _products_dict(record):
+    """Return a record's products with quantities in whole units."""
+    return {
+        name: from_units(units) for name, units in record.products.items()
+    }
+
+
+def _write_changes(conn, batch):
+    """Execute the statements persisting a batch of changes."""
+    for warehouse_id, header, _products in batch:
+        if header is None:
+            conn.execute("DELETE FROM products WHERE warehouse_id = ?",
+                         (warehouse_id,))
+            conn.execute("DELETE FROM warehouses WHERE id = ?",
+                         (warehouse_id,))
+        else:
+            # Free the names first so renames within a batch cannot clash
+            conn.execute("UPDATE warehouses SET name = ? WHERE id = ?",
+                         (f"\0{warehouse_id}", warehouse_id))
+    for warehouse_id, header, products in batch:
+        if header is not None:
+            _write_warehouse(conn, header, products)
+
+
+def _write_warehouse(conn, header, products):
+    """Upsert a warehouse row and its changed products by catalog id."""
+    conn.execute(
+        """INSERT INTO warehouses (id, name, capacity, balance, type,
+                                   created_at, updated_at, version)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT(id) DO UPDATE SET
+               name = excluded.name, capacity = excluded.capacity,
+               balance = excluded.balance, updated_at = excluded.updated_at,
+               version = excluded.version""",
+        header
+    )
+    for product_id, quantity in products.items():
+        if quantity is None:
+            conn.execute(
+                """DELETE FROM products
+                   WHERE warehouse_id = ? AND product_id = ?""",
+                (header[0], product_id)
+            )
+        else:
+            conn.execute(
+                """INSERT INTO products (warehouse_id, product_id, quantity)
+                   VALUES (?, ?, ?)
+                   ON CONFLICT(warehouse_id, product_id) DO UPDATE SET
+                       quantity = excluded.quantity,
+                       updated_at = CURRENT_TIMESTAMP""",
+                (header[0], product_id, quantity)
+            )
+
+
+class WriteBehindFlusher(threading.Thread):
+    """Background thread periodically flushing a MemoryWarehouseManager."""
+
+    def __init__(self, manager, interval):
+        """Initialize the flusher for a manager and interval in seconds."""
+        super().__init__(name='write-behind-flusher', daemon=True)
+        self.manager = manager
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        """Flush the manager every interval until stopped."""
+        while not self._stopped.wait(self.interval):
+            try:
+                self.manager.flush()
+            except sqlite3.Error:
+                logger.exception("Write-behind flush failed, will retry")
+
+    def stop(self):
+        """Stop the thread and wait for it to finish."""
+        self._stopped.set()
+        self.join()
@@ -0,0 +1,200 @@
+"""Schema migrations for databases created by earlier versions.
+
+The schema version is kept in PRAGMA user_version. Each migration upgrades
+the tables from the previous version to its own version using the table
+definitions of that version. schema.sql then adds whatever is still
+missing (indexes, triggers, new tables). The whole upgrade runs in a
+single transaction.
+"""
+import os
+import sqlite3
+from contextlib import contextmanager
+from quantity import SCALE
+
+
+# Schema of the latest version
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'schema.sql')
+
+
+def read_schema():
+    """Read the SQL script creating the latest schema."""
+    with open(SCHEMA_PATH, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def _table_exists(conn, table):
+    """Check whether a table exists."""
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (table,)
+    ).fetchone()
+    return row is not None
+
+
+def _rebuild(conn, table, create_sql, select_sql):
+    """Recreate a table with a new definition, copying its rows.
+
+    The old table's explicit indexes and triggers are dropped; schema.sql
+    creates the current ones afterwards. select_sql reads the old rows
+    from the table "<table>_legacy".
+    """
+    legacy = f"{table}_legacy"
+    cursor = conn.execute(
+        """SELECT type, name FROM sqlite_master
+           WHERE tbl_name = ? AND type IN ('index', 'trigger')
+             AND sql IS NOT NULL""",
+        (table,)
+    )
+    for kind, name in cursor.fetchall():
+        conn.execute(f"DROP {kind.upper()} {name}")
+    conn.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+    conn.execute(create_sql)
+    conn.execute(f"INSERT INTO {table} {select_sql}")
+    conn.execute(f"DROP TABLE {legacy}")
+
+
+def _add_catalog(conn):
+    """Version 1: store product names once in a catalog table."""
+    conn.execute("""CREATE TABLE catalog (
+                        id INTEGER PRIMARY KEY,
+                        name TEXT NOT NULL UNIQUE,
+                        default_quantity REAL
+                    )""")
+    conn.execute("""INSERT INTO catalog (name)
+                    SELECT DISTINCT name FROM products""")
+    _rebuild(conn, 'products', """CREATE TABLE products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        warehouse_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity REAL NOT NULL DEFAULT 0.0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (warehouse_id) REFERENCES warehouses(id) ON DELETE CASCADE,
+        FOREIGN KEY (product_id) REFERENCES catalog(id),
+        UNIQUE(warehouse_id, product_id)
+    )""", """SELECT p.id, p.warehouse_id, c.id, p.quantity,
+                    p.created_at, p.updated_at
+             FROM products_legacy p JOIN catalog c ON c.name = p.name""")
+
+
+def _units(column):
+    """SQL expression converting a REAL column to integer milli-units."""
+    return f"CAST(ROUND({column} * {SCALE}) AS INTEGER)"
+
+
+def _use_milli_units(conn):
+    """Version 2: store quantities as INTEGER milli-units."""
+    _rebuild(conn, 'warehouses', """CREATE TABLE warehouses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        capacity INTEGER NOT NULL DEFAULT 0,
+        balance INTEGER NOT NULL DEFAULT 0,
+        type TEXT NOT NULL DEFAULT 'fruit',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""", f"""SELECT id, name, {_units('capacity')}, {_units('balance')},
+                     type, created_at, updated_at
+              FROM warehouses_legacy""")
+    _rebuild(conn, 'products', """CREATE TABLE products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        warehouse_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (warehouse_id) REFERENCES warehouses(id) ON DELETE CASCADE,
+        FOREIGN KEY (product_id) REFERENCES catalog(id),
+        UNIQUE(warehouse_id, product_id)
+    )""", f"""SELECT id, warehouse_id, product_id, {_units('quantity')},
+                     created_at, updated_at
+              FROM products_legacy""")
+    _rebuild(conn, 'catalog', """CREATE TABLE catalog (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        default_quantity INTEGER
+    )""", f"""SELECT id, name, {_units('default_quantity')}
+              FROM catalog_legacy""")
+
+
+def _add_row_versions(conn):
+    """Version 3: add a version counter to warehouses."""
+    conn.execute("""ALTER TABLE warehouses
+                    ADD COLUMN version INTEGER NOT NULL DEFAULT 0""")
+
+
+def _index_warehouse_names(conn):
+    """Version 4: add the trigram index of warehouse names for search."""
+    conn.execute("""CREATE VIRTUAL TABLE warehouses_fts USING fts5(
+        name, content='warehouses', content_rowid='id', tokenize='trigram'
+    )""")
+    conn.execute(
+        "INSERT INTO warehouses_fts (warehouses_fts) VALUES ('rebuild')"
+    )
+
+
+# (version, migration) in ascending version order
+MIGRATIONS = [
+    (1, _add_catalog),
+    (2, _use_milli_units),
+    (3, _add_row_versions),
+    (4, _index_warehouse_names),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _pending(conn):
+    """Get the migrations a database still needs."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version == 0 and not _table_exists(conn, 'warehouses'):
+        return []  # New database, schema.sql creates the latest version
+    return [migration for migration in MIGRATIONS if migration[0] > version]
+
+
+def split_statements(script):
+    """Split an SQL script into complete statements."""
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ''
+
+
+def _upgrade(conn, script):
+    """Run pending migrations followed by the schema script."""
+    pending = _pending(conn)
+    for _version, migration in pending:
+        migration(conn)
+    for statement in split_statements(script):
+        conn.execute(statement)
+    if pending:
+        # Index catalog rows copied while the search triggers were absent
+        conn.execute("INSERT INTO catalog_fts (catalog_fts) VALUES ('rebuild')")
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+@contextmanager
+def _migration_pragmas(conn):
+    """Relax foreign keys and table renaming while migrating."""
+    conn.execute("PRAGMA foreign_keys = OFF")
+    # Keep references to renamed tables pointing at the original names
+    conn.execute("PRAGMA legacy_alter_table = ON")
+    try:
+        yield
+    finally:
+        conn.execute("PRAGMA legacy_alter_table = OFF")
+        conn.execute("PRAGMA foreign_keys = ON")
+
+
+def apply_schema(conn, script):
+    """Create or upgrade the schema to the latest version atomically."""
+    with _migration_pragmas(conn):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            _upgrade(conn, script)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
@@ -0,0 +1,241 @@
+"""Opt-in per-request profiling for the Flask application."""
+import contextvars
+import cProfile
+import itertools
+import os
+import pstats
+import threading
+import time
+from collections import namedtuple
+from functools import partial
+from flask import (abort, current_app, g, render_template, request,
+                   send_from_directory)
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_QUERY_ARG = 'profile'
+_TRUTHY = ('1', 'true', 'yes', 'on')
+
+# Where the profile of a request is stored, known before its body is sent
+ProfileDestination = namedtuple('ProfileDestination',
+                                ('directory', 'name', 'keep', 'title'))
+# SQL statements of the request being profiled, None in other requests
+_statements = contextvars.ContextVar('profiled_statements', default=None)
+
+
+def record_statement(statement):
+    """Trace callback keeping the statements of the profiled request.
+
+    The manager is shared by all requests, so statements executed while
+    serving other requests at the same time are ignored.
+    """
+    statements = _statements.get()
+    if statements is not None:
+        statements.append(statement)
+
+
+class RequestProfiler:
+    """Runs selected requests under cProfile and stores the results.
+
+    Profiling is enabled for a single request by sending the ``X-Profile``
+    header or the ``?profile=1`` query flag from an allowed client address.
+    Each profile is stored as a ``.prof`` file (loadable with ``pstats``)
+    together with a ``.txt`` report listing WarehouseManager method timings
+    and the SQL statements executed during the request.
+    """
+
+    def __init__(self, app=None, get_manager=None):
+        """Initialize the profiler, optionally binding it to an app."""
+        self._get_manager = get_manager
+        self._busy = threading.Lock()
+        self._counter = itertools.count(1)
+        if app is not None:
+            self.init_app(app, get_manager)
+
+    def init_app(self, app, get_manager):
+        """Register request hooks and profile routes on the app."""
+        self._get_manager = get_manager
+        _set_config_defaults(app.config)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._abandon)
+        app.add_url_rule('/profiles', 'list_profiles', self.list_profiles)
+        app.add_url_rule('/profiles/<path:filename>', 'download_profile',
+                         self.download_profile)
+
+    @property
+    def directory(self):
+        """Directory where profiles of the current app are stored."""
+        return current_app.config['PROFILE_DIR']
+
+    def _client_allowed(self):
+        """Check whether the requesting client may use profiling."""
+        allowed = current_app.config['PROFILE_ALLOWED_CLIENTS']
+        return request.remote_addr in allowed
+
+    def _requested(self):
+        """Check whether the current request asks to be profiled."""
+        flag = request.headers.get(PROFILE_HEADER) or \
+            request.args.get(PROFILE_QUERY_ARG)
+        return bool(flag) and flag.lower() in _TRUTHY
+
+    def _start(self):
+        """Start profiling the request if requested and allowed."""
+        if request.endpoint in ('list_profiles', 'download_profile') or \
+                not (self._requested() and self._client_allowed()):
+            return
+        # pylint: disable-next=consider-using-with
+        if not self._busy.acquire(blocking=False):
+            return  # Another request is being profiled
+        try:
+            statements, manager = self._trace_statements()
+        except BaseException:
+            self._busy.release()
+            raise
+        g.profile = (cProfile.Profile(), statements, time.perf_counter(),
+                     manager)
+        g.profile[0].enable()
+
+    def _trace_statements(self):
+        """Start capturing the SQL statements of the request.
+
+        Returns the list they are recorded in and the traced manager.
+        """
+        manager = self._get_manager()
+        manager.trace_callback = record_statement
+        statements = []
+        _statements.set(statements)
+        return statements, manager
+
+    def _finish(self, response):
+        """Tag the response and store the profile once it is complete.
+
+        A streamed body is rendered while it is sent, so its profile is
+        completed when the response is closed, after the last chunk.
+        """
+        state = g.pop('profile', None)
+        if state is None:
+            return response
+        destination = self._destination()
+        response.headers['X-Profile-Id'] = destination.name
+        complete = partial(self._complete, state, destination)
+        if response.is_streamed:
+            response.call_on_close(complete)
+        else:
+            complete()
+        return response
+
+    def _destination(self):
+        """Get where the profile of the current request is stored."""
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        return ProfileDestination(
+            self.directory,
+            f"{stamp}-{next(self._counter):04d}-{request.endpoint}",
+            current_app.config['PROFILE_KEEP'],
+            f"{request.method} {request.full_path}"
+        )
+
+    def _complete(self, state, destination):
+        """Stop profiling and store the profile and its report."""
+        profile, statements, started, _manager = state
+        self._stop(state)
+        _store(destination, profile, statements,
+               time.perf_counter() - started)
+
+    def _abandon(self, _exc):
+        """Stop a profile left running by a request that failed."""
+        state = g.pop('profile', None)
+        if state is not None:
+            self._stop(state)
+
+    def _stop(self, state):
+        """Disable the profiler and stop capturing SQL statements."""
+        profile, manager = state[0], state[-1]
+        profile.disable()
+        _statements.set(None)
+        manager.trace_callback = None
+        self._busy.release()
+
+    def recent_profiles(self):
+        """Return stored profile names, newest first."""
+        return _recent_profiles(self.directory)
+
+    def list_profiles(self):
+        """List recently stored profiles."""
+        if not self._client_allowed():
+            abort(404)
+        return render_template('profiles.html',
+                               profiles=self.recent_profiles())
+
+    def download_profile(self, filename):
+        """Download a stored profile or report file."""
+        if not self._client_allowed():
+            abort(404)
+        return send_from_directory(self.directory, filename,
+                                   as_attachment=True)
+
+
+def _set_config_defaults(config):
+    """Set default profiling configuration values."""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    config.setdefault('PROFILE_ALLOWED_CLIENTS', ('127.0.0.1',))
+    config.setdefault('PROFILE_DIR', os.path.join(base_dir, 'profiles'))
+    config.setdefault('PROFILE_KEEP', 20)
+
+
+def _store(destination, profile, statements, elapsed):
+    """Write a profile and its report to disk and rotate old ones."""
+    os.makedirs(destination.directory, exist_ok=True)
+    path = os.path.join(destination.directory, destination.name)
+    profile.dump_stats(path + '.prof')
+    with open(path + '.txt', 'w', encoding='utf-8') as report:
+        _write_report(report, destination.title, profile, statements,
+                      elapsed)
+    for name in _recent_profiles(destination.directory)[destination.keep:]:
+        _remove_profile(destination.directory, name)
+
+
+def _recent_profiles(directory):
+    """Return the names of the profiles stored in directory, newest first."""
+    if not os.path.isdir(directory):
+        return []
+    names = [f[:-len('.prof')] for f in os.listdir(directory)
+             if f.endswith('.prof')]
+    return sorted(names, reverse=True)
+
+
+def _remove_profile(directory, name):
+    """Remove a stored profile and its report."""
+    for suffix in ('.prof', '.txt'):
+        path = os.path.join(directory, name + suffix)
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def _write_report(report, title, profile, statements, elapsed):
+    """Write a human readable report of a profiled request."""
+    report.write(f"{title}\n")
+    report.write(f"Total time: {elapsed * 1000:.2f} ms\n\n")
+    stats = pstats.Stats(profile, stream=report)
+    _write_manager_timings(report, stats)
+    _write_statements(report, statements)
+    stats.sort_stats('cumulative').print_stats(30)
+
+
+def _write_manager_timings(report, stats):
+    """Write timings of WarehouseManager methods to the report."""
+    report.write("WarehouseManager methods (calls, cumulative ms):\n")
+    rows = []
+    for (filename, _line, func), values in stats.stats.items():
+        if filename.endswith('warehouse_manager.py'):
+            rows.append((values[3], func, values[1]))
+    for cumulative, func, calls in sorted(rows, reverse=True):
+        report.write(f"  {func:<32} {calls:>6} {cumulative * 1000:>10.3f}\n")
+    report.write("\n")
+
+
+def _write_statements(report, statements):
+    """Write executed SQL statements to the report."""
+    report.write(f"SQL statements ({len(statements)}):\n")
+    for statement in statements:
+        report.write(f"  {' '.join(statement.split())}\n")
+    report.write("\n")
@@ -0,0 +1,41 @@
+"""Fixed-point quantities stored as integer milli-units.
+
+Quantities are kept as integers counting thousandths of a unit, so adding
+and removing stock never accumulates binary floating point error. Values
+are converted at the edges: to_units() for input, from_units() for output.
+"""
+from decimal import Decimal, ROUND_HALF_EVEN
+
+# Number of units in one whole quantity (three decimal places)
+SCALE = 1000
+# Largest quantity whose milli-units fit a 64-bit SQLite INTEGER
+MAX_QUANTITY = (2 ** 63 - 1) // SCALE
+
+
+def to_units(value):
+    """Convert a quantity to integer milli-units, rounding half to even."""
+    if isinstance(value, int):
+        return value * SCALE
+    if isinstance(value, float):
+        # Exact for any float with at most three meaningful decimals
+        return round(value * SCALE)
+    units = (Decimal(value) * SCALE).to_integral_value(ROUND_HALF_EVEN)
+    return int(units)
+
+
+def from_units(units):
+    """Convert integer milli-units to a quantity.
+
+    Whole quantities are returned as int, others as the nearest float.
+    """
+    whole, fraction = divmod(units, SCALE)
+    if fraction == 0:
+        return whole
+    return units / SCALE
+
+
+def format_quantity(value):
+    """Format a quantity with two or three decimals, e.g. 50.70 or 3.142."""
+    units = to_units(value)
+    text = f"{Decimal(units) / SCALE:.3f}"
+    return text[:-1] if text.endswith('0') else text
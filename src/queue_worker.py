@@ -0,0 +1,40 @@
+"""Background thread consuming a queue, started on first use."""
+import queue
+import threading
+
+
+class QueueWorker:
+    """Base class of objects processing a queue in a background thread.
+
+    Subclasses put items on self.queue and implement _run(), which takes
+    items until the None stop marker put by stop(). The thread is started
+    by start(), which is cheap to call on every use.
+    """
+
+    def __init__(self, name, maxsize):
+        """Initialize with the thread name and the queue bound."""
+        self.queue = queue.Queue(maxsize)
+        self._name = name
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the thread if not running."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name=self._name, daemon=True
+                )
+                self._thread.start()
+
+    def stop(self):
+        """Process the queued items and stop the thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+    def _run(self):
+        """Process queued items until the None stop marker."""
+        raise NotImplementedError
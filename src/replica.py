@@ -0,0 +1,146 @@
+"""Read-only connections for queries, optionally to a refreshed replica.
+
+The read-only methods of WarehouseManager borrow their connections from
+a ReadPool instead of opening a read-write connection each. They are
+opened with the mode=ro URI and PRAGMA query_only, so a read path can
+never write. With the database in WAL mode (set when the schema is
+applied) readers see the last committed state without blocking writers.
+
+With max_staleness set, the pool reads a replica file next to the
+database instead, copied with the SQLite backup API whenever the copy is
+older than max_staleness seconds. Reads then leave the primary file to
+the writers, and see changes up to max_staleness seconds (plus the time
+of one copy) late.
+"""
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Idle connections kept open by a pool, more are opened when needed
+READ_POOL_SIZE = 4
+# Appended to the database path to get the path of its replica
+REPLICA_SUFFIX = '.replica'
+
+
+def connect_read_only(path):
+    """Open a read-only connection to the database at path.
+
+    The connection may be used from any thread, one at a time.
+    """
+    uri = f"{pathlib.Path(path).resolve().as_uri()}?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+def copy_database(source_path, target_path):
+    """Copy a live database with the backup API.
+
+    The copy is written to a temporary file which then atomically replaces
+    target_path, so connections open on the old copy keep reading it.
+    """
+    temp_path = f"{target_path}.tmp"
+    source = connect_read_only(source_path)
+    target = sqlite3.connect(temp_path)
+    try:
+        source.backup(target)
+        # A copy in WAL mode could not be read without its -shm file
+        target.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        target.close()
+        source.close()
+    os.replace(temp_path, target_path)
+
+
+class ReadPool:
+    """Lends read-only connections to a database or to its replica."""
+
+    def __init__(self, db_path, size=READ_POOL_SIZE, max_staleness=None):
+        """Initialize with the database path, idle connections to keep and
+        the seconds a replica may lag behind, None to read the database.
+        """
+        self.db_path = db_path
+        self.size = size
+        self.max_staleness = max_staleness
+        # (copied_at, connection) pairs, copied_at of the replica read
+        self._idle = []
+        # time.monotonic() of the last replica copy, None before the first
+        self._copied_at = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def replica_path(self):
+        """Path of the replica file."""
+        return f"{self.db_path}{REPLICA_SUFFIX}"
+
+    @contextmanager
+    def connection(self):
+        """Lend a connection, returning it to the pool afterwards."""
+        if self.max_staleness is not None:
+            self._refresh_if_stale()
+        copied_at, conn = self._take()
+        try:
+            yield conn
+        finally:
+            self._give_back(copied_at, conn)
+
+    def _take(self):
+        """Take an idle connection, or open one to the file read now."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            copied_at = self._copied_at
+        path = self.db_path if copied_at is None else self.replica_path
+        return copied_at, connect_read_only(path)
+
+    def _give_back(self, copied_at, conn):
+        """Keep a lent connection, or close it if not needed any more."""
+        with self._lock:
+            if copied_at == self._copied_at and len(self._idle) < self.size:
+                self._idle.append((copied_at, conn))
+                return
+        conn.close()
+
+    def _stale(self):
+        """Check if the replica is missing or older than max_staleness."""
+        copied_at = self._copied_at
+        return (copied_at is None
+                or time.monotonic() - copied_at >= self.max_staleness)
+
+    def _refresh_if_stale(self):
+        """Refresh a stale replica, unless another thread is refreshing it.
+
+        Until the first copy exists every reader waits for it, later ones
+        keep reading the current copy while it is refreshed.
+        """
+        if not self._stale():
+            return
+        if self._copied_at is not None and self._refresh_lock.locked():
+            return
+        with self._refresh_lock:
+            if self._stale():
+                self._copy()
+
+    def refresh(self):
+        """Copy the database to the replica now."""
+        with self._refresh_lock:
+            self._copy()
+
+    def _copy(self):
+        """Copy the database and close the connections to the old copy."""
+        copy_database(self.db_path, self.replica_path)
+        with self._lock:
+            self._copied_at = time.monotonic()
+        self.close()
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _copied_at, conn in idle:
+            conn.close()
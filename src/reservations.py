@@ -0,0 +1,128 @@
+"""Expiry of stock reservations (holds).
+
+A hold reserves a quantity of a product for an order until it is
+confirmed, released or expires. Availability checks ignore expired holds,
+so expiry is exact whenever the rows are removed. HoldTimer removes them
+at their deadlines, which it keeps in a min-heap in memory, instead of
+scanning the table for expired rows.
+"""
+import heapq
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Default seconds a hold lasts before it expires
+HOLD_SECONDS = 15 * 60
+
+
+class HoldTimer:
+    """Deletes expired holds at their deadlines from a background thread.
+
+    Deadlines are unix seconds kept in a heap of (expires_at, hold id).
+    Confirmed and released holds stay in the heap until their deadline
+    and are then skipped by the delete. The thread is started on the
+    first scheduled hold and loads the holds left by earlier runs.
+    """
+
+    def __init__(self, get_connection, clock=time.time):
+        """Initialize with a callable returning database connections."""
+        self._get_connection = get_connection
+        self.clock = clock
+        self._heap = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self):
+        """Return the number of deadlines waiting in the heap."""
+        return len(self._heap)
+
+    def start(self):
+        """Load the stored holds and start the thread if not running."""
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._load()
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run,
+                                            name='hold-timer', daemon=True)
+            self._thread.start()
+
+    def _load(self):
+        """Add the deadlines of all stored holds to the heap."""
+        conn = self._get_connection()
+        try:
+            rows = conn.execute("SELECT expires_at, id FROM reservations")
+            self._heap.extend(tuple(row) for row in rows)
+        finally:
+            conn.close()
+        heapq.heapify(self._heap)
+
+    def stop(self):
+        """Stop the thread and wait for it to finish."""
+        with self._condition:
+            thread, self._thread = self._thread, None
+            self._stopped = True
+            self._condition.notify()
+        if thread is not None:
+            thread.join()
+
+    def schedule(self, hold_id, expires_at):
+        """Schedule a hold to be deleted at expires_at."""
+        self.start()
+        with self._condition:
+            heapq.heappush(self._heap, (expires_at, hold_id))
+            if self._heap[0][1] == hold_id:
+                self._condition.notify()  # New earliest deadline
+
+    def _due(self, now):
+        """Pop the ids of holds whose deadline has passed."""
+        with self._condition:
+            ids = []
+            while self._heap and self._heap[0][0] <= now:
+                ids.append(heapq.heappop(self._heap)[1])
+            return ids
+
+    def reclaim(self):
+        """Delete the holds that are due, returning how many were deleted."""
+        now = self.clock()
+        ids = self._due(now)
+        if not ids:
+            return 0
+        conn = self._get_connection()
+        try:
+            placeholders = ', '.join('?' * len(ids))
+            cursor = conn.execute(
+                f"DELETE FROM reservations WHERE id IN ({placeholders})", ids
+            )
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def _timeout(self):
+        """Get the seconds until the earliest deadline, None if none."""
+        return self._heap[0][0] - self.clock() if self._heap else None
+
+    def _wait(self):
+        """Wait until the earliest deadline, return False once stopped."""
+        with self._condition:
+            timeout = self._timeout()
+            while not self._stopped and (timeout is None or timeout > 0):
+                self._condition.wait(timeout)
+                timeout = self._timeout()
+            return not self._stopped
+
+    def _run(self):
+        """Reclaim holds at their deadlines until stopped."""
+        while self._wait():
+            try:
+                self.reclaim()
+            except sqlite3.Error:
+                # The expired rows stay ignored, and are loaded again on
+                # the next start
+                logger.exception("Reclaiming expired holds failed")
+                time.sleep(1.0)
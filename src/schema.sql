@@ -1,31 +1,148 @@
 -- SQL Schema for Warehouse Manager Application
 -- This file contains the database schema for SQLite
+-- Quantities (capacity, balance, quantity) are INTEGER milli-units,
+-- see quantity.py
 
 -- Warehouses table
 CREATE TABLE IF NOT EXISTS warehouses (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT NOT NULL UNIQUE,
-    capacity REAL NOT NULL DEFAULT 0.0,
-    balance REAL NOT NULL DEFAULT 0.0,
+    capacity INTEGER NOT NULL DEFAULT 0,
+    balance INTEGER NOT NULL DEFAULT 0,
     type TEXT NOT NULL DEFAULT 'fruit',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    -- Incremented on every change, for compare-and-swap updates
+    version INTEGER NOT NULL DEFAULT 0
 );
 
--- Products table
+-- Product catalog, each product name is stored once
+CREATE TABLE IF NOT EXISTS catalog (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    default_quantity INTEGER
+);
+
+-- Index for case-insensitive prefix search of product names
+CREATE INDEX IF NOT EXISTS idx_catalog_name_nocase
+    ON catalog(name COLLATE NOCASE);
+
+-- Trigram index for fuzzy search of product names
+CREATE VIRTUAL TABLE IF NOT EXISTS catalog_fts USING fts5(
+    name, content='catalog', content_rowid='id', tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS catalog_fts_insert AFTER INSERT ON catalog BEGIN
+    INSERT INTO catalog_fts (rowid, name) VALUES (new.id, new.name);
+END;
+
+CREATE TRIGGER IF NOT EXISTS catalog_fts_delete AFTER DELETE ON catalog BEGIN
+    INSERT INTO catalog_fts (catalog_fts, rowid, name)
+    VALUES ('delete', old.id, old.name);
+END;
+
+-- Products table, products refer to the catalog by id
 CREATE TABLE IF NOT EXISTS products (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     warehouse_id INTEGER NOT NULL,
-    name TEXT NOT NULL,
-    quantity REAL NOT NULL DEFAULT 0.0,
+    product_id INTEGER NOT NULL,
+    quantity INTEGER NOT NULL DEFAULT 0,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (warehouse_id) REFERENCES warehouses(id) ON DELETE CASCADE,
-    UNIQUE(warehouse_id, name)
+    FOREIGN KEY (product_id) REFERENCES catalog(id),
+    UNIQUE(warehouse_id, product_id)
 );
 
 -- Index for faster product lookups by warehouse
 CREATE INDEX IF NOT EXISTS idx_products_warehouse_id ON products(warehouse_id);
 
+-- Covering index for per-product aggregation
+CREATE INDEX IF NOT EXISTS idx_products_product_id
+    ON products(product_id, quantity);
+
 -- Index for faster warehouse lookups by name
 CREATE INDEX IF NOT EXISTS idx_warehouses_name ON warehouses(name);
+
+-- Trigram index for substring search of warehouse names, see search.py
+CREATE VIRTUAL TABLE IF NOT EXISTS warehouses_fts USING fts5(
+    name, content='warehouses', content_rowid='id', tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS warehouses_fts_insert
+AFTER INSERT ON warehouses BEGIN
+    INSERT INTO warehouses_fts (rowid, name) VALUES (new.id, new.name);
+END;
+
+CREATE TRIGGER IF NOT EXISTS warehouses_fts_delete
+AFTER DELETE ON warehouses BEGIN
+    INSERT INTO warehouses_fts (warehouses_fts, rowid, name)
+    VALUES ('delete', old.id, old.name);
+END;
+
+CREATE TRIGGER IF NOT EXISTS warehouses_fts_update
+AFTER UPDATE OF name ON warehouses BEGIN
+    INSERT INTO warehouses_fts (warehouses_fts, rowid, name)
+    VALUES ('delete', old.id, old.name);
+    INSERT INTO warehouses_fts (rowid, name) VALUES (new.id, new.name);
+END;
+
+-- Capacity history, see history.py. level is the bucket size in seconds
+-- (1 for raw samples), ts the bucket start in unix seconds
+CREATE TABLE IF NOT EXISTS capacity_history (
+    level INTEGER NOT NULL,
+    warehouse_id INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    samples INTEGER NOT NULL,
+    balance_sum INTEGER NOT NULL,
+    balance_min INTEGER NOT NULL,
+    balance_max INTEGER NOT NULL,
+    capacity INTEGER NOT NULL,
+    PRIMARY KEY (level, warehouse_id, ts)
+) WITHOUT ROWID;
+
+-- Index for time range reads over all warehouses and for compaction
+CREATE INDEX IF NOT EXISTS idx_capacity_history_ts
+    ON capacity_history(level, ts);
+
+-- Time up to which each history level has been rolled up
+CREATE TABLE IF NOT EXISTS history_watermarks (
+    level INTEGER PRIMARY KEY,
+    ts INTEGER NOT NULL
+);
+
+-- Stock reserved for orders until confirmed, released or expired, see
+-- reservations.py. expires_at is in unix seconds
+CREATE TABLE IF NOT EXISTS reservations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    warehouse_id INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (warehouse_id) REFERENCES warehouses(id) ON DELETE CASCADE,
+    FOREIGN KEY (product_id) REFERENCES catalog(id)
+);
+
+-- Index for summing the holds of a product
+CREATE INDEX IF NOT EXISTS idx_reservations_product
+    ON reservations(warehouse_id, product_id, expires_at, quantity);
+
+-- Threshold alert rules, see alerts.py. threshold is a fill ratio or a
+-- product quantity in milli-units; firing holds whether the condition
+-- held when the warehouse last changed
+CREATE TABLE IF NOT EXISTS alert_rules (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    warehouse_id INTEGER NOT NULL,
+    product_id INTEGER,
+    kind TEXT NOT NULL,
+    threshold INTEGER NOT NULL,
+    firing INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (warehouse_id) REFERENCES warehouses(id) ON DELETE CASCADE,
+    FOREIGN KEY (product_id) REFERENCES catalog(id)
+);
+
+-- Index evaluating just the rules of a changed warehouse
+CREATE INDEX IF NOT EXISTS idx_alert_rules_warehouse
+    ON alert_rules(warehouse_id);
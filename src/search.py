@@ -0,0 +1,141 @@
+"""Full-text and faceted search over warehouses and their products.
+
+Each word of a query must occur in the name of a warehouse or of one of
+its products. Words of three or more characters are looked up in the
+trigram indexes warehouses_fts and catalog_fts, which match substrings
+case-insensitively; shorter words fall back to a LIKE scan. Results can
+be filtered by facet values and come with the number of matching
+warehouses for each facet value, so a client can narrow a search down.
+"""
+
+# Facets results are counted and can be filtered by
+FACETS = ('type', 'fill', 'product')
+# Values of the fill facet, FILL_BUCKETS[i] is below (i + 1) / 4 full
+FILL_BUCKETS = ('0-25%', '25-50%', '50-75%', '75-100%', 'full')
+# Default number of results per page
+PER_PAGE = 20
+
+_FILL = """CASE WHEN w.balance >= w.capacity THEN 4
+                ELSE w.balance * 4 / w.capacity END"""
+# SQL condition of each facet filter, with the value as the parameter
+_FILTERS = {
+    'type': "w.type = ?",
+    'fill': f"{_FILL} = ?",
+    'product': """w.id IN (
+        SELECT warehouse_id FROM products
+        WHERE product_id = (SELECT id FROM catalog WHERE name = ?))""",
+}
+# Warehouses whose name or a product name matches the two parameters
+_MATCH_INDEXED = """w.id IN (
+    SELECT rowid FROM warehouses_fts WHERE warehouses_fts MATCH ?
+    UNION
+    SELECT warehouse_id FROM products WHERE product_id IN (
+        SELECT rowid FROM catalog_fts WHERE catalog_fts MATCH ?))"""
+_MATCH_SCAN = """w.id IN (
+    SELECT id FROM warehouses WHERE name LIKE ? ESCAPE '\\'
+    UNION
+    SELECT warehouse_id FROM products WHERE product_id IN (
+        SELECT id FROM catalog WHERE name LIKE ? ESCAPE '\\'))"""
+# Condition of a search without words or filters
+_ALL = '1'
+_LIKE_ESCAPES = str.maketrans({'\\': '\\\\', '%': '\\%', '_': '\\_'})
+
+
+def _word_condition(word):
+    """Get the SQL condition and parameter matching one query word."""
+    if len(word) >= 3:
+        return _MATCH_INDEXED, '"' + word.replace('"', '""') + '"'
+    return _MATCH_SCAN, f"%{word.translate(_LIKE_ESCAPES)}%"
+
+
+def _filter_value(facet, value):
+    """Get the SQL parameter of a facet filter, validating the facet."""
+    if facet not in _FILTERS:
+        raise ValueError(f"Unknown facet: {facet}")
+    if facet == 'fill':
+        if value not in FILL_BUCKETS:
+            raise ValueError(f"Unknown fill bucket: {value}")
+        return FILL_BUCKETS.index(value)
+    return value
+
+
+def _where(query, filters):
+    """Build the WHERE clause and parameters of a search."""
+    conditions, params = [_ALL], []
+    for word in query.split():
+        condition, param = _word_condition(word)
+        conditions.append(condition)
+        params += [param, param]
+    for facet, value in filters.items():
+        if value:
+            params.append(_filter_value(facet, value))
+            conditions.append(_FILTERS[facet])
+    return ' AND '.join(conditions), params
+
+
+def _product_counts(where):
+    """Get SQL counting the matching warehouses holding each product."""
+    if where == _ALL:
+        # The covering product index answers this without the warehouses
+        return "SELECT product_id, COUNT(*) AS count FROM products" \
+               " GROUP BY product_id"
+    # CROSS JOIN reads the products of just the matching warehouses
+    return """SELECT p.product_id, COUNT(*) AS count
+              FROM matched m CROSS JOIN products p ON p.warehouse_id = m.id
+              GROUP BY p.product_id"""
+
+
+def _count_facets(conn, where, params):
+    """Count the matching warehouses by each facet value."""
+    counts = {facet: {} for facet in FACETS}
+    cursor = conn.execute(
+        f"""WITH matched AS MATERIALIZED (
+                SELECT w.id, w.type, {_FILL} AS fill
+                FROM warehouses w WHERE {where}
+            )
+            SELECT 'type', type, COUNT(*) FROM matched GROUP BY type
+            UNION ALL
+            SELECT 'fill', fill, COUNT(*) FROM matched GROUP BY fill
+            UNION ALL
+            SELECT 'product', c.name, t.count FROM ({_product_counts(where)}) t
+            JOIN catalog c ON c.id = t.product_id""",
+        params
+    )
+    for facet, value, count in cursor:
+        counts[facet][FILL_BUCKETS[value] if facet == 'fill' else value] = count
+    return counts
+
+
+def sort_facets(counts):
+    """Order the values of facet counts for display.
+
+    Types are sorted by name, fill buckets from empty to full and products
+    by descending count.
+    """
+    return {
+        'type': dict(sorted(counts['type'].items())),
+        'fill': {bucket: counts['fill'][bucket]
+                 for bucket in FILL_BUCKETS if bucket in counts['fill']},
+        'product': dict(sorted(counts['product'].items(),
+                               key=lambda item: (-item[1], item[0]))),
+    }
+
+
+def search_warehouses(conn, query='', filters=None, limit=PER_PAGE,
+                      offset=0):
+    """Search warehouses by name and product names.
+
+    filters maps facets to the value the results must have, empty values
+    are ignored. Raises ValueError for unknown facets or fill buckets.
+    Returns a dict with the total number of matches, the warehouse rows
+    from offset on in id order and the facet counts (see sort_facets).
+    """
+    where, params = _where(query, filters or {})
+    rows = conn.execute(
+        f"SELECT w.* FROM warehouses w WHERE {where}"
+        " ORDER BY w.id LIMIT ? OFFSET ?",
+        params + [limit, offset]
+    ).fetchall()
+    facets = sort_facets(_count_facets(conn, where, params))
+    return {'total': sum(facets['type'].values()), 'rows': rows,
+            'facets': facets}
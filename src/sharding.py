@@ -0,0 +1,708 @@
+"""Warehouse storage spread over several SQLite files (shards).
+
+A single database file serializes all writers. ShardedWarehouseManager
+keeps each warehouse in one of N shard databases, chosen by its id, so
+writes to warehouses on different shards do not wait for each other.
+A small directory database allocates the ids and enforces unique names
+over all shards. Queries over all warehouses are fanned out to the
+shards in parallel threads and their results merged.
+"""
+import contextvars
+import heapq
+import os
+import sqlite3
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from operator import itemgetter
+from catalog import rank_by_similarity
+from cross_shard import JOURNAL_SCHEMA, CrossShardWrites
+from history import MAX_POINTS
+from quantity import from_units, to_units
+from replica import connect_read_only
+from reservations import HOLD_SECONDS
+from search import FACETS, PER_PAGE, sort_facets
+from snapshot import import_snapshot
+from warehouse_manager import (VERIFY_BATCH_SIZE, WarehouseManager,
+                               check_batch_size, default_db_path)
+
+# Default number of shard databases
+SHARDS = 4
+
+# Journal ids of the cross-shard changes applied to a shard
+APPLIED_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS applied_changes (
+        id INTEGER PRIMARY KEY
+    )"""
+
+# Warehouse ids and names of all shards. NOCASE matches the LOWER(name)
+# comparison of WarehouseManager for the ASCII names it folds.
+DIRECTORY_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS directory (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE COLLATE NOCASE
+    )"""
+
+
+def shard_paths(db_path, count):
+    """Get the shard database paths next to a directory database path.
+
+    warehouse.db gets the shards warehouse.shard0.db, warehouse.shard1.db
+    and so on.
+    """
+    root, extension = os.path.splitext(db_path)
+    return [f"{root}.shard{number}{extension}" for number in range(count)]
+
+
+class WarehouseShard(WarehouseManager):
+    """WarehouseManager of one shard, storing warehouses under given ids.
+
+    Also takes part in changes spanning shards, see cross_shard.py.
+    """
+
+    def _init_db(self, conn):
+        """Initialize the schema and the table of applied changes."""
+        super()._init_db(conn)
+        conn.execute(APPLIED_SCHEMA)
+        conn.commit()
+
+    def insert_warehouse(self, warehouse_id, name, capacity, warehouse_type):
+        """Create a warehouse under an id allocated by the directory.
+
+        Returns the id, or None if the name or id is taken in the shard.
+        """
+        return self._insert_warehouse(warehouse_id, name, capacity,
+                                      warehouse_type)
+
+    def begin_write(self):
+        """Open a connection holding the write lock of the shard."""
+        conn = self._get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    def warehouse_row(self, conn, warehouse_id):
+        """Read a warehouse row on conn, None if missing."""
+        return self._get_warehouse(conn, warehouse_id)
+
+    def available_units(self, conn, warehouse_id, product_name):
+        """Read the unreserved stock of a product in milli-units on conn."""
+        row = self._availability(conn, warehouse_id, product_name)
+        return row['available'] if row else 0
+
+    def applied(self, conn, journal_id):
+        """Check on conn if the change of a journal id has been applied."""
+        return conn.execute("SELECT 1 FROM applied_changes WHERE id = ?",
+                            (journal_id,)).fetchone() is not None
+
+    def apply_legs(self, conn, journal_id, legs, oldest_id):
+        """Apply (warehouse id, product name, milli-units) legs on conn.
+
+        The legs were checked while the shard was locked, so they are
+        applied as they are, and journal_id is recorded as applied in the
+        same transaction. The records of journal ids below oldest_id,
+        which are no longer pending, are deleted.
+        """
+        deltas = Counter()
+        for warehouse_id, product_name, units in legs:
+            self._apply_leg(conn, warehouse_id, product_name, units)
+            deltas[warehouse_id] += units
+        self._apply_deltas(conn, {warehouse_id: self._get_warehouse(
+            conn, warehouse_id
+        ) for warehouse_id in deltas}, deltas)
+        conn.execute("DELETE FROM applied_changes WHERE id < ?", (oldest_id,))
+        conn.execute("INSERT INTO applied_changes (id) VALUES (?)",
+                     (journal_id,))
+
+    def _apply_leg(self, conn, warehouse_id, product_name, units):
+        """Add units (taken if negative) of a product to a warehouse."""
+        conn.execute("INSERT OR IGNORE INTO catalog (name) VALUES (?)",
+                     (product_name,))
+        product_id = conn.execute("SELECT id FROM catalog WHERE name = ?",
+                                  (product_name,)).fetchone()['id']
+        if units < 0:
+            self._take_stock(conn, warehouse_id, product_id, -units)
+        else:
+            self._upsert_product(conn, warehouse_id, product_id, units)
+
+
+class ShardedWarehouseManager:  # pylint: disable=too-many-public-methods
+    """Manages warehouses spread over shard databases by id.
+
+    Warehouse id n is stored in shard n % len(shards). Single warehouse
+    calls are routed to their shard; get_all_warehouses, product_totals
+    and verify_and_repair query all shards in parallel. The directory
+    database at db_path holds the ids and names of all warehouses. No
+    database is opened before it is first used.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, db_path=None, shards=SHARDS):
+        """Initialize the directory and shard managers."""
+        self.db_path = db_path if db_path is not None else default_db_path()
+        self.shards = [WarehouseShard(path)
+                       for path in shard_paths(self.db_path, shards)]
+        self.catalog = ShardedCatalog(self.shards)
+        self.history = ShardedHistory(self)
+        self.alerts = ShardedAlerts(self)
+        self._directory_ready, self._directory_lock = False, threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=shards,
+                                            thread_name_prefix='shard')
+        self._cross_shard = CrossShardWrites(self.shards, self.shard_for,
+                                             self.db_path,
+                                             self._get_directory)
+        # Complete the changes a stopped process left half committed
+        self._cross_shard.complete()
+
+    @property
+    def trace_callback(self):
+        """Callable receiving each SQL statement executed by the shards."""
+        return self.shards[0].trace_callback
+
+    @trace_callback.setter
+    def trace_callback(self, callback):
+        for shard in self.shards:
+            shard.trace_callback = callback
+
+    def close(self):
+        """Stop the threads querying shards, holds and alerts; close reads."""
+        self._executor.shutdown()
+        for shard in self.shards:
+            shard.holds.stop()
+            shard.reads.close()
+        self.alerts.dispatcher.stop()
+
+    def shard_for(self, warehouse_id):
+        """Get the shard storing a warehouse id."""
+        return self.shards[warehouse_id % len(self.shards)]
+
+    def fan_out(self, function):
+        """Call function(shard) for all shards in parallel.
+
+        Each call runs in a copy of the caller's context, so context
+        variables (like the statements of a profiled request) follow it.
+        Returns the results in shard order.
+        """
+        contexts = [contextvars.copy_context() for _ in self.shards]
+        return list(self._executor.map(
+            lambda context, shard: context.run(function, shard),
+            contexts, self.shards
+        ))
+
+    def _get_directory(self):
+        """Get a connection to the directory database."""
+        conn = sqlite3.connect(self.db_path)
+        if not self._directory_ready:
+            with self._directory_lock:
+                conn.execute(DIRECTORY_SCHEMA)
+                conn.execute(JOURNAL_SCHEMA)
+                conn.commit()
+                self._directory_ready = True
+        return conn
+
+    def _directory_write(self, query, params):
+        """Run a write on the directory, returning its cursor.
+
+        Returns None if it violates the unique names.
+        """
+        conn = self._get_directory()
+        try:
+            with conn:
+                return conn.execute(query, params)
+        except sqlite3.IntegrityError:
+            return None
+        finally:
+            conn.close()
+
+    def _directory_name(self, warehouse_id):
+        """Get the name of a warehouse in the directory, None if missing."""
+        conn = self._get_directory()
+        try:
+            row = conn.execute("SELECT name FROM directory WHERE id = ?",
+                               (warehouse_id,)).fetchone()
+            return row[0] if row else None
+        finally:
+            conn.close()
+
+    def name_exists(self, name, exclude_id=None):
+        """Check if a warehouse name already exists on any shard."""
+        conn = self._get_directory()
+        try:
+            row = conn.execute(
+                "SELECT 1 FROM directory WHERE name = ? AND id IS NOT ?",
+                (name, exclude_id)
+            ).fetchone()
+            return row is not None
+        finally:
+            conn.close()
+
+    def create_warehouse(self, name, capacity, warehouse_type='fruit'):
+        """Create a new warehouse with given name, capacity and type.
+
+        The name and id are reserved in the directory first, so the name
+        is unique over all shards.
+        """
+        cursor = self._directory_write(
+            "INSERT INTO directory (name) VALUES (?)", (name,)
+        )
+        if cursor is None:
+            return None  # Name already exists
+        warehouse_id = cursor.lastrowid
+        created = self.shard_for(warehouse_id).insert_warehouse(
+            warehouse_id, name, capacity, warehouse_type
+        )
+        if created is None:
+            self._directory_write("DELETE FROM directory WHERE id = ?",
+                                  (warehouse_id,))
+        return created
+
+    def get_warehouse(self, warehouse_id, projection='full'):
+        """Get a warehouse by ID, see WarehouseManager.get_warehouse."""
+        return self.shard_for(warehouse_id).get_warehouse(warehouse_id,
+                                                          projection)
+
+    def get_products(self, warehouse_id):
+        """Get the products of a warehouse as a name to quantity dict."""
+        return self.shard_for(warehouse_id).get_products(warehouse_id)
+
+    def get_all_warehouses(self):
+        """Get all warehouses of all shards ordered by id."""
+        per_shard = self.fan_out(lambda shard: shard.get_all_warehouses())
+        return list(heapq.merge(*per_shard, key=itemgetter('id')))
+
+    def iter_warehouses(self):
+        """Iterate over the warehouses of all shards in id order."""
+        return heapq.merge(*(shard.iter_warehouses() for shard in self.shards),
+                           key=itemgetter('id'))
+
+    def product_totals(self):
+        """Get the total quantity of each product over all shards."""
+        totals = {}
+        for shard_totals in self.fan_out(lambda shard: shard.product_totals()):
+            for name, total in shard_totals.items():
+                # Sum exact milli-units, not floats
+                totals[name] = totals.get(name, 0) + to_units(total)
+        return {name: from_units(total)
+                for name, total in sorted(totals.items())}
+
+    def search_warehouses(self, query='', filters=None, page=1,
+                          per_page=PER_PAGE):
+        """Search all shards, merging their matches in id order.
+
+        Each shard returns its first page * per_page matches, of which
+        the requested page is taken after the merge.
+        """
+        found = self.fan_out(lambda shard: shard.search_warehouses(
+            query, filters, 1, page * per_page
+        ))
+        counts = {facet: Counter() for facet in FACETS}
+        for shard_found in found:
+            for facet, values in shard_found['facets'].items():
+                counts[facet].update(values)
+        warehouses = heapq.merge(*(shard_found['warehouses']
+                                   for shard_found in found),
+                                 key=itemgetter('id'))
+        return {'total': sum(shard_found['total'] for shard_found in found),
+                'warehouses': list(islice(warehouses, (page - 1) * per_page,
+                                          page * per_page)),
+                'facets': sort_facets(counts)}
+
+    def export_snapshot(self, path, compress=False):
+        """Write a snapshot of each shard, see WarehouseManager.
+
+        Shard n is written to the nth of shard_paths(path, shards), e.g.
+        snap.shard0.bin for snap.bin, the shards in parallel. Each
+        snapshot is consistent, but a change made meanwhile may be in the
+        snapshots of some shards only. The directory is rebuilt from the
+        shards by import_sharded_snapshot. Returns a dict of table ->
+        number of rows of all shards.
+        """
+        paths = dict(zip(self.shards, shard_paths(path, len(self.shards))))
+        counts = Counter()
+        for shard_counts in self.fan_out(
+                lambda shard: shard.export_snapshot(paths[shard], compress)):
+            counts.update(shard_counts)
+        return dict(counts)
+
+    def find_drift(self):
+        """Find warehouses whose balance differs from their products' sum."""
+        return self.verify_and_repair()['mismatches']
+
+    def verify_and_repair(self, repair=False, batch_size=VERIFY_BATCH_SIZE,
+                          pause=0.0):
+        """Verify the balances of all shards in parallel.
+
+        See WarehouseManager.verify_and_repair, the reports of the shards
+        are combined into one.
+        """
+        check_batch_size(batch_size)
+        report = {'checked': 0, 'mismatches': {}, 'repaired': 0}
+        for shard_report in self.fan_out(
+                lambda shard: shard.verify_and_repair(repair, batch_size,
+                                                      pause)):
+            report['checked'] += shard_report['checked']
+            report['mismatches'].update(shard_report['mismatches'])
+            report['repaired'] += shard_report['repaired']
+        return report
+
+    def update_warehouse(self, warehouse_id, name, capacity,
+                         expected_version=None):
+        """Update warehouse name and capacity.
+
+        A new name is reserved in the directory before the shard is
+        updated, and released again if the update fails.
+        """
+        old_name = self._directory_name(warehouse_id)
+        if old_name is None:
+            return False, "Warehouse not found"
+        if self._directory_write("UPDATE directory SET name = ? WHERE id = ?",
+                                 (name, warehouse_id)) is None:
+            return False, "Name already exists"
+        success, message = self.shard_for(warehouse_id).update_warehouse(
+            warehouse_id, name, capacity, expected_version
+        )
+        if not success:
+            self._directory_write("UPDATE directory SET name = ? WHERE id = ?",
+                                  (old_name, warehouse_id))
+        return success, message
+
+    def add_product(self, warehouse_id, product_name, quantity,
+                    expected_version=None):
+        """Add a product to a warehouse, see WarehouseManager.add_product."""
+        return self.shard_for(warehouse_id).add_product(
+            warehouse_id, product_name, quantity, expected_version
+        )
+
+    def remove_product(self, warehouse_id, product_name,
+                       expected_version=None):
+        """Remove a product, see WarehouseManager.remove_product."""
+        return self.shard_for(warehouse_id).remove_product(
+            warehouse_id, product_name, expected_version
+        )
+
+    def remove_products(self, warehouse_id, product_names,
+                        expected_version=None):
+        """Remove several products, see WarehouseManager.remove_products."""
+        return self.shard_for(warehouse_id).remove_products(
+            warehouse_id, product_names, expected_version
+        )
+
+    def move_products(self, source_id, target_id, product_names,
+                      expected_version=None):
+        """Move the stock of products, see WarehouseManager.move_products.
+
+        Moves between shards are made atomic by cross_shard.py.
+        """
+        shard = self.shard_for(source_id)
+        if source_id != target_id and shard is not self.shard_for(target_id):
+            return self._cross_shard.move_products(
+                source_id, target_id, product_names, expected_version
+            )
+        return shard.move_products(source_id, target_id, product_names,
+                                   expected_version)
+
+    def transfer(self, source_id, target_id, product_name, quantity):
+        """Move a quantity of a product, see WarehouseManager.transfer."""
+        return self.transfer_many([(source_id, target_id, product_name,
+                                    quantity)])
+
+    def transfer_many(self, transfers):
+        """Make transfers, see WarehouseManager.transfer_many.
+
+        Batches spanning shards are made atomic by cross_shard.py.
+        """
+        shards = {self.shard_for(warehouse_id) for transfer in transfers
+                  for warehouse_id in transfer[:2]}
+        if len(shards) > 1:
+            return self._cross_shard.transfer_many(transfers)
+        if not shards:
+            return False, "Nothing to transfer"
+        return shards.pop().transfer_many(transfers)
+
+    def available(self, warehouse_id, product_name):
+        """Get the quantity of a product not held by reservations."""
+        return self.shard_for(warehouse_id).available(warehouse_id,
+                                                      product_name)
+
+    def reserve(self, warehouse_id, product_name, quantity, ttl=HOLD_SECONDS):
+        """Hold a quantity of a product, see WarehouseManager.reserve.
+
+        The reservation id encodes the shard, see global_id().
+        """
+        shard = self.shard_for(warehouse_id)
+        local_id = shard.reserve(warehouse_id, product_name, quantity, ttl)
+        if local_id is None:
+            return None
+        return self.global_id(local_id, warehouse_id)
+
+    def global_id(self, local_id, warehouse_id):
+        """Encode the shard of a warehouse in a shard-local id.
+
+        Shard-local reservation and alert rule ids become
+        local id * N + shard.
+        """
+        return local_id * len(self.shards) + warehouse_id % len(self.shards)
+
+    def local_id(self, global_id):
+        """Get the shard and shard-local id of an id from global_id()."""
+        local_id, index = divmod(global_id, len(self.shards))
+        return self.shards[index], local_id
+
+    def confirm(self, reservation_id):
+        """Pick the held stock, see WarehouseManager.confirm."""
+        shard, local_id = self.local_id(reservation_id)
+        return shard.confirm(local_id)
+
+    def release(self, reservation_id):
+        """Release a hold, see WarehouseManager.release."""
+        shard, local_id = self.local_id(reservation_id)
+        return shard.release(local_id)
+
+    def delete_warehouses(self, warehouse_ids):
+        """Delete several warehouses, in one transaction per shard.
+
+        Returns the number of warehouses deleted.
+        """
+        ids = set(warehouse_ids)
+        deleted = self.fan_out(lambda shard: shard.delete_warehouses(
+            [wh_id for wh_id in ids if self.shard_for(wh_id) is shard]
+        ))
+        conn = self._get_directory()
+        try:
+            with conn:
+                conn.executemany("DELETE FROM directory WHERE id = ?",
+                                 [(wh_id,) for wh_id in ids])
+        finally:
+            conn.close()
+        return sum(deleted)
+
+    def delete_warehouse(self, warehouse_id):
+        """Delete a warehouse and release its name."""
+        deleted = self.shard_for(warehouse_id).delete_warehouse(warehouse_id)
+        self._directory_write("DELETE FROM directory WHERE id = ?",
+                              (warehouse_id,))
+        return deleted
+
+
+class ShardedCatalog:
+    """Product catalog searching the catalogs of all shards.
+
+    Each shard interns the product names of its own warehouses; the
+    default products are in every shard.
+    """
+
+    def __init__(self, shards):
+        """Initialize with the shard managers."""
+        self._shards = shards
+
+    def suggested(self):
+        """Get products with a suggested quantity as a name to qty dict."""
+        return self._shards[0].catalog.suggested()
+
+    def search(self, prefix, limit=20):
+        """Find product names starting with prefix on any shard."""
+        names = set()
+        for shard in self._shards:
+            names.update(shard.catalog.search(prefix, limit))
+        return sorted(names, key=str.lower)[:limit]
+
+    def fuzzy_search(self, term, limit=20):
+        """Find product names similar to term on any shard."""
+        names = set()
+        for shard in self._shards:
+            names.update(shard.catalog.fuzzy_search(term, limit))
+        return rank_by_similarity(term, sorted(names))[:limit]
+
+
+class ShardedAlerts:
+    """Alert rules of all shards, see alerts.AlertEngine.
+
+    Rule ids encode their shard like reservation ids. The shards share
+    one dispatcher, so alerts of all shards go to the same sinks.
+    """
+
+    def __init__(self, manager):
+        """Initialize with the sharded manager, sharing a dispatcher."""
+        self._manager = manager
+        self.dispatcher = manager.shards[0].alerts.dispatcher
+        for shard in manager.shards:
+            shard.alerts.dispatcher = self.dispatcher
+
+    def add_rule(self, warehouse_id, kind, threshold, product_name=None):
+        """Add a rule to a warehouse, see AlertEngine.add_rule."""
+        local_id = self._manager.shard_for(warehouse_id).alerts.add_rule(
+            warehouse_id, kind, threshold, product_name
+        )
+        if local_id is None:
+            return None
+        return self._manager.global_id(local_id, warehouse_id)
+
+    def remove_rule(self, rule_id):
+        """Remove a rule, returning False if it does not exist."""
+        shard, local_id = self._manager.local_id(rule_id)
+        return shard.alerts.remove_rule(local_id)
+
+    def rules(self, warehouse_id=None):
+        """Get the rules of a warehouse, or of all warehouses, as dicts."""
+        shards = self._manager.shards
+        if warehouse_id is not None:
+            shards = [self._manager.shard_for(warehouse_id)]
+        rules = [
+            dict(rule, id=self._manager.global_id(rule['id'],
+                                                  rule['warehouse_id']))
+            for shard in shards for rule in shard.alerts.rules(warehouse_id)
+        ]
+        return sorted(rules, key=itemgetter('warehouse_id', 'id'))
+
+
+class ShardedHistory:
+    """Capacity history of all shards, see history.CapacityHistory."""
+
+    def __init__(self, manager):
+        """Initialize with the sharded manager."""
+        self._manager = manager
+
+    def _histories(self):
+        """Get the histories of the shards."""
+        return [shard.history for shard in self._manager.shards]
+
+    @property
+    def clock(self):
+        """Callable returning the current unix time of the histories."""
+        return self._histories()[0].clock
+
+    @clock.setter
+    def clock(self, clock):
+        for history in self._histories():
+            history.clock = clock
+
+    def compact(self):
+        """Compact the history of every shard."""
+        self._manager.fan_out(lambda shard: shard.history.compact())
+
+    def query(self, start, end, warehouse_ids=None, max_points=MAX_POINTS):
+        """Get the history between start and end from the shards.
+
+        Only the shards of the given warehouse ids are queried.
+        """
+        shards = self._manager.shards
+        if warehouse_ids is not None:
+            shards = {self._manager.shard_for(warehouse_id)
+                      for warehouse_id in warehouse_ids}
+        history = {}
+        for shard in shards:
+            history.update(shard.history.query(start, end, warehouse_ids,
+                                               max_points))
+        return history
+
+    def start_compactor(self, interval):
+        """Start a background compactor for every shard."""
+        for history in self._histories():
+            history.start_compactor(interval)
+
+    def stop_compactor(self):
+        """Stop the background compactors."""
+        for history in self._histories():
+            history.stop_compactor()
+
+
+def import_sharded_snapshot(path, db_path, shards=SHARDS):
+    """Create sharded databases at db_path from a sharded snapshot at path.
+
+    The snapshots of the shards, written by export_snapshot of a
+    ShardedWarehouseManager with as many shards, are imported into the
+    shard databases and the directory is rebuilt from their warehouses.
+    Raises FileExistsError if any of the databases exists and ValueError
+    if the snapshot is of another number of shards; nothing is left
+    behind then. Returns a dict of table -> number of rows of all shards.
+    """
+    snapshots, databases = _import_paths(path, db_path, shards)
+    try:
+        counts = _import_shards(snapshots, databases)
+        _build_directory(db_path, databases)
+    except BaseException:
+        _remove_existing((db_path, *databases))
+        raise
+    return counts
+
+
+def _import_paths(path, db_path, shards):
+    """Get the paths of the shard snapshots and databases of an import.
+
+    Raises ValueError if there are snapshots of more shards and
+    FileExistsError if any of the databases exists.
+    """
+    snapshots = shard_paths(path, shards + 1)
+    if os.path.exists(snapshots.pop()):
+        raise ValueError(f"{path} is a snapshot of more than {shards} shards")
+    databases = shard_paths(db_path, shards)
+    existing = [database for database in (db_path, *databases)
+                if os.path.exists(database)]
+    if existing:
+        raise FileExistsError(f"{existing[0]} already exists")
+    return snapshots, databases
+
+
+def _remove_existing(paths):
+    """Remove the files of paths that exist."""
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _import_shards(snapshots, databases):
+    """Import each shard snapshot, returning the rows of all shards."""
+    counts = Counter()
+    for number, (snapshot, database) in enumerate(zip(snapshots, databases)):
+        counts.update(import_snapshot(snapshot, database))
+        conn = connect_read_only(database)
+        try:
+            misplaced = conn.execute(
+                "SELECT COUNT(*) FROM warehouses WHERE id % ? != ?",
+                (len(databases), number)
+            ).fetchone()[0]
+        finally:
+            conn.close()
+        if misplaced:
+            raise ValueError(f"{snapshot} is not a snapshot of shard "
+                             f"{number} of {len(databases)}")
+    return dict(counts)
+
+
+def _build_directory(db_path, databases):
+    """Create the directory of the warehouses in the shard databases.
+
+    Its id counter continues from the highest id any shard has used.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(DIRECTORY_SCHEMA)
+        last_id = max(_copy_directory_rows(conn, database)
+                      for database in databases)
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = 'directory'")
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) "
+                     "VALUES ('directory', ?)", (last_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _copy_directory_rows(conn, database):
+    """Add the warehouses of a shard database to the directory of conn.
+
+    Returns the highest warehouse id the shard has used.
+    """
+    shard = connect_read_only(database)
+    try:
+        rows = shard.execute("SELECT id, name FROM warehouses").fetchall()
+        last_id = shard.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'warehouses'"
+        ).fetchone()
+    finally:
+        shard.close()
+    try:
+        conn.executemany("INSERT INTO directory (id, name) VALUES (?, ?)",
+                         [tuple(row) for row in rows])
+    except sqlite3.IntegrityError as error:
+        raise ValueError("A warehouse name is in several shards") from error
+    return last_id[0] if last_id else 0
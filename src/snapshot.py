@@ -0,0 +1,342 @@
+"""Compact binary snapshots of the full warehouse state.
+
+A snapshot holds the catalog, warehouses and products (plus the
+AUTOINCREMENT counters) of a database in a columnar format:
+
+    magic            8 bytes, b'WHSNAP' and the format version
+    header           u32 length + JSON: schema version, compression, tables
+    chunks           u8 table index, u32 row count, then for each column
+                     u8 has nulls, [validity block], data block(s)
+    end              u8 255
+
+Each block is u8 codec (0 raw, 1 zlib) + u64 length + payload. Integer
+columns are one block of little-endian int64 values; text columns are a
+block of u32 end offsets and a block of UTF-8 data. Validity blocks hold
+one byte per row, 0 for NULL.
+
+Export streams each table from SQLite in id order, chunk_rows rows at a
+time, inside one read transaction, so the snapshot is consistent and
+memory use bounded. Uncompressed snapshots are read zero-copy from a
+memory map: integer columns are memoryviews into the file and text is
+only decoded when accessed. Import bulk-loads a new database and creates
+the indexes and triggers after the data.
+"""
+import json
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import sys
+import zlib
+from array import array
+from collections.abc import Sequence
+from itertools import accumulate
+from migrations import SCHEMA_VERSION, read_schema, split_statements
+
+MAGIC = b'WHSNAP\x00\x01'
+# Rows per chunk, bounds the memory used by export and import
+CHUNK_ROWS = 65536
+# zlib level of compressed snapshots, favouring speed over size
+ZLIB_LEVEL = 1
+RAW, ZLIB = 0, 1
+_END = 255
+_BLOCK = struct.Struct('<BQ')
+_CHUNK = struct.Struct('<BI')
+
+# (table, columns as (name, 'int' or 'text')), in load order
+TABLES = (
+    ('catalog', (('id', 'int'), ('name', 'text'),
+                 ('default_quantity', 'int'))),
+    ('warehouses', (('id', 'int'), ('name', 'text'), ('capacity', 'int'),
+                    ('balance', 'int'), ('type', 'text'),
+                    ('created_at', 'text'), ('updated_at', 'text'),
+                    ('version', 'int'))),
+    ('products', (('id', 'int'), ('warehouse_id', 'int'),
+                  ('product_id', 'int'), ('quantity', 'int'),
+                  ('created_at', 'text'), ('updated_at', 'text'))),
+    # Loaded last, replacing the counters advanced by the inserts
+    ('sqlite_sequence', (('name', 'text'), ('seq', 'int'))),
+)
+# Schema statements run after the data is loaded
+_DEFERRED = re.compile(r'^\s*CREATE\s+(INDEX|TRIGGER)', re.IGNORECASE | re.M)
+
+
+def _write_block(out, data, codec):
+    """Write a block of bytes, compressed with zlib if codec is ZLIB."""
+    if codec == ZLIB:
+        data = zlib.compress(data, ZLIB_LEVEL)
+    out.write(_BLOCK.pack(codec, len(data)))
+    out.write(data)
+
+
+def _int_bytes(values):
+    """Encode integers (None as 0) as little-endian int64 bytes."""
+    ints = array('q', [0 if value is None else value for value in values])
+    if sys.byteorder == 'big':
+        ints.byteswap()
+    return ints.tobytes()
+
+
+def _text_blocks(values):
+    """Encode strings (None as empty) as u32 end offsets and UTF-8 data."""
+    encoded = [b'' if value is None else value.encode() for value in values]
+    offsets = array('I', accumulate(map(len, encoded), initial=0))
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    return [offsets.tobytes(), b''.join(encoded)]
+
+
+def _write_column(out, values, kind, codec):
+    """Write the values of a column of a chunk."""
+    has_nulls = None in values
+    out.write(bytes([has_nulls]))
+    if has_nulls:
+        _write_block(out, bytes(value is not None for value in values), codec)
+    blocks = _text_blocks(values) if kind == 'text' else [_int_bytes(values)]
+    for block in blocks:
+        _write_block(out, block, codec)
+
+
+def _export_table(conn, out, table_index, codec, chunk_rows):
+    """Stream a table to the snapshot in id order, returning its rows."""
+    table, columns = TABLES[table_index]
+    names = ', '.join(name for name, _kind in columns)
+    cursor = conn.execute(
+        f"SELECT {names} FROM {table} ORDER BY {columns[0][0]}"
+    )
+    rows = 0
+    chunk = cursor.fetchmany(chunk_rows)
+    while chunk:
+        out.write(_CHUNK.pack(table_index, len(chunk)))
+        for (_name, kind), values in zip(columns, zip(*chunk)):
+            _write_column(out, values, kind, codec)
+        rows += len(chunk)
+        chunk = cursor.fetchmany(chunk_rows)
+    return rows
+
+
+def export_snapshot(conn, path, compress=False, chunk_rows=CHUNK_ROWS):
+    """Write a snapshot of the database of conn to path.
+
+    The tables are read in one transaction. The snapshot is written to a
+    temporary file which then replaces path. Returns a dict of table ->
+    number of rows.
+    """
+    codec = ZLIB if compress else RAW
+    header = json.dumps({'schema_version': SCHEMA_VERSION,
+                         'compression': 'zlib' if compress else None,
+                         'tables': TABLES}).encode()
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as out:
+        out.write(MAGIC + struct.pack('<I', len(header)) + header)
+        counts = _export_tables(conn, out, codec, chunk_rows)
+        out.write(bytes([_END]))
+    os.replace(temp_path, path)
+    return counts
+
+
+def _export_tables(conn, out, codec, chunk_rows):
+    """Stream all tables in one read transaction, returning their rows."""
+    counts = {}
+    conn.execute("BEGIN")
+    try:
+        for index, (table, _columns) in enumerate(TABLES):
+            counts[table] = _export_table(conn, out, index, codec, chunk_rows)
+    finally:
+        conn.rollback()
+    return counts
+
+
+class TextColumn(Sequence):
+    """Text column of a chunk, decoding values only when accessed."""
+
+    def __init__(self, offsets, data, validity=None):
+        """Initialize with the end offsets, UTF-8 data and validity."""
+        self._offsets = offsets
+        self._data = data
+        self._validity = validity
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __iter__(self):
+        offsets, data, validity = self._offsets, self._data, self._validity
+        for index in range(len(offsets) - 1):
+            if validity is not None and not validity[index]:
+                yield None
+            else:
+                yield str(data[offsets[index]:offsets[index + 1]], 'utf-8')
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if self._validity is not None and not self._validity[index]:
+            return None
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return str(self._data[start:end], 'utf-8')
+
+
+class SnapshotReader:
+    """Reads the chunks of a snapshot file through a memory map.
+
+    Use as a context manager. Columns of uncompressed snapshots refer to
+    the mapped file, which stays mapped until they are released.
+    """
+
+    def __init__(self, path):
+        """Map the snapshot file and read its header."""
+        with open(path, 'rb') as snapshot_file:
+            self._mmap = mmap.mmap(snapshot_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        if bytes(self._view[:len(MAGIC)]) != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a warehouse snapshot")
+        length, = struct.unpack_from('<I', self._view, len(MAGIC))
+        self._position = len(MAGIC) + 4
+        self.header = json.loads(bytes(self._take(length)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Release the mapping, once no columns refer to it any more."""
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass  # Closed when the last column referring to it is freed
+
+    def _take(self, length):
+        """Return a view of the next length bytes."""
+        start = self._position
+        self._position += length
+        return self._view[start:self._position]
+
+    def _block(self, item_format='B'):
+        """Read a block as a memoryview of item_format items."""
+        codec, length = _BLOCK.unpack(self._take(_BLOCK.size))
+        data = self._take(length)
+        if codec == ZLIB:
+            data = memoryview(zlib.decompress(data))
+        if item_format != 'B' and sys.byteorder == 'big':
+            swapped = array(item_format, data.tobytes())
+            swapped.byteswap()
+            return memoryview(swapped)
+        return data.cast(item_format)
+
+    def _column(self, kind):
+        """Read the values of a column of a chunk."""
+        validity = self._block() if self._take(1)[0] else None
+        if kind == 'text':
+            offsets = self._block('I')
+            return TextColumn(offsets, self._block(), validity)
+        values = self._block('q')
+        if validity is None:
+            return values
+        return [value if valid else None
+                for value, valid in zip(values, validity)]
+
+    def chunks(self):
+        """Yield (table, {column: values}) for each chunk in the file."""
+        while True:
+            table_index = self._take(1)[0]
+            if table_index == _END:
+                return
+            self._position -= 1
+            table_index, _rows = _CHUNK.unpack(self._take(_CHUNK.size))
+            table, columns = self.header['tables'][table_index]
+            yield table, {name: self._column(kind) for name, kind in columns}
+
+
+def _split_schema():
+    """Split the schema into table statements and deferred statements."""
+    tables, deferred = [], []
+    for statement in split_statements(read_schema()):
+        (deferred if _DEFERRED.search(statement) else tables).append(statement)
+    return tables, deferred
+
+
+def _execute_all(conn, statements):
+    """Execute each of the statements."""
+    for statement in statements:
+        conn.execute(statement)
+
+
+def _load(conn, reader):
+    """Insert the chunks of a snapshot, returning rows per table."""
+    counts = {}
+    for table, columns in reader.chunks():
+        if table == 'sqlite_sequence' and table not in counts:
+            conn.execute("DELETE FROM sqlite_sequence")
+        placeholders = ', '.join('?' * len(columns))
+        cursor = conn.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)})"
+            f" VALUES ({placeholders})",
+            zip(*columns.values())
+        )
+        counts[table] = counts.get(table, 0) + cursor.rowcount
+        del columns  # Release the views into the mapped file
+    return counts
+
+
+def import_snapshot(path, db_path):
+    """Create a new database at db_path from the snapshot at path.
+
+    The tables are created first, the data is bulk-loaded in one
+    transaction and the indexes and triggers are created afterwards.
+    The database is built in a temporary file that then becomes db_path.
+    Raises FileExistsError if db_path exists. Returns a dict of table ->
+    number of rows.
+    """
+    if os.path.exists(db_path):
+        raise FileExistsError(f"{db_path} already exists")
+    temp_path = f"{db_path}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)  # Left by an interrupted import
+    with SnapshotReader(path) as reader:
+        _check_header(reader.header)
+        counts = _build(temp_path, reader)
+    os.replace(temp_path, db_path)
+    return counts
+
+
+def _check_header(header):
+    """Raise ValueError unless the snapshot has our schema.
+
+    The table and column names are used in SQL, so only ours are accepted.
+    """
+    if (header.get('schema_version') != SCHEMA_VERSION
+            or header.get('tables') != json.loads(json.dumps(TABLES))):
+        raise ValueError("Snapshot is of another schema version")
+
+
+def _build(db_path, reader):
+    """Create the database at db_path from the snapshot of reader."""
+    conn = sqlite3.connect(db_path)
+    try:
+        return _fill(conn, reader)
+    finally:
+        conn.close()
+
+
+def _fill(conn, reader):
+    """Create the schema around the loaded snapshot data."""
+    # A half-built temporary file is discarded anyway, skip durability
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    tables, deferred = _split_schema()
+    _execute_all(conn, tables)
+    counts = _load(conn, reader)
+    _execute_all(conn, deferred)
+    for index in ('catalog_fts', 'warehouses_fts'):
+        conn.execute(f"INSERT INTO {index} ({index}) VALUES ('rebuild')")
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+    return counts
@@ -0,0 +1,268 @@
+"""Unit tests for threshold alerts."""
+import unittest
+import threading
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from alerts import Alert, AlertDispatcher, SSESink, WebhookSink
+from app import create_app
+from warehouse_manager import ConflictError
+from tests.storage_modes import StorageModeTests
+
+ALERT = Alert(1, 2, 'fill_above', None, 0.5, 0.6, True)
+
+
+class RecordingSink:
+    """Sink keeping the alerts it receives."""
+
+    def __init__(self):
+        """Initialize without alerts."""
+        self.alerts = []
+
+    def send(self, alert):
+        """Keep an alert."""
+        self.alerts.append(alert)
+
+
+class AlertTests(StorageModeTests):
+    """Alert rule tests run against each storage mode."""
+
+    def setUp(self):
+        """Set up a warehouse and a sink recording its alerts."""
+        super().setUp()
+        self.sink = RecordingSink()
+        self.manager.alerts.dispatcher.sinks[:] = [self.sink]
+        self.wh_id = self.manager.create_warehouse("Test", 10.0)
+        self.manager.add_product(self.wh_id, "Apple", 4.0)
+
+    def flush(self):
+        """Write pending changes of a memory manager to the database."""
+        if hasattr(self.manager, 'flush'):
+            self.manager.flush()
+
+    def sent(self):
+        """Get and clear the alerts delivered since the last call."""
+        self.flush()
+        self.manager.alerts.dispatcher.wait()
+        alerts, self.sink.alerts = self.sink.alerts, []
+        return [(alert.kind, alert.value, alert.firing) for alert in alerts]
+
+    def test_fill_alerts_on_crossings_only(self):
+        """Test a fill rule alerts when crossed and crossed back."""
+        rule_id = self.manager.alerts.add_rule(self.wh_id, 'fill_above', 0.5)
+        self.manager.add_product(self.wh_id, "Pear", 1.0)
+        self.assertEqual(self.sent(), [])
+        self.manager.add_product(self.wh_id, "Pear", 1.0)
+        self.assertEqual(self.sent(), [('fill_above', 0.6, True)])
+        self.manager.add_product(self.wh_id, "Pear", 1.0)
+        self.assertEqual(self.sent(), [])
+        self.manager.remove_product(self.wh_id, "Apple")
+        self.assertEqual(self.sent(), [('fill_above', 0.3, False)])
+        self.assertEqual(self.manager.alerts.rules(self.wh_id), [{
+            'id': rule_id, 'warehouse_id': self.wh_id, 'kind': 'fill_above',
+            'product': None, 'threshold': 0.5, 'firing': False,
+        }])
+
+    def test_stock_alerts_on_picks(self):
+        """Test a stock rule alerts when confirmed picks cross it."""
+        self.manager.alerts.add_rule(self.wh_id, 'stock_below', 2.5, "Apple")
+        self.manager.confirm(self.manager.reserve(self.wh_id, "Apple", 1.0))
+        self.assertEqual(self.sent(), [])
+        self.manager.confirm(self.manager.reserve(self.wh_id, "Apple", 1.0))
+        self.assertEqual(self.sent(), [('stock_below', 2, True)])
+        self.manager.add_product(self.wh_id, "Apple", 0.5)
+        self.assertEqual(self.sent(), [('stock_below', 2.5, False)])
+        self.manager.remove_product(self.wh_id, "Apple")
+        self.assertEqual(self.sent(), [('stock_below', 0, True)])
+
+    def test_new_rules_start_in_current_state(self):
+        """Test adding a rule already crossed does not alert."""
+        self.manager.alerts.add_rule(self.wh_id, 'fill_above', 0.25)
+        self.manager.add_product(self.wh_id, "Pear", 1.0)
+        self.assertEqual(self.sent(), [])
+        self.assertTrue(self.manager.alerts.rules()[0]['firing'])
+
+    def test_rules(self):
+        """Test invalid rules are refused and rules can be removed."""
+        alerts = self.manager.alerts
+        with self.assertRaises(ValueError):
+            alerts.add_rule(self.wh_id, 'fill_below', 0.5)
+        with self.assertRaises(ValueError):
+            alerts.add_rule(self.wh_id, 'stock_below', 1.0)
+        self.assertIsNone(alerts.add_rule(999, 'fill_above', 0.5))
+        rule_id = alerts.add_rule(self.wh_id, 'fill_above', 0.5)
+        self.assertTrue(alerts.remove_rule(rule_id))
+        self.assertFalse(alerts.remove_rule(rule_id))
+        alerts.add_rule(self.wh_id, 'fill_above', 0.5)
+        self.manager.delete_warehouse(self.wh_id)
+        self.flush()
+        self.assertEqual(alerts.rules(), [])
+
+
+class TestAlerts(AlertTests, unittest.TestCase):
+    """Tests for alerts with SQLite storage."""
+
+    mode = 'sqlite'
+
+    def test_failed_changes_send_nothing(self):
+        """Test alerts of rolled back changes are not sent."""
+        self.manager.alerts.add_rule(self.wh_id, 'fill_above', 0.5)
+        with self.assertRaises(ConflictError):
+            self.manager.add_product(self.wh_id, "Pear", 5.0,
+                                     expected_version=0)
+        self.assertEqual(self.sent(), [])
+        self.assertFalse(self.manager.alerts.rules()[0]['firing'])
+
+    def test_repair_alerts(self):
+        """Test balances repaired by verify_and_repair are evaluated."""
+        self.manager.alerts.add_rule(self.wh_id, 'fill_above', 0.5)
+        conn = self.manager._get_connection()  # pylint: disable=protected-access
+        conn.execute("UPDATE products SET quantity = 8000")
+        conn.commit()
+        conn.close()
+        self.manager.verify_and_repair(repair=True)
+        self.assertEqual(self.sent(), [('fill_above', 0.8, True)])
+
+    def test_routes(self):
+        """Test adding and removing rules in the UI and the alert stream."""
+        client = create_app({'TESTING': True},
+                            manager=self.manager).test_client()
+        response = client.get('/alerts/stream')
+        self.assertEqual(response.status_code, 404)
+        client.post(f'/warehouse/{self.wh_id}/alerts',
+                    data={'kind': 'fill_above', 'threshold': '75'})
+        client.post(f'/warehouse/{self.wh_id}/alerts',
+                    data={'kind': 'stock_below', 'threshold': '1'})
+        response = client.get(f'/warehouse/{self.wh_id}')
+        self.assertIn(b'Fill above 75.0%', response.data)
+        self.assertIn(b'Invalid alert rule!', response.data)
+        rule_id = self.manager.alerts.rules()[0]['id']
+        client.post(f'/warehouse/{self.wh_id}/alerts/{rule_id}/delete')
+        self.assertEqual(self.manager.alerts.rules(), [])
+
+        self.manager.alerts.dispatcher.sinks.append(SSESink(keepalive=0.01))
+        response = client.get('/alerts/stream', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        response.close()
+
+
+class TestMemoryAlerts(AlertTests, unittest.TestCase):
+    """Tests for alerts with memory storage, evaluated on flushes."""
+
+    mode = 'memory'
+
+    def test_listing_rules_does_not_flush(self):
+        """Test the warehouse page reads rules without flushing changes."""
+        client = create_app({'TESTING': True},
+                            manager=self.manager).test_client()
+        self.manager.alerts.add_rule(self.wh_id, 'fill_above', 0.5)
+        self.assertEqual(self.manager.pending_changes, 0)
+        self.manager.add_product(self.wh_id, "Pear", 2.0)
+        response = client.get(f'/warehouse/{self.wh_id}')
+        self.assertIn(b'Fill above 50.0%', response.data)
+        self.assertEqual(self.manager.pending_changes, 1)
+        self.assertFalse(self.manager.alerts.rules()[0]['firing'])
+        self.flush()
+        self.assertTrue(self.manager.alerts.rules()[0]['firing'])
+
+
+class TestShardedAlerts(AlertTests, unittest.TestCase):
+    """Tests for alerts with sharded storage."""
+
+    mode = 'sharded'
+
+    def test_rule_ids_encode_shards(self):
+        """Test rules of warehouses on different shards have unique ids."""
+        other = self.manager.create_warehouse("Other", 10.0)
+        first = self.manager.alerts.add_rule(self.wh_id, 'fill_above', 0.5)
+        second = self.manager.alerts.add_rule(other, 'fill_above', 0.5)
+        self.assertNotEqual(first, second)
+        self.assertEqual([rule['id'] for rule in self.manager.alerts.rules()],
+                         [first, second])
+        self.manager.add_product(other, "Pear", 6.0)
+        self.assertEqual(self.sent(), [('fill_above', 0.6, True)])
+        self.assertTrue(self.manager.alerts.remove_rule(second))
+        self.assertEqual(len(self.manager.alerts.rules()), 1)
+
+
+class TestDispatcher(unittest.TestCase):
+    """Tests for the dispatch queue and sinks."""
+
+    def test_full_queue_drops_alerts(self):
+        """Test submit does not wait for a blocked sink."""
+        entered, release = threading.Event(), threading.Event()
+
+        class BlockingSink(RecordingSink):
+            """Sink waiting for release before keeping alerts."""
+
+            def send(self, alert):
+                """Wait for release, then keep the alert."""
+                entered.set()
+                release.wait()
+                super().send(alert)
+
+        sink = BlockingSink()
+        dispatcher = AlertDispatcher([sink], maxsize=1)
+        dispatcher.submit([ALERT])
+        entered.wait()
+        with self.assertLogs('alerts', 'WARNING'):
+            dispatcher.submit([ALERT._replace(rule_id=2),
+                               ALERT._replace(rule_id=3)])
+        self.assertEqual(dispatcher.dropped, 1)
+        release.set()
+        dispatcher.stop()
+        self.assertEqual([alert.rule_id for alert in sink.alerts], [1, 2])
+
+    def test_failing_sink(self):
+        """Test a failing sink does not stop delivery to the others."""
+        sink = RecordingSink()
+        dispatcher = AlertDispatcher([WebhookSink('http://127.0.0.1:9/',
+                                                  timeout=1), sink])
+        with self.assertLogs('alerts', 'ERROR'):
+            dispatcher.submit([ALERT])
+            dispatcher.stop()
+        self.assertEqual(sink.alerts, [ALERT])
+
+    def test_webhook(self):
+        """Test the webhook sink POSTs alerts as JSON."""
+        received = []
+
+        class Handler(BaseHTTPRequestHandler):
+            """Stub webhook receiver."""
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                """Keep the posted JSON."""
+                length = int(self.headers['Content-Length'])
+                received.append(json.loads(self.rfile.read(length)))
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """Do not log requests."""
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            dispatcher = AlertDispatcher([WebhookSink(
+                f'http://127.0.0.1:{server.server_port}/alerts'
+            )])
+            dispatcher.submit([ALERT])
+            dispatcher.stop()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(received, [ALERT._asdict()])
+
+    def test_sse_stream(self):
+        """Test SSE clients receive events and keepalive comments."""
+        sink = SSESink(keepalive=0.01)
+        stream = sink.stream()
+        self.assertEqual(next(stream), ": keepalive\n\n")
+        sink.send(ALERT)
+        event = next(stream)
+        self.assertTrue(event.startswith('data: '))
+        self.assertEqual(json.loads(event[6:]), ALERT._asdict())
+        stream.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
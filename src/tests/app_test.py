@@ -2,7 +2,11 @@
 import unittest
 import tempfile
 import os
-from app import app, _parse_float
+import sqlite3
+import tracemalloc
+from app import (HISTORY_DEFAULT_DAYS, HISTORY_MAX_DAYS, app, create_app,
+                 get_manager, _parse_float, _parse_ids)
+from history import DAY
 from warehouse_manager import WarehouseManager
 
 
@@ -16,26 +20,24 @@ class TestApp(unittest.TestCase):
         )
         self.temp_db.close()
 
-        # Create test manager and replace global manager
-        import app as app_module
-        self.original_manager = app_module.manager
-        app_module.manager = WarehouseManager(db_path=self.temp_db.name)
-        self.manager = app_module.manager
-
-        app.config['TESTING'] = True
-        app.config['WTF_CSRF_ENABLED'] = False
-        self.client = app.test_client()
+        self.manager = WarehouseManager(db_path=self.temp_db.name)
+        self.app = create_app({'TESTING': True}, manager=self.manager)
+        self.client = self.app.test_client()
 
     def tearDown(self):
-        """Clean up temporary database and restore manager."""
-        import app as app_module
-        app_module.manager = self.original_manager
+        """Clean up temporary database."""
         os.unlink(self.temp_db.name)
 
     def test_index(self):
         """Test index page."""
         response = self.client.get('/')
         self.assertEqual(response.status_code, 200)
+        self.assertIn(b'No warehouses yet', response.data)
+        wh_id = self.manager.create_warehouse("Listed", 10.0)
+        self.manager.add_product(wh_id, "Apple", 2.0)
+        response = self.client.get('/')
+        self.assertIn(b'Listed', response.data)
+        self.assertIn(b'Apple: 2', response.data)
 
     def test_create_warehouse_get(self):
         """Test create warehouse page GET."""
@@ -59,6 +61,16 @@ class TestApp(unittest.TestCase):
         }, follow_redirects=True)
         self.assertEqual(response.status_code, 200)
 
+    def test_create_warehouse_post_unstorable_capacity(self):
+        """Test creating a warehouse with a non-finite or huge capacity."""
+        for capacity in ('inf', 'nan', '1e300'):
+            response = self.client.post('/create', data={
+                'name': f'Capacity {capacity}', 'capacity': capacity
+            }, follow_redirects=True)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'Invalid warehouse data!', response.data)
+        self.assertEqual(self.manager.get_all_warehouses(), [])
+
     def test_create_warehouse_post_invalid_capacity(self):
         """Test creating a warehouse with invalid capacity."""
         response = self.client.post('/create', data={
@@ -157,6 +169,19 @@ class TestApp(unittest.TestCase):
         }, follow_redirects=True)
         self.assertEqual(response.status_code, 200)
 
+    def test_add_product_unstorable_quantity(self):
+        """Test adding a non-finite or huge quantity of a product."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        for quantity in ('inf', 'nan', '1e300'):
+            response = self.client.post(
+                f'/warehouse/{wh_id}/add_product',
+                data={'product_name': 'Apple', 'quantity': quantity},
+                follow_redirects=True
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'Invalid product data!', response.data)
+        self.assertEqual(self.manager.get_products(wh_id), {})
+
     def test_add_product_exceeds_capacity(self):
         """Test adding product that exceeds capacity."""
         wh_id = self.manager.create_warehouse("Test", 10.0)
@@ -175,6 +200,36 @@ class TestApp(unittest.TestCase):
         }, follow_redirects=True)
         self.assertEqual(response.status_code, 200)
 
+    def test_view_warehouse_formats_quantities(self):
+        """Test quantities are shown with fixed-point formatting."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 3.142)
+        response = self.client.get(f'/warehouse/{wh_id}')
+        self.assertIn(b'3.142 units', response.data)
+        self.assertIn(b'100.00', response.data)
+
+    def test_catalog_search(self):
+        """Test searching the catalog by prefix."""
+        response = self.client.get('/catalog/search?q=pe')
+        self.assertEqual(response.get_json(),
+                         {'products': ['Peach', 'Pear']})
+
+    def test_catalog_search_fuzzy(self):
+        """Test catalog search falls back to fuzzy matching."""
+        response = self.client.get('/catalog/search?q=Strawbery')
+        self.assertEqual(response.get_json()['products'][0], 'Strawberry')
+
+    def test_catalog_search_empty(self):
+        """Test catalog search without a query."""
+        response = self.client.get('/catalog/search')
+        self.assertEqual(response.get_json(), {'products': []})
+
+    def test_view_custom_warehouse(self):
+        """Test viewing a custom warehouse shows catalog suggestions."""
+        wh_id = self.manager.create_warehouse("Custom", 100.0, "custom")
+        response = self.client.get(f'/warehouse/{wh_id}')
+        self.assertIn(b'catalog-suggestions', response.data)
+
     def test_remove_product_success(self):
         """Test removing a product from warehouse."""
         wh_id = self.manager.create_warehouse("Test", 100.0)
@@ -211,6 +266,310 @@ class TestApp(unittest.TestCase):
         )
         self.assertEqual(response.status_code, 200)
 
+    def test_selected_ids_not_storable(self):
+        """Test ids that are not integers SQLite can store are skipped."""
+        source = self.manager.create_warehouse("Source", 100.0)
+        self.manager.add_product(source, "Apple", 1.0)
+        for value in ('\u00b2', str(2 ** 63)):
+            response = self.client.post('/warehouses/delete', data={
+                'warehouse_ids': [value]
+            }, follow_redirects=True)
+            self.assertIn(b'No warehouses selected!', response.data)
+            response = self.client.post(
+                f'/warehouse/{source}/move_products',
+                data={'product_names': ['Apple'], 'target_id': value},
+                follow_redirects=True
+            )
+            self.assertIn(b'Invalid target warehouse!', response.data)
+        self.assertEqual(self.manager.get_products(source), {"Apple": 1})
+
+    def test_verify_command(self):
+        """Test the verify CLI command reports and repairs drift."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 10.0)
+        conn = sqlite3.connect(self.temp_db.name)
+        conn.execute("UPDATE warehouses SET balance = 12500")
+        conn.commit()
+        conn.close()
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['verify', '--batch-size', '10'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn(f"Warehouse {wh_id}: balance 12.50, products 10.00",
+                      result.output)
+        result = runner.invoke(args=['verify', '--repair'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("1 mismatched, 1 repaired", result.output)
+        result = runner.invoke(args=['verify'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Checked 1 warehouses, 0 mismatched", result.output)
+
+    def test_verify_command_invalid_batch_size(self):
+        """Test the verify command refuses batches of no warehouses."""
+        runner = self.app.test_cli_runner()
+        for args in (['--batch-size', '0'], ['--pause', '-1']):
+            result = runner.invoke(args=['verify', *args])
+            self.assertEqual(result.exit_code, 2)
+            self.assertNotIn("Checked", result.output)
+
+    def test_warehouse_history(self):
+        """Test the capacity history route returns chart points."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 10.0)
+        response = self.client.get(f'/warehouse/{wh_id}/history?days=1')
+        self.assertEqual(response.status_code, 200)
+        point = response.get_json()['points'][-1]
+        self.assertEqual(point['capacity'], 100)
+        self.assertEqual(point['maximum'], 10)
+
+    def test_warehouse_history_days_bounded(self):
+        """Test invalid days give the default and long ones are capped."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        history = self.manager.history
+        spans = []
+        query = history.query
+        history.query = lambda start, end, ids: (
+            spans.append(end - start) or query(start, end, ids)
+        )
+        for days in ('inf', 'nan', '-1', '0', '1e300', '100000'):
+            response = self.client.get(
+                f'/warehouse/{wh_id}/history?days={days}'
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.get_json()['points']), 1)
+        self.assertEqual(spans, [HISTORY_DEFAULT_DAYS * DAY] * 5
+                         + [HISTORY_MAX_DAYS * DAY])
+
+    def test_warehouse_history_not_found(self):
+        """Test the capacity history route of a missing warehouse."""
+        response = self.client.get('/warehouse/999/history')
+        self.assertEqual(response.status_code, 404)
+
+    def test_update_with_stale_version_conflicts(self):
+        """Test updating from an outdated form responds with a conflict."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 1.0)
+        response = self.client.post(f'/warehouse/{wh_id}', data={
+            'update_warehouse': '1', 'name': 'New', 'capacity': '50',
+            'version': '0'
+        })
+        self.assertEqual(response.status_code, 409)
+        self.assertIn(b'changed by someone else', response.data)
+        self.assertIn(b'name="version" value="1"', response.data)
+        self.assertEqual(self.manager.get_warehouse(wh_id)['name'], "Test")
+
+    def test_remove_with_stale_version_conflicts(self):
+        """Test removing from an outdated page responds with a conflict."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 1.0)
+        response = self.client.post(
+            f'/warehouse/{wh_id}/remove_product/Apple', data={'version': '0'}
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.manager.get_products(wh_id), {"Apple": 1})
+        response = self.client.post(
+            f'/warehouse/{wh_id}/remove_product/Apple', data={'version': '1'}
+        )
+        self.assertEqual(response.status_code, 302)
+
+    def test_add_with_stale_version_conflicts(self):
+        """Test an add based on an outdated version responds with a conflict."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 1.0)
+        response = self.client.post(f'/warehouse/{wh_id}/add_product', data={
+            'product_name': 'Apple', 'quantity': '1', 'version': '0'
+        })
+        self.assertEqual(response.status_code, 409)
+
+    def test_delete_selected_warehouses(self):
+        """Test deleting the selected warehouses with one request."""
+        ids = [self.manager.create_warehouse(f"Test {n}", 10.0)
+               for n in range(3)]
+        response = self.client.post('/warehouses/delete', data={
+            'warehouse_ids': [str(ids[0]), str(ids[1]), 'x']
+        }, follow_redirects=True)
+        self.assertIn(b'Deleted 2 warehouses!', response.data)
+        self.assertEqual(len(self.manager.get_all_warehouses()), 1)
+        response = self.client.post('/warehouses/delete',
+                                    follow_redirects=True)
+        self.assertIn(b'No warehouses selected!', response.data)
+
+    def test_remove_selected_products(self):
+        """Test removing the selected products with one request."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        for name in ("Apple", "Pear", "Plum"):
+            self.manager.add_product(wh_id, name, 1.0)
+        response = self.client.post(f'/warehouse/{wh_id}/remove_products', data={
+            'product_names': ['Apple', 'Plum'], 'version': '3'
+        }, follow_redirects=True)
+        self.assertIn(b'Removed 2 products!', response.data)
+        self.assertEqual(self.manager.get_products(wh_id), {"Pear": 1})
+        response = self.client.post(f'/warehouse/{wh_id}/remove_products', data={
+            'product_names': ['Pear'], 'version': '3'
+        })
+        self.assertEqual(response.status_code, 409)
+        response = self.client.post(f'/warehouse/{wh_id}/remove_products',
+                                    follow_redirects=True)
+        self.assertIn(b'Could not remove products!', response.data)
+
+    def test_move_selected_products(self):
+        """Test moving the selected products with one request."""
+        source = self.manager.create_warehouse("Source", 100.0)
+        target = self.manager.create_warehouse("Target", 1.0)
+        self.manager.add_product(source, "Apple", 1.0)
+        self.manager.add_product(source, "Pear", 1.0)
+        url = f'/warehouse/{source}/move_products'
+        response = self.client.post(url, data={
+            'product_names': ['Apple', 'Pear'], 'target_id': str(target)
+        }, follow_redirects=True)
+        self.assertIn(b'Not enough space in target warehouse', response.data)
+        response = self.client.post(url, data={
+            'product_names': ['Apple'], 'target_id': str(target)
+        }, follow_redirects=True)
+        self.assertIn(f'Moved products to warehouse #{target}!'.encode(),
+                      response.data)
+        self.assertEqual(self.manager.get_products(target), {"Apple": 1})
+        response = self.client.post(url, data={'product_names': ['Pear']},
+                                    follow_redirects=True)
+        self.assertIn(b'Invalid target warehouse!', response.data)
+        response = self.client.post(url, data={
+            'product_names': ['Pear'], 'target_id': str(target),
+            'version': '0'
+        })
+        self.assertEqual(response.status_code, 409)
+
+    def test_index_shows_flashed_messages_once(self):
+        """Test the streamed index page takes its flashed messages."""
+        response = self.client.post('/create', data={
+            'name': 'Flashed', 'capacity': '100', 'warehouse_type': 'fruit'
+        }, follow_redirects=True)
+        self.assertIn(b'Warehouse created successfully!', response.data)
+        response = self.client.get('/')
+        self.assertNotIn(b'Warehouse created successfully!', response.data)
+
+
+class TestStreamedIndex(unittest.TestCase):
+    """Tests for the memory use of the streamed index page."""
+
+    def setUp(self):
+        """Set up a test client on a temporary database."""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.manager = WarehouseManager(
+            db_path=os.path.join(self.temp_dir.name, 'index.db')
+        )
+        self.client = create_app({'TESTING': True},
+                                 manager=self.manager).test_client()
+        self.client.get('/')  # Compile the templates before measuring
+
+    def tearDown(self):
+        """Close the read connections and remove the database."""
+        self.manager.reads.close()
+        self.temp_dir.cleanup()
+
+    def add_warehouses(self, count):
+        """Insert count warehouses holding an apple, bypassing the manager."""
+        self.manager.catalog.intern("Apple")
+        conn = sqlite3.connect(self.manager.db_path)
+        try:
+            first = conn.execute(
+                "SELECT COALESCE(MAX(id), 0) + 1 FROM warehouses"
+            ).fetchone()[0]
+            ids = range(first, first + count)
+            conn.executemany(
+                """INSERT INTO warehouses (id, name, capacity, balance, type)
+                   VALUES (?, 'Varasto ' || ?, 100000, 1000, 'fruit')""",
+                [(warehouse_id, warehouse_id) for warehouse_id in ids]
+            )
+            conn.executemany(
+                """INSERT INTO products (warehouse_id, product_id, quantity)
+                   SELECT ?, id, 1000 FROM catalog WHERE name = 'Apple'""",
+                [(warehouse_id,) for warehouse_id in ids]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def stream_index(self):
+        """Get the index page, returning (peak traced bytes, page length)."""
+        tracemalloc.start()
+        try:
+            response = self.client.get('/', buffered=False)
+            length = sum(len(chunk) for chunk in response.response)
+            response.close()
+            return tracemalloc.get_traced_memory()[1], length
+        finally:
+            tracemalloc.stop()
+
+    def test_peak_memory_independent_of_fleet_size(self):
+        """Test a ten times larger fleet does not raise the peak memory."""
+        self.add_warehouses(500)
+        small_peak, small_length = self.stream_index()
+        self.add_warehouses(4500)
+        large_peak, large_length = self.stream_index()
+        self.assertGreater(large_length, 9 * small_length)
+        self.assertLess(large_peak, 1.5 * small_peak)
+        self.assertLess(large_peak, large_length / 10)
+
+
+class TestCreateApp(unittest.TestCase):
+    """Tests for the application factory."""
+
+    def test_manager_created_lazily(self):
+        """Test the manager is only created when first needed."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = os.path.join(temp_dir, 'lazy.db')
+            flask_app = create_app({'TESTING': True, 'DATABASE': db_path})
+            self.assertNotIn('warehouse_manager', flask_app.extensions)
+            self.assertFalse(os.path.exists(db_path))
+
+            self.assertEqual(flask_app.test_client().get('/').status_code, 200)
+            with flask_app.app_context():
+                manager = get_manager()
+                self.assertIs(manager, get_manager())
+            self.assertEqual(manager.db_path, db_path)
+            self.assertTrue(os.path.exists(db_path))
+
+    def test_memory_storage(self):
+        """Test the memory storage mode builds a write-behind manager."""
+        from memory_store import MemoryWarehouseManager
+        with tempfile.TemporaryDirectory() as temp_dir:
+            flask_app = create_app({
+                'STORAGE': 'memory',
+                'DATABASE': os.path.join(temp_dir, 'memory.db')
+            })
+            with flask_app.app_context():
+                manager = get_manager()
+            self.assertIsInstance(manager, MemoryWarehouseManager)
+            manager.close()
+
+    def test_sharded_storage(self):
+        """Test the sharded storage mode spreads warehouses over shards."""
+        from sharding import ShardedWarehouseManager
+        with tempfile.TemporaryDirectory() as temp_dir:
+            flask_app = create_app({
+                'STORAGE': 'sharded',
+                'SHARDS': 2,
+                'DATABASE': os.path.join(temp_dir, 'sharded.db'),
+                'HISTORY_COMPACT_INTERVAL': None
+            })
+            client = flask_app.test_client()
+            for name in ('First', 'Second'):
+                client.post('/create', data={'name': name, 'capacity': '10'})
+            with flask_app.app_context():
+                manager = get_manager()
+            self.assertIsInstance(manager, ShardedWarehouseManager)
+            response = client.get('/')
+            self.assertIn(b'First', response.data)
+            self.assertIn(b'Second', response.data)
+            self.assertEqual(client.get('/warehouse/2').status_code, 200)
+            manager.close()
+
+    def test_apps_are_independent(self):
+        """Test each created app has its own manager."""
+        first = create_app(manager=WarehouseManager(db_path=':memory:'))
+        second = create_app(manager=WarehouseManager(db_path=':memory:'))
+        self.assertIsNot(first.extensions['warehouse_manager'],
+                         second.extensions['warehouse_manager'])
+
 
 class TestParseFloat(unittest.TestCase):
     """Tests for _parse_float helper function."""
@@ -240,6 +599,25 @@ class TestParseFloat(unittest.TestCase):
         result = _parse_float('abc')
         self.assertIsNone(result)
 
+    def test_parse_float_not_storable(self):
+        """Test non-finite and too large values are invalid."""
+        for value in ('inf', '-inf', 'nan', '1e400', '1e300'):
+            self.assertIsNone(_parse_float(value), value)
+
+
+class TestParseIds(unittest.TestCase):
+    """Tests for _parse_ids helper function."""
+
+    def test_parse_ids_valid(self):
+        """Test parsing id strings."""
+        self.assertEqual(_parse_ids(['1', ' 2 ', str(2 ** 63 - 1)]),
+                         [1, 2, 2 ** 63 - 1])
+
+    def test_parse_ids_invalid_skipped(self):
+        """Test invalid and out of range ids are skipped."""
+        self.assertEqual(_parse_ids([None, '', 'x', '\u00b2', '1.5', '0',
+                                     '-1', str(2 ** 63), '3']), [3])
+
 
 class TestFlashUpdateResult(unittest.TestCase):
     """Tests for _flash_update_result helper function."""
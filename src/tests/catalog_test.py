@@ -0,0 +1,74 @@
+"""Unit tests for ProductCatalog class."""
+import unittest
+import tempfile
+import os
+from warehouse_manager import WarehouseManager
+
+
+class TestProductCatalog(unittest.TestCase):
+    """Tests for ProductCatalog class."""
+
+    def setUp(self):
+        """Set up a catalog backed by a temporary database."""
+        self.temp_db = tempfile.NamedTemporaryFile(
+            suffix='.db', delete=False
+        )
+        self.temp_db.close()
+        self.manager = WarehouseManager(db_path=self.temp_db.name)
+        self.catalog = self.manager.catalog
+
+    def tearDown(self):
+        """Clean up temporary database."""
+        os.unlink(self.temp_db.name)
+
+    def test_intern_returns_same_id(self):
+        """Test interning a name twice returns the same id."""
+        product_id = self.catalog.intern("Widget")
+        self.assertEqual(self.catalog.intern("Widget"), product_id)
+
+    def test_intern_distinct_names(self):
+        """Test different names get different ids."""
+        self.assertNotEqual(self.catalog.intern("Widget"),
+                            self.catalog.intern("Gadget"))
+
+    def test_intern_seeded_product(self):
+        """Test seeded products already have ids."""
+        conn = self.manager._get_connection()
+        count = conn.execute("SELECT COUNT(*) FROM catalog").fetchone()[0]
+        self.catalog.intern("Apple")
+        after = conn.execute("SELECT COUNT(*) FROM catalog").fetchone()[0]
+        conn.close()
+        self.assertEqual(count, after)
+
+    def test_suggested(self):
+        """Test suggested products are the seeded defaults."""
+        self.catalog.intern("Widget")
+        self.assertEqual(self.catalog.suggested(),
+                         WarehouseManager.AVAILABLE_PRODUCTS)
+
+    def test_search_prefix(self):
+        """Test prefix search is case-insensitive and sorted."""
+        self.catalog.intern("pepper")
+        self.assertEqual(self.catalog.search("PE"),
+                         ["Peach", "Pear", "pepper"])
+
+    def test_search_limit(self):
+        """Test prefix search honours the limit."""
+        self.assertEqual(len(self.catalog.search("P", limit=2)), 2)
+
+    def test_search_no_match(self):
+        """Test prefix search without matches."""
+        self.assertEqual(self.catalog.search("Zucchini"), [])
+
+    def test_fuzzy_search_typo(self):
+        """Test fuzzy search finds names despite typos."""
+        self.assertEqual(self.catalog.fuzzy_search("Pinapple")[0],
+                         "Pineapple")
+
+    def test_fuzzy_search_short_term(self):
+        """Test fuzzy search falls back to prefix search for short terms."""
+        self.assertEqual(self.catalog.fuzzy_search("Ma"), ["Mango"])
+
+    def test_fuzzy_search_quotes(self):
+        """Test fuzzy search handles quotes in the term."""
+        self.assertEqual(self.catalog.fuzzy_search('"""'), [])
@@ -0,0 +1,132 @@
+"""Unit tests for group commit of product additions."""
+import unittest
+import tempfile
+import shutil
+import threading
+import os
+from concurrent.futures import ThreadPoolExecutor
+from app import create_app, get_manager
+from group_commit import GroupCommitManager
+from warehouse_manager import ConflictError
+
+
+class TestGroupCommit(unittest.TestCase):
+    """Tests for GroupCommitManager and its writer."""
+
+    def setUp(self):
+        """Set up a manager waiting long enough to group writes."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, 'warehouse.db')
+        self.manager = GroupCommitManager(self.db_path, max_delay=0.2)
+        self.wh_id = self.manager.create_warehouse("Test", 100.0)
+
+    def tearDown(self):
+        """Stop the manager and remove temporary files."""
+        self.manager.close()
+        shutil.rmtree(self.temp_dir)
+
+    def add_concurrently(self, additions):
+        """Call add_product with each argument tuple from its own thread.
+
+        Returns the results, or the exceptions raised, in order.
+        """
+        def add(args):
+            try:
+                return self.manager.add_product(*args)
+            except ConflictError as error:
+                return error
+        with ThreadPoolExecutor(max_workers=len(additions)) as executor:
+            return list(executor.map(add, additions))
+
+    def test_burst_shares_commits(self):
+        """Test concurrent additions are committed in few transactions."""
+        results = self.add_concurrently(
+            [(self.wh_id, f"Item {number}", 1.0) for number in range(20)]
+        )
+        self.assertEqual(results, [True] * 20)
+        self.assertLess(self.manager.writer.commits, 20)
+        warehouse = self.manager.get_warehouse(self.wh_id)
+        self.assertEqual(warehouse['varasto'].saldo, 20)
+        self.assertEqual(len(warehouse['products']), 20)
+
+    def test_results_per_item(self):
+        """Test failing additions do not affect the rest of their group."""
+        version = self.manager.get_warehouse(self.wh_id)['version']
+        results = self.add_concurrently([
+            (self.wh_id, "Apple", 30.0),
+            (self.wh_id, "Pear", 200.0),
+            (999, "Apple", 1.0),
+            (self.wh_id, "Kiwi", 1.0, version - 1),
+            (self.wh_id, "Apple", 0),
+        ])
+        self.assertEqual(results[:3], [True, False, False])
+        self.assertIsInstance(results[3], ConflictError)
+        self.assertFalse(results[4])
+        self.assertEqual(self.manager.get_warehouse(self.wh_id)['products'],
+                         {"Apple": 30})
+
+    def test_failed_write_rolled_back_alone(self):
+        """Test a raising write is rolled back to its savepoint."""
+        def rename_and_fail(conn, name):
+            conn.execute("UPDATE warehouses SET name = ?", (name,))
+            raise ValueError("Failed after writing")
+
+        self.manager.catalog.intern("Apple")  # Not in the writer's transaction
+        writer = self.manager.writer
+        failing = writer.submit(rename_and_fail, "Renamed")
+        adding = writer.submit(self.manager._try_add,  # pylint: disable=protected-access
+                               self.wh_id, "Apple", 5000, None)
+        with self.assertRaises(ValueError):
+            failing.result()
+        self.assertTrue(adding.result())
+        warehouse = self.manager.get_warehouse(self.wh_id)
+        self.assertEqual(warehouse['name'], "Test")
+        self.assertEqual(warehouse['products'], {"Apple": 5})
+
+    def test_alerts_of_rolled_back_writes_dropped(self):
+        """Test only the alerts of committed additions are sent."""
+        sent = []
+        self.manager.alerts.dispatcher.sinks = [type(
+            'Sink', (), {'send': lambda _self, alert: sent.append(alert)}
+        )()]
+        self.manager.alerts.add_rule(self.wh_id, 'fill_above', 0.25)
+        version = self.manager.get_warehouse(self.wh_id)['version']
+        results = self.add_concurrently([
+            (self.wh_id, "Apple", 30.0, version - 1),
+            (self.wh_id, "Pear", 60.0, version),
+        ])
+        self.assertIsInstance(results[0], ConflictError)
+        self.assertTrue(results[1])
+        self.manager.alerts.dispatcher.wait()
+        self.assertEqual([(alert.value, alert.firing) for alert in sent],
+                         [(0.6, True)])
+
+    def test_close_commits_queued_writes(self):
+        """Test close() waits for the queued additions."""
+        started = threading.Event()
+        self.manager.catalog.intern("Apple")
+        future = self.manager.writer.submit(
+            lambda conn: started.set() or self.manager._try_add(  # pylint: disable=protected-access
+                conn, self.wh_id, "Apple", 1000, None
+            )
+        )
+        self.manager.close()
+        self.assertTrue(started.is_set())
+        self.assertTrue(future.result(timeout=0))
+        reopened = GroupCommitManager(self.db_path)
+        self.assertEqual(reopened.get_products(self.wh_id), {"Apple": 1})
+
+    def test_app_config(self):
+        """Test the app uses group commit when configured."""
+        app = create_app({'TESTING': True, 'DATABASE': self.db_path,
+                          'GROUP_COMMIT': True,
+                          'HISTORY_COMPACT_INTERVAL': None})
+        with app.app_context():
+            manager = get_manager()
+            self.assertIsInstance(manager, GroupCommitManager)
+            self.assertTrue(manager.add_product(self.wh_id, "Apple", 1.0))
+            manager.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+"""Unit tests for the capacity history."""
+import unittest
+import tempfile
+import os
+import time
+from history import DAY, HOUR, MINUTE, RAW, HistoryPoint
+from warehouse_manager import WarehouseManager
+
+# Start of a day in unix seconds
+START = 1_700_006_400
+
+
+class TestCapacityHistory(unittest.TestCase):
+    """Tests for CapacityHistory class."""
+
+    def setUp(self):
+        """Set up a history with a controllable clock."""
+        self.temp_db = tempfile.NamedTemporaryFile(
+            suffix='.db', delete=False
+        )
+        self.temp_db.close()
+        self.manager = WarehouseManager(db_path=self.temp_db.name)
+        self.history = self.manager.history
+        self.now = START
+        self.history.clock = lambda: self.now
+        self.wh_id = self.manager.create_warehouse("Test", 100.0)
+
+    def tearDown(self):
+        """Clean up temporary database."""
+        os.unlink(self.temp_db.name)
+
+    def _count(self, level):
+        """Count the stored points of a level."""
+        conn = self.manager._get_connection()  # pylint: disable=protected-access
+        count = conn.execute(
+            "SELECT COUNT(*) FROM capacity_history WHERE level = ?", (level,)
+        ).fetchone()[0]
+        conn.close()
+        return count
+
+    def test_changes_are_sampled(self):
+        """Test each change records a sample, merged per second."""
+        self.manager.add_product(self.wh_id, "Apple", 10.0)
+        self.manager.add_product(self.wh_id, "Pear", 20.0)
+        self.now += 1
+        self.manager.remove_product(self.wh_id, "Apple")
+        self.manager.update_warehouse(self.wh_id, "Test", 50.0)
+        points = self.history.query(START, START + 10)[self.wh_id]
+        self.assertEqual(points, [
+            HistoryPoint(START, 13.333, 0, 30, 100),
+            HistoryPoint(START + 1, 20, 20, 20, 50),
+        ])
+
+    def test_compact_rolls_up_closed_buckets(self):
+        """Test closed buckets are rolled up to every level."""
+        for offset in (0, 30, 90):
+            self.now = START + offset
+            self.manager.add_product(self.wh_id, "Apple", 1.0)
+        self.now = START + DAY + 1
+        self.history.compact()
+        self.assertEqual(self._count(MINUTE), 2)
+        self.assertEqual(self._count(HOUR), 1)
+        self.assertEqual(self._count(DAY), 1)
+        points = self.history.query(START, START + DAY, max_points=1)
+        self.assertEqual(points[self.wh_id], [
+            HistoryPoint(START, 1.5, 0, 3, 100)
+        ])
+
+    def test_compact_is_incremental(self):
+        """Test compacting twice does not count points twice."""
+        self.manager.add_product(self.wh_id, "Apple", 1.0)
+        self.now = START + 2 * MINUTE
+        self.history.compact()
+        self.history.compact()
+        self.manager.add_product(self.wh_id, "Apple", 1.0)
+        self.now = START + 4 * MINUTE
+        self.history.compact()
+        points = self.history.query(START, START + HOUR)[self.wh_id]
+        self.assertEqual([point.balance for point in points], [0.5, 2])
+
+    def test_expire_after_retention(self):
+        """Test points are expired only after their retention."""
+        self.manager.add_product(self.wh_id, "Apple", 1.0)
+        self.now = START + HOUR
+        self.history.compact()
+        self.assertEqual(self._count(RAW), 1)
+        self.now = START + DAY + HOUR
+        self.history.compact()
+        self.assertEqual(self._count(RAW), 0)
+        self.assertEqual(self._count(MINUTE), 1)
+
+    def test_retention_keeps_points_not_rolled_up(self):
+        """Test points are kept until rolled up, whatever the retention."""
+        self.history.retention[RAW] = 0
+        self.now = START + 30
+        self.manager.add_product(self.wh_id, "Apple", 1.0)
+        self.history.compact()
+        self.assertEqual(self._count(RAW), 2)
+
+    def test_choose_level(self):
+        """Test the finest level with few enough points is chosen."""
+        self.now = START + 100 * DAY
+        end = self.now
+        self.assertEqual(self.history.choose_level(end - 60, end), RAW)
+        self.assertEqual(self.history.choose_level(end - HOUR, end), MINUTE)
+        self.assertEqual(self.history.choose_level(end - 7 * DAY, end), HOUR)
+        self.assertEqual(self.history.choose_level(end - 90 * DAY, end), DAY)
+        # Minute points of the last hour are already expired
+        self.assertEqual(
+            self.history.choose_level(end - 9 * DAY, end - 8 * DAY), HOUR
+        )
+
+    def test_query_includes_points_not_rolled_up(self):
+        """Test a coarse query also reads the newest finer points."""
+        self.manager.add_product(self.wh_id, "Apple", 4.0)
+        self.now = START + HOUR + 10
+        self.history.compact()
+        self.manager.add_product(self.wh_id, "Apple", 4.0)
+        points = self.history.query(START, START + 2 * HOUR, max_points=2)
+        self.assertEqual(points[self.wh_id], [
+            HistoryPoint(START, 2, 0, 4, 100),
+            HistoryPoint(START + HOUR, 8, 8, 8, 100),
+        ])
+
+    def test_query_selected_warehouses(self):
+        """Test querying the history of selected warehouses."""
+        other = self.manager.create_warehouse("Other", 10.0)
+        self.assertEqual(
+            set(self.history.query(START, START + 1)), {self.wh_id, other}
+        )
+        self.assertEqual(
+            set(self.history.query(START, START + 1, [other])), {other}
+        )
+
+    def test_background_compactor(self):
+        """Test the compactor thread compacts until stopped."""
+        self.now = START + MINUTE
+        self.history.start_compactor(0.01)
+        self.history.start_compactor(0.01)
+        started = time.monotonic()
+        while self._count(MINUTE) == 0:
+            self.assertLess(time.monotonic() - started, 2.0)
+            time.sleep(0.01)
+        self.history.stop_compactor()
+        self.history.stop_compactor()
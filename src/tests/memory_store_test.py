@@ -0,0 +1,273 @@
+"""Unit tests for the in-memory write-behind warehouse store."""
+import unittest
+import tempfile
+import shutil
+import time
+import os
+from memory_store import MemoryHolds, MemoryWarehouseManager
+from warehouse_manager import CONFLICT, ConflictError, WarehouseManager
+
+
+def _state(manager):
+    """Return comparable state of all warehouses of a manager."""
+    return [
+        (w['id'], w['name'], w['type'], w['varasto'].tilavuus,
+         w['varasto'].saldo, dict(w['products']))
+        for w in manager.get_all_warehouses()
+    ]
+
+
+def _run_operations(manager):
+    """Run a mixed sequence of operations and return their results."""
+    first = manager.create_warehouse("First", 100.0)
+    second = manager.create_warehouse("Second", 50.0, "custom")
+    return [
+        first, second,
+        manager.create_warehouse("first", 10.0),
+        manager.add_product(first, "Apple", 50.7),
+        manager.add_product(first, "Apple", 3.14),
+        manager.add_product(first, "Pear", 100.0),
+        manager.add_product(second, "Bolt", 20.0),
+        manager.add_product(999, "Apple", 1.0),
+        manager.remove_product(first, "Apple"),
+        manager.remove_product(first, "Apple"),
+        manager.update_warehouse(first, "Second", 100.0),
+        manager.update_warehouse(second, "Renamed", 10.0),
+        manager.update_warehouse(second, "Renamed", 30.0),
+        manager.update_warehouse(999, "Nothing", 1.0),
+        manager.name_exists("renamed"),
+        manager.get_warehouse(second, projection=('name', 'type')),
+        manager.delete_warehouse(first),
+        manager.delete_warehouse(first),
+        manager.create_warehouse("Third", 5.0),
+    ]
+
+
+class TestMemoryWarehouseManager(unittest.TestCase):
+    """Tests for MemoryWarehouseManager."""
+
+    def setUp(self):
+        """Set up a temporary directory for databases."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, 'memory.db')
+        self.manager = MemoryWarehouseManager(self.db_path, start=False)
+
+    def tearDown(self):
+        """Stop the manager and remove temporary files."""
+        self.manager.close()
+        shutil.rmtree(self.temp_dir)
+
+    def _reopen(self):
+        """Open the persisted database directly."""
+        return WarehouseManager(db_path=self.db_path)
+
+    def test_results_match_sqlite_mode(self):
+        """Test operations give the same results as direct SQLite mode."""
+        direct = WarehouseManager(
+            db_path=os.path.join(self.temp_dir, 'direct.db')
+        )
+        self.assertEqual(_run_operations(self.manager),
+                         _run_operations(direct))
+        self.assertEqual(_state(self.manager), _state(direct))
+        self.assertEqual(
+            [(w['id'], w['products']) for w in self.manager.iter_warehouses()],
+            [(w['id'], w['products']) for w in direct.iter_warehouses()]
+        )
+
+    def test_bulk_results_match_sqlite_mode(self):
+        """Test bulk operations give the same results as SQLite mode."""
+        direct = WarehouseManager(
+            db_path=os.path.join(self.temp_dir, 'direct.db')
+        )
+
+        def bulk(manager):
+            first = manager.create_warehouse("First", 100.0)
+            second = manager.create_warehouse("Second", 12.0)
+            third = manager.create_warehouse("Third", 1.0)
+            for name, quantity in (("Apple", 5.0), ("Pear", 6.0),
+                                   ("Plum", 7.0)):
+                manager.add_product(first, name, quantity)
+            manager.reserve(first, "Plum", 2.0)
+            return [
+                manager.move_products(first, second, ["Apple", "Plum"]),
+                manager.move_products(first, second, ["Pear"]),
+                manager.move_products(first, first, ["Pear"]),
+                manager.move_products(first, 999, ["Pear"]),
+                manager.remove_products(first, ["Pear", "Plum", "Kiwi"]),
+                manager.delete_warehouses([third, 999]),
+                manager.available(second, "Plum"),
+            ]
+
+        self.assertEqual(bulk(self.manager), bulk(direct))
+        self.assertEqual(_state(self.manager), _state(direct))
+        direct.holds.stop()
+        self.manager.flush()
+        self.assertEqual(_state(self._reopen()), _state(direct))
+
+    def test_flush_persists_state(self):
+        """Test flushing writes the in-memory state to SQLite."""
+        _run_operations(self.manager)
+        self.assertGreater(self.manager.pending_changes, 0)
+        self.manager.flush()
+        self.assertEqual(self.manager.pending_changes, 0)
+        self.assertEqual(_state(self._reopen()), _state(self.manager))
+
+    def test_writes_not_persisted_before_flush(self):
+        """Test writes are served from memory until flushed."""
+        self.manager.create_warehouse("Test", 100.0)
+        self.assertEqual(len(self.manager.get_all_warehouses()), 1)
+        self.assertEqual(self._reopen().get_all_warehouses(), [])
+
+    def test_loads_existing_state(self):
+        """Test existing database content is loaded on construction."""
+        direct = self._reopen()
+        wh_id = direct.create_warehouse("Existing", 100.0)
+        direct.add_product(wh_id, "Apple", 10.0)
+        direct.delete_warehouse(direct.create_warehouse("Deleted", 1.0))
+        manager = MemoryWarehouseManager(self.db_path, start=False)
+        self.assertEqual(_state(manager), _state(direct))
+        new_id = manager.create_warehouse("New", 10.0)
+        self.assertEqual(new_id, wh_id + 2)
+        manager.close()
+
+    def test_flush_in_batches(self):
+        """Test flushing writes all changes in several batches."""
+        self.manager.batch_size = 2
+        for number in range(5):
+            self.manager.create_warehouse(f"Warehouse {number}", 10.0)
+        self.assertEqual(self.manager.flush(), 5)
+        self.assertEqual(len(self._reopen().get_all_warehouses()), 5)
+
+    def test_flush_swapped_names_across_batches(self):
+        """Test names swapped between warehouses are persisted."""
+        self.manager.batch_size = 1
+        first = self.manager.create_warehouse("A", 10.0)
+        second = self.manager.create_warehouse("B", 10.0)
+        self.manager.flush()
+        self.manager.update_warehouse(first, "Temp", 10.0)
+        self.manager.update_warehouse(second, "A", 10.0)
+        self.manager.update_warehouse(first, "B", 10.0)
+        self.manager.flush()
+        names = {w['id']: w['name'] for w in self._reopen().get_all_warehouses()}
+        self.assertEqual(names, {first: "B", second: "A"})
+
+    def test_flush_deleted_warehouse(self):
+        """Test deleting a persisted warehouse removes it and its products."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 10.0)
+        self.manager.flush()
+        self.manager.delete_warehouse(wh_id)
+        self.manager.flush()
+        self.assertIsNone(self._reopen().get_warehouse(wh_id))
+        self.assertEqual(self._reopen().get_products(wh_id), {})
+
+    def test_background_flush_within_interval(self):
+        """Test the flusher persists changes within its interval."""
+        manager = MemoryWarehouseManager(self.db_path, flush_interval=0.05)
+        started = time.monotonic()
+        wh_id = manager.create_warehouse("Test", 100.0)
+        direct = self._reopen()
+        while direct.get_warehouse(wh_id) is None:
+            self.assertLess(time.monotonic() - started, 2.0)
+            time.sleep(0.01)
+        manager.close()
+        self.assertAlmostEqual(manager.flush_interval, 0.05)
+
+    def test_close_flushes_pending_changes(self):
+        """Test closing persists pending changes."""
+        manager = MemoryWarehouseManager(self.db_path, flush_interval=60)
+        manager.create_warehouse("Test", 100.0)
+        manager.close()
+        self.assertEqual(len(self._reopen().get_all_warehouses()), 1)
+
+    def test_snapshot(self):
+        """Test snapshotting writes a consistent database copy."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 10.0)
+        path = os.path.join(self.temp_dir, 'snapshot.db')
+        self.manager.snapshot(path)
+        self.assertFalse(os.path.exists(path + '.tmp'))
+        copy = WarehouseManager(db_path=path)
+        self.assertEqual(_state(copy), _state(self.manager))
+
+    def test_get_warehouse_projections(self):
+        """Test projections of in-memory warehouses."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        header = self.manager.get_warehouse(wh_id, projection='header')
+        self.assertNotIn('products', header)
+        self.assertIsNone(self.manager.get_warehouse(999))
+        self.assertEqual(self.manager.get_products(999), {})
+
+    def test_verify_and_repair_in_memory(self):
+        """Test drifted in-memory balances are found and repaired."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.create_warehouse("Other", 100.0)
+        self.manager.add_product(wh_id, "Apple", 10.0)
+        self.manager.flush()
+        # pylint: disable=protected-access
+        self.manager._warehouses[wh_id].balance = 12000
+        report = self.manager.verify_and_repair(batch_size=1)
+        self.assertEqual(report['mismatches'], {wh_id: (12, 10)})
+        report = self.manager.verify_and_repair(repair=True)
+        self.assertEqual((report['checked'], report['repaired']), (2, 1))
+        self.assertEqual(self.manager.find_drift(), {})
+        self.assertEqual(self.manager.pending_changes, 1)
+
+    def test_verify_invalid_batch_size(self):
+        """Test batches of fewer than one warehouse are refused."""
+        self.manager.create_warehouse("Test", 100.0)
+        with self.assertRaises(ValueError):
+            self.manager.verify_and_repair(batch_size=0)
+
+    def test_history_sampled_on_flush(self):
+        """Test flushed warehouses get a capacity history sample."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 10.0)
+        self.assertEqual(self.manager.history.query(0, time.time() + 1), {})
+        self.manager.flush()
+        points = self.manager.history.query(0, time.time() + 1)[wh_id]
+        self.assertEqual(points[-1].balance, 10)
+
+    def test_stale_version_conflicts(self):
+        """Test changes based on an old version conflict in memory."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 1.0)
+        self.assertEqual(
+            self.manager.update_warehouse(wh_id, "New", 50.0, 0),
+            (False, CONFLICT)
+        )
+        with self.assertRaises(ConflictError):
+            self.manager.remove_product(wh_id, "Apple", expected_version=0)
+        self.assertTrue(self.manager.remove_product(wh_id, "Apple", 1))
+        self.manager.flush()
+        self.assertEqual(self._reopen().get_warehouse(wh_id)['version'], 2)
+
+
+class TestMemoryHolds(unittest.TestCase):
+    """Tests for MemoryHolds."""
+
+    def setUp(self):
+        """Set up holds on a clock the tests advance."""
+        self.now = 0.0
+        self.holds = MemoryHolds(clock=lambda: self.now)
+
+    def test_held_totals(self):
+        """Test totals follow holds added, popped, expired and dropped."""
+        first = self.holds.add(1, "Apple", 300, 10)
+        self.holds.add(1, "Apple", 200, 20)
+        self.holds.add(1, "Pear", 100, 30)
+        self.holds.add(2, "Apple", 50, 30)
+        self.assertEqual(self.holds.held(1, "Apple"), 500)
+        self.assertEqual(self.holds.pop(first).quantity, 300)
+        self.assertIsNone(self.holds.pop(first))
+        self.assertEqual(self.holds.held(1, "Apple"), 200)
+        self.now = 20.0
+        self.assertEqual(self.holds.held(1, "Apple"), 0)
+        self.assertEqual(self.holds.held(1, "Pear"), 100)
+        self.holds.drop(1, "Pear")
+        self.assertEqual(self.holds.held(1, "Pear"), 0)
+        self.assertEqual(self.holds.held(2, "Apple"), 50)
+        self.holds.drop(2)
+        self.assertEqual(self.holds.held(2, "Apple"), 0)
+        self.now = 40.0
+        self.assertEqual(self.holds.held(2, "Apple"), 0)
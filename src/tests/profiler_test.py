@@ -0,0 +1,152 @@
+"""Unit tests for request profiling."""
+import unittest
+import tempfile
+import shutil
+import os
+import threading
+from unittest import mock
+from app import create_app
+from warehouse_manager import WarehouseManager
+
+
+class TestRequestProfiler(unittest.TestCase):
+    """Tests for RequestProfiler."""
+
+    def setUp(self):
+        """Set up test client, temporary database and profile directory."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.manager = WarehouseManager(
+            db_path=os.path.join(self.temp_dir, 'test.db')
+        )
+        self.profile_dir = os.path.join(self.temp_dir, 'profiles')
+        self.app = create_app({
+            'TESTING': True,
+            'PROFILE_DIR': self.profile_dir,
+            'PROFILE_KEEP': 2
+        }, manager=self.manager)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        """Remove temporary files."""
+        shutil.rmtree(self.temp_dir)
+
+    def _get_index(self, **kwargs):
+        """Get the streamed index page, closing it like a server would."""
+        return self.client.get('/', buffered=True, **kwargs)
+
+    def _profiles(self):
+        """Return stored profile file names."""
+        if not os.path.isdir(self.profile_dir):
+            return []
+        return sorted(os.listdir(self.profile_dir))
+
+    def test_request_not_profiled_by_default(self):
+        """Test that ordinary requests are not profiled."""
+        response = self.client.get('/')
+        self.assertNotIn('X-Profile-Id', response.headers)
+        self.assertEqual(self._profiles(), [])
+
+    def test_profile_header(self):
+        """Test profiling a request with the X-Profile header."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        response = self.client.get(f'/warehouse/{wh_id}',
+                                   headers={'X-Profile': '1'})
+        name = response.headers['X-Profile-Id']
+        self.assertIn(name + '.prof', self._profiles())
+        with open(os.path.join(self.profile_dir, name + '.txt'),
+                  encoding='utf-8') as report:
+            content = report.read()
+        self.assertIn('get_warehouse', content)
+        self.assertIn('SELECT', content)
+
+    def test_profile_query_flag(self):
+        """Test profiling a request with the profile query flag."""
+        response = self._get_index(query_string={'profile': '1'})
+        self.assertIn('X-Profile-Id', response.headers)
+
+    def test_profile_disallowed_client(self):
+        """Test that clients outside the allow list are not profiled."""
+        self.app.config['PROFILE_ALLOWED_CLIENTS'] = ('10.0.0.1',)
+        response = self._get_index(headers={'X-Profile': '1'})
+        self.assertNotIn('X-Profile-Id', response.headers)
+        response = self.client.get('/profiles')
+        self.assertEqual(response.status_code, 404)
+
+    def test_profile_stops_tracing(self):
+        """Test that SQL tracing is disabled after the request."""
+        self._get_index(headers={'X-Profile': '1'})
+        self.assertIsNone(self.manager.trace_callback)
+
+    def test_concurrent_request_statements_not_recorded(self):
+        """Test SQL of a request served meanwhile stays out of a profile."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        get_warehouse = self.manager.get_warehouse
+
+        def serve_other_request_first(*args, **kwargs):
+            other = threading.Thread(target=lambda: self.app.test_client()
+                                     .get('/catalog/search?q=zzconcurrent'))
+            other.start()
+            other.join()
+            return get_warehouse(*args, **kwargs)
+
+        self.manager.get_warehouse = serve_other_request_first
+        response = self.client.get(f'/warehouse/{wh_id}',
+                                   headers={'X-Profile': '1'})
+        with open(os.path.join(self.profile_dir,
+                               response.headers['X-Profile-Id'] + '.txt'),
+                  encoding='utf-8') as report:
+            content = report.read()
+        self.assertIn('FROM warehouses', content)
+        self.assertNotIn('zzconcurrent', content)
+
+    def test_failed_start_releases_profiler(self):
+        """Test a request failing to start profiling lets others profile."""
+
+        def fail(_manager, _callback):
+            raise RuntimeError("Tracing failed")
+
+        with mock.patch.object(WarehouseManager, 'trace_callback',
+                               property(lambda _manager: None, fail),
+                               create=True):
+            with self.assertRaises(RuntimeError):
+                self._get_index(headers={'X-Profile': '1'})
+        response = self._get_index(headers={'X-Profile': '1'})
+        self.assertIn('X-Profile-Id', response.headers)
+
+    def test_streamed_response_profiled_until_closed(self):
+        """Test the profile of a streamed page covers rendering its body."""
+        self.manager.create_warehouse("Streamed", 100.0)
+        response = self.client.get('/', headers={'X-Profile': '1'})
+        name = response.headers['X-Profile-Id']
+        self.assertEqual(self._profiles(), [])
+        self.assertIn(b'Streamed', response.get_data())
+        response.close()
+        self.assertIsNone(self.manager.trace_callback)
+        with open(os.path.join(self.profile_dir, name + '.txt'),
+                  encoding='utf-8') as report:
+            content = report.read()
+        self.assertIn('iter_warehouses', content)
+        self.assertIn('LEFT JOIN products', content)
+
+    def test_profile_rotation(self):
+        """Test that only the configured number of profiles is kept."""
+        for _ in range(4):
+            self._get_index(headers={'X-Profile': '1'})
+        profiles = [f for f in self._profiles() if f.endswith('.prof')]
+        self.assertEqual(len(profiles), 2)
+
+    def test_list_and_download_profiles(self):
+        """Test listing and downloading stored profiles."""
+        name = self._get_index(
+            headers={'X-Profile': '1'}
+        ).headers['X-Profile-Id']
+        response = self.client.get('/profiles')
+        self.assertIn(name, response.get_data(as_text=True))
+        response = self.client.get(f'/profiles/{name}.txt')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('SQL statements', response.get_data(as_text=True))
+
+    def test_list_profiles_empty(self):
+        """Test listing profiles before any are recorded."""
+        response = self.client.get('/profiles')
+        self.assertEqual(response.status_code, 200)
@@ -0,0 +1,42 @@
+"""Unit tests for fixed-point quantity helpers."""
+import unittest
+from decimal import Decimal
+from quantity import SCALE, format_quantity, from_units, to_units
+
+
+class TestQuantity(unittest.TestCase):
+    """Tests for quantity conversions."""
+
+    def test_to_units_int(self):
+        """Test converting whole quantities."""
+        self.assertEqual(to_units(5), 5 * SCALE)
+
+    def test_to_units_float(self):
+        """Test converting floats is exact to three decimals."""
+        self.assertEqual(to_units(50.7), 50700)
+        self.assertEqual(to_units(3.14), 3140)
+        self.assertEqual(to_units(0.001), 1)
+
+    def test_to_units_decimal_and_string(self):
+        """Test converting Decimal and string quantities."""
+        self.assertEqual(to_units(Decimal('1.2345')), 1234)
+        self.assertEqual(to_units('2.5'), 2500)
+
+    def test_to_units_negative(self):
+        """Test converting negative quantities."""
+        self.assertEqual(to_units(-1.5), -1500)
+
+    def test_from_units_whole(self):
+        """Test whole quantities convert back to int."""
+        self.assertEqual(from_units(15000), 15)
+        self.assertIsInstance(from_units(15000), int)
+
+    def test_from_units_fraction(self):
+        """Test fractional quantities convert back to float."""
+        self.assertEqual(from_units(47560), 47.56)
+
+    def test_format_quantity(self):
+        """Test formatting with two or three decimals."""
+        self.assertEqual(format_quantity(50.7), "50.70")
+        self.assertEqual(format_quantity(3.142), "3.142")
+        self.assertEqual(format_quantity(0), "0.00")
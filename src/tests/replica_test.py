@@ -0,0 +1,94 @@
+"""Unit tests for read-only connections and replicas."""
+import unittest
+import tempfile
+import shutil
+import sqlite3
+import os
+from app import create_app, get_manager
+from replica import ReadPool
+from warehouse_manager import WarehouseManager
+
+
+class TestReadPool(unittest.TestCase):
+    """Tests for ReadPool and the reads of WarehouseManager."""
+
+    def setUp(self):
+        """Set up a database with a warehouse."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, 'warehouse.db')
+        self.manager = WarehouseManager(self.db_path)
+        self.wh_id = self.manager.create_warehouse("Test", 100.0)
+
+    def tearDown(self):
+        """Close the connections and remove temporary files."""
+        self.manager.reads.close()
+        shutil.rmtree(self.temp_dir)
+
+    def balance(self):
+        """Read the balance of the warehouse."""
+        return self.manager.get_warehouse(self.wh_id)['varasto'].saldo
+
+    def test_connections_are_read_only(self):
+        """Test lent connections cannot write."""
+        with self.manager.reads.connection() as conn:
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute("DELETE FROM warehouses")
+        self.assertEqual(self.manager.get_all_warehouses()[0]['name'], "Test")
+
+    def test_connections_are_reused(self):
+        """Test up to size idle connections are kept for the next reads."""
+        pool = ReadPool(self.db_path, size=1)
+        with pool.connection() as first, pool.connection() as second:
+            self.assertIsNot(first, second)
+        with pool.connection() as conn:
+            self.assertIs(conn, second)
+        pool.close()
+
+    def test_reads_do_not_block_writers(self):
+        """Test a write commits while a read transaction is open."""
+        with self.manager.reads.connection() as conn:
+            conn.execute("BEGIN")
+            self.assertEqual(conn.execute(
+                "SELECT balance FROM warehouses"
+            ).fetchone()[0], 0)
+            self.assertTrue(self.manager.add_product(self.wh_id, "Apple",
+                                                     1.0))
+            self.assertEqual(conn.execute(
+                "SELECT balance FROM warehouses"
+            ).fetchone()[0], 0)
+            conn.rollback()
+        self.assertEqual(self.balance(), 1.0)
+
+    def test_replica_staleness(self):
+        """Test replica reads lag until the copy is refreshed."""
+        self.manager.reads.max_staleness = 60.0
+        self.assertEqual(self.balance(), 0)
+        self.manager.add_product(self.wh_id, "Apple", 1.0)
+        self.assertEqual(self.balance(), 0)
+        self.assertEqual(self.manager.get_products(self.wh_id), {})
+        self.manager.reads.refresh()
+        self.assertEqual(self.balance(), 1.0)
+        self.assertEqual(self.manager.get_products(self.wh_id),
+                         {"Apple": 1.0})
+        self.manager.reads.max_staleness = 0
+        self.manager.add_product(self.wh_id, "Pear", 1.0)
+        self.assertEqual(self.balance(), 2.0)
+
+    def test_app_config(self):
+        """Test the app configures the reads of its manager."""
+        app = create_app({'TESTING': True, 'DATABASE': self.db_path,
+                          'READ_POOL_SIZE': 2,
+                          'READ_REPLICA_STALENESS': 5.0,
+                          'HISTORY_COMPACT_INTERVAL': None})
+        with app.app_context():
+            reads = get_manager().reads
+            self.assertEqual((reads.size, reads.max_staleness), (2, 5.0))
+            self.assertTrue(get_manager().name_exists("Test"))
+            self.assertTrue(os.path.exists(reads.replica_path))
+            get_manager().holds.stop()
+            get_manager().alerts.dispatcher.stop()
+            reads.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
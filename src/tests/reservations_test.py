@@ -0,0 +1,186 @@
+"""Unit tests for stock reservations."""
+import unittest
+import threading
+import time
+from warehouse_manager import WarehouseManager
+from tests.storage_modes import StorageModeTests
+
+# Unix time the tests start at
+START = 1_700_000_000
+
+
+class ReservationTests(StorageModeTests):
+    """Reservation tests run against each storage mode."""
+
+    def setUp(self):
+        """Set up a warehouse with stock and a controllable clock."""
+        super().setUp()
+        self.now = START
+        self.set_clock(lambda: self.now)
+        self.wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(self.wh_id, "Apple", 10.0)
+
+    def set_clock(self, clock):
+        """Set the clock of the holds."""
+        self.manager.holds.clock = clock
+
+    def test_holds_count_against_available(self):
+        """Test reserved quantities are not available to others."""
+        first = self.manager.reserve(self.wh_id, "Apple", 6.0)
+        self.assertIsNotNone(first)
+        self.assertEqual(self.manager.available(self.wh_id, "Apple"), 4)
+        self.assertIsNone(self.manager.reserve(self.wh_id, "Apple", 4.5))
+        self.assertIsNotNone(self.manager.reserve(self.wh_id, "Apple", 4.0))
+        self.assertEqual(self.manager.available(self.wh_id, "Apple"), 0)
+
+    def test_reserve_invalid(self):
+        """Test missing products and non-positive quantities are refused."""
+        self.assertIsNone(self.manager.reserve(self.wh_id, "Pear", 1.0))
+        self.assertIsNone(self.manager.reserve(999, "Apple", 1.0))
+        self.assertIsNone(self.manager.reserve(self.wh_id, "Apple", 0))
+        self.assertEqual(self.manager.available(self.wh_id, "Pear"), 0)
+
+    def test_confirm_picks_stock(self):
+        """Test confirming takes the held quantity from the warehouse."""
+        hold = self.manager.reserve(self.wh_id, "Apple", 2.5)
+        self.assertTrue(self.manager.confirm(hold))
+        self.assertFalse(self.manager.confirm(hold))
+        warehouse = self.manager.get_warehouse(self.wh_id)
+        self.assertEqual(warehouse['varasto'].saldo, 7.5)
+        self.assertEqual(dict(warehouse['products']), {'Apple': 7.5})
+        self.assertTrue(self.manager.confirm(
+            self.manager.reserve(self.wh_id, "Apple", 7.5)
+        ))
+        self.assertEqual(self.manager.get_products(self.wh_id), {})
+        self.assertEqual(self.manager.find_drift(), {})
+
+    def test_release_frees_stock(self):
+        """Test releasing makes the held quantity available again."""
+        hold = self.manager.reserve(self.wh_id, "Apple", 10.0)
+        self.assertTrue(self.manager.release(hold))
+        self.assertFalse(self.manager.release(hold))
+        self.assertFalse(self.manager.confirm(hold))
+        self.assertEqual(self.manager.available(self.wh_id, "Apple"), 10)
+
+    def test_holds_expire(self):
+        """Test expired holds can no longer be confirmed."""
+        hold = self.manager.reserve(self.wh_id, "Apple", 10.0, ttl=60)
+        self.now += 60
+        self.assertEqual(self.manager.available(self.wh_id, "Apple"), 10)
+        self.assertFalse(self.manager.confirm(hold))
+        self.assertFalse(self.manager.release(hold))
+
+    def test_removing_product_drops_holds(self):
+        """Test holds of a removed product are dropped."""
+        hold = self.manager.reserve(self.wh_id, "Apple", 1.0)
+        self.manager.remove_product(self.wh_id, "Apple")
+        self.manager.add_product(self.wh_id, "Apple", 1.0)
+        self.assertFalse(self.manager.confirm(hold))
+        self.assertEqual(self.manager.available(self.wh_id, "Apple"), 1)
+
+    def test_concurrent_reservations_never_oversell(self):
+        """Test concurrent reservations hold at most the stock."""
+        self.set_clock(time.time)
+        holds = []
+
+        def reserve():
+            for _ in range(5):
+                hold = self.manager.reserve(self.wh_id, "Apple", 1.0)
+                if hold is not None:
+                    holds.append(hold)
+
+        threads = [threading.Thread(target=reserve) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(holds), 10)
+        self.assertEqual(len(set(holds)), 10)
+        self.assertEqual(self.manager.available(self.wh_id, "Apple"), 0)
+
+
+class TestReservations(ReservationTests, unittest.TestCase):
+    """Tests for reservations with SQLite storage."""
+
+    mode = 'sqlite'
+
+    def _stored_holds(self):
+        """Count the reservation rows in the database."""
+        conn = self.manager._get_connection()  # pylint: disable=protected-access
+        try:
+            return conn.execute(
+                "SELECT COUNT(*) FROM reservations"
+            ).fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_timer_reclaims_due_holds(self):
+        """Test the timer deletes exactly the holds that are due."""
+        self.manager.reserve(self.wh_id, "Apple", 1.0, ttl=10)
+        self.manager.reserve(self.wh_id, "Apple", 1.0, ttl=20)
+        self.now += 10
+        self.assertEqual(self.manager.holds.reclaim(), 1)
+        self.assertEqual(self.manager.holds.reclaim(), 0)
+        self.assertEqual(self._stored_holds(), 1)
+
+    def test_timer_thread_reclaims_at_deadline(self):
+        """Test the background thread deletes holds when they expire."""
+        self.set_clock(time.time)
+        self.manager.reserve(self.wh_id, "Apple", 1.0, ttl=0.05)
+        started = time.monotonic()
+        while self._stored_holds():
+            self.assertLess(time.monotonic() - started, 2.0)
+            time.sleep(0.01)
+        self.assertEqual(len(self.manager.holds), 0)
+
+    def test_timer_loads_stored_holds(self):
+        """Test holds of an earlier run are reclaimed after a restart."""
+        self.manager.reserve(self.wh_id, "Apple", 1.0, ttl=10)
+        self.manager.holds.stop()
+        restarted = WarehouseManager(self.manager.db_path)
+        restarted.holds.clock = lambda: START
+        restarted.holds.start()
+        restarted.holds.stop()
+        restarted.holds.clock = lambda: START + 10
+        self.assertEqual(restarted.holds.reclaim(), 1)
+
+    def test_deleting_warehouse_deletes_holds(self):
+        """Test holds are deleted with their warehouse."""
+        self.manager.reserve(self.wh_id, "Apple", 1.0)
+        self.manager.delete_warehouse(self.wh_id)
+        self.assertEqual(self._stored_holds(), 0)
+
+
+class TestMemoryReservations(ReservationTests, unittest.TestCase):
+    """Tests for reservations with memory storage."""
+
+    mode = 'memory'
+
+    def test_confirmed_pick_is_flushed(self):
+        """Test the picked stock is persisted by the next flush."""
+        self.manager.confirm(self.manager.reserve(self.wh_id, "Apple", 4.0))
+        self.manager.flush()
+        stored = WarehouseManager(self.manager.db_path)
+        self.assertEqual(stored.get_products(self.wh_id), {'Apple': 6})
+
+
+class TestShardedReservations(ReservationTests, unittest.TestCase):
+    """Tests for reservations with sharded storage."""
+
+    mode = 'sharded'
+
+    def set_clock(self, clock):
+        """Set the clock of the holds of every shard."""
+        for shard in self.manager.shards:
+            shard.holds.clock = clock
+
+    def test_reservation_ids_route_to_shards(self):
+        """Test reservations on different shards get distinct ids."""
+        other = self.manager.create_warehouse("Other", 100.0)
+        self.manager.add_product(other, "Apple", 1.0)
+        first = self.manager.reserve(self.wh_id, "Apple", 1.0)
+        second = self.manager.reserve(other, "Apple", 1.0)
+        self.assertNotEqual(first, second)
+        self.assertTrue(self.manager.confirm(second))
+        self.assertEqual(self.manager.get_products(other), {})
+        self.assertTrue(self.manager.release(first))
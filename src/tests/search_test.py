@@ -0,0 +1,134 @@
+"""Unit tests for warehouse search."""
+import unittest
+from app import SEARCH_MAX_PAGE, create_app
+from tests.storage_modes import StorageModeTests
+
+
+class SearchTests(StorageModeTests):
+    """Search tests run against each storage mode."""
+
+    def setUp(self):
+        """Set up warehouses with products."""
+        super().setUp()
+        self.north = self.manager.create_warehouse("North Depot", 10.0)
+        self.south = self.manager.create_warehouse("South Depot", 10.0,
+                                                   'custom')
+        self.annex = self.manager.create_warehouse("Annex 100%", 4.0)
+        self.manager.add_product(self.north, "Mango", 10.0)
+        self.manager.add_product(self.south, "Mango", 1.0)
+        self.manager.add_product(self.south, "Kiwi", 1.0)
+
+    def search_ids(self, query='', **filters):
+        """Search and return the ids of the matching warehouses."""
+        found = self.manager.search_warehouses(query, filters)
+        return [warehouse['id'] for warehouse in found['warehouses']]
+
+    def test_matches_warehouse_and_product_names(self):
+        """Test words match name substrings of warehouses and products."""
+        self.assertEqual(self.search_ids("depot"), [self.north, self.south])
+        self.assertEqual(self.search_ids("ANG"), [self.north, self.south])
+        self.assertEqual(self.search_ids("depot kiwi"), [self.south])
+        self.assertEqual(self.search_ids("depot pear"), [])
+        self.assertEqual(self.search_ids(), [self.north, self.south,
+                                             self.annex])
+
+    def test_short_words(self):
+        """Test words shorter than a trigram, with LIKE wildcards."""
+        self.assertEqual(self.search_ids("ki"), [self.south])
+        self.assertEqual(self.search_ids("%"), [self.annex])
+        self.assertEqual(self.search_ids("_"), [])
+
+    def test_facets(self):
+        """Test facet counts and filters."""
+        found = self.manager.search_warehouses("depot")
+        self.assertEqual(found['total'], 2)
+        self.assertEqual(found['facets'], {
+            'type': {'custom': 1, 'fruit': 1},
+            'fill': {'0-25%': 1, 'full': 1},
+            'product': {'Mango': 2, 'Kiwi': 1},
+        })
+        self.assertEqual(self.search_ids(fill='full'), [self.north])
+        self.assertEqual(self.search_ids(type='custom'), [self.south])
+        self.assertEqual(self.search_ids(product='Kiwi', type='fruit'), [])
+        self.assertEqual(self.search_ids(product='', type=''),
+                         [self.north, self.south, self.annex])
+
+    def test_invalid_filters(self):
+        """Test unknown facets and fill buckets are refused."""
+        with self.assertRaises(ValueError):
+            self.manager.search_warehouses(filters={'fill': 'half'})
+        with self.assertRaises(ValueError):
+            self.manager.search_warehouses(filters={'site': 'north'})
+
+    def test_pages(self):
+        """Test results are paginated in id order."""
+        ids = [self.manager.create_warehouse(f"Extra {number}", 1.0)
+               for number in range(5)]
+        pages = [self.manager.search_warehouses("extra", page=page,
+                                                per_page=2)
+                 for page in (1, 2, 3, 4)]
+        self.assertEqual([[w['id'] for w in page['warehouses']]
+                          for page in pages],
+                         [ids[:2], ids[2:4], ids[4:], []])
+        self.assertEqual({page['total'] for page in pages}, {5})
+
+    def test_page_beyond_sqlite_integers(self):
+        """Test pages past the largest storable offset are clamped."""
+        client = create_app({'TESTING': True},
+                            manager=self.manager).test_client()
+        response = client.get('/warehouses/search?page=99999999999999999999'
+                              '&per_page=100')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json['page'], response.json['warehouses']),
+                         (SEARCH_MAX_PAGE, []))
+        response = client.get('/search?q=depot&page=99999999999999999999')
+        self.assertEqual(response.status_code, 200)
+
+    def test_index_follows_changes(self):
+        """Test renamed and deleted warehouses are found by new names."""
+        self.manager.update_warehouse(self.annex, "West Store", 4.0)
+        self.manager.delete_warehouse(self.north)
+        self.manager.remove_product(self.south, "Kiwi")
+        self.assertEqual(self.search_ids("annex"), [])
+        self.assertEqual(self.search_ids("store"), [self.annex])
+        self.assertEqual(self.search_ids("depot"), [self.south])
+        self.assertEqual(self.search_ids("kiwi"), [])
+
+
+class TestSearch(SearchTests, unittest.TestCase):
+    """Tests for search with SQLite storage."""
+
+    mode = 'sqlite'
+
+    def test_routes(self):
+        """Test the search page and its JSON variant."""
+        client = create_app({'TESTING': True},
+                            manager=self.manager).test_client()
+        response = client.get('/search?q=mango&type=custom')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'South Depot', response.data)
+        self.assertNotIn(b'North Depot', response.data)
+        response = client.get('/warehouses/search?q=depot&per_page=1&page=2')
+        self.assertEqual(response.json['total'], 2)
+        self.assertEqual(response.json['pages'], 2)
+        self.assertEqual(response.json['warehouses'], [{
+            'id': self.south, 'name': 'South Depot', 'type': 'custom',
+            'balance': 2, 'capacity': 10,
+        }])
+        response = client.get('/warehouses/search?fill=half')
+        self.assertEqual(response.status_code, 400)
+        response = client.get('/search?fill=half')
+        self.assertEqual(response.status_code, 302)
+
+
+class TestMemorySearch(SearchTests, unittest.TestCase):
+    """Tests for search with memory storage."""
+
+    mode = 'memory'
+
+
+class TestShardedSearch(SearchTests, unittest.TestCase):
+    """Tests for search with sharded storage."""
+
+    mode = 'sharded'
+
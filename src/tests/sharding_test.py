@@ -0,0 +1,209 @@
+"""Unit tests for the sharded warehouse storage."""
+import contextvars
+import unittest
+import tempfile
+import shutil
+import os
+from app import create_app
+from sharding import (ShardedWarehouseManager, import_sharded_snapshot,
+                      shard_paths)
+from warehouse_manager import CONFLICT, WarehouseManager, default_db_path
+from tests.memory_store_test import _run_operations, _state
+
+
+class TestShardedWarehouseManager(unittest.TestCase):
+    """Tests for ShardedWarehouseManager class."""
+
+    def setUp(self):
+        """Set up a sharded manager in a temporary directory."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, 'warehouse.db')
+        self.manager = ShardedWarehouseManager(self.db_path, shards=3)
+
+    def tearDown(self):
+        """Stop the manager and remove temporary files."""
+        self.manager.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_shard_paths(self):
+        """Test shard files are named after the directory database."""
+        self.assertEqual(shard_paths('/data/warehouse.db', 2), [
+            '/data/warehouse.shard0.db', '/data/warehouse.shard1.db'
+        ])
+
+    def test_default_path(self):
+        """Test the shards are named after the default database path."""
+        manager = ShardedWarehouseManager(shards=2)
+        self.assertEqual(manager.db_path, default_db_path())
+        self.assertEqual([shard.db_path for shard in manager.shards],
+                         shard_paths(default_db_path(), 2))
+        manager.close()
+
+    def test_fan_out_keeps_context(self):
+        """Test shard calls see the context variables of the caller."""
+        variable = contextvars.ContextVar('variable')
+        variable.set('caller')
+        self.assertEqual(self.manager.fan_out(lambda shard: variable.get()),
+                         ['caller'] * len(self.manager.shards))
+
+    def test_databases_opened_lazily(self):
+        """Test no database file exists before it is used."""
+        self.assertEqual(os.listdir(self.temp_dir), [])
+        self.manager.get_warehouse(4)
+        # Besides the WAL files of the open shard
+        self.assertEqual([name for name in os.listdir(self.temp_dir)
+                          if name.endswith('.db')], ['warehouse.shard1.db'])
+
+    def test_results_match_sqlite_mode(self):
+        """Test operations give the same results as a single database."""
+        direct = WarehouseManager(
+            db_path=os.path.join(self.temp_dir, 'direct.db')
+        )
+        self.assertEqual(_run_operations(self.manager),
+                         _run_operations(direct))
+        self.assertEqual(_state(self.manager), _state(direct))
+
+    def test_warehouses_spread_by_id(self):
+        """Test each warehouse is stored in the shard of its id."""
+        ids = [self.manager.create_warehouse(f"Warehouse {number}", 10.0)
+               for number in range(6)]
+        for index, shard in enumerate(self.manager.shards):
+            stored = [w['id'] for w in shard.get_all_warehouses()]
+            self.assertEqual(stored, [i for i in ids if i % 3 == index])
+        self.assertEqual([w['id'] for w in self.manager.get_all_warehouses()],
+                         ids)
+        self.assertEqual([w['id'] for w in self.manager.iter_warehouses()],
+                         ids)
+
+    def test_names_unique_over_shards(self):
+        """Test names are unique over shards, case-insensitively."""
+        first = self.manager.create_warehouse("Main", 10.0)
+        self.assertIsNone(self.manager.create_warehouse("MAIN", 10.0))
+        second = self.manager.create_warehouse("Other", 10.0)
+        self.assertNotEqual(self.manager.shard_for(first),
+                            self.manager.shard_for(second))
+        self.assertEqual(self.manager.update_warehouse(second, "main", 10.0),
+                         (False, "Name already exists"))
+        self.assertTrue(self.manager.name_exists("main"))
+        self.assertFalse(self.manager.name_exists("main", exclude_id=first))
+
+    def test_failed_rename_releases_name(self):
+        """Test a name reserved for a failed update is released."""
+        wh_id = self.manager.create_warehouse("Main", 10.0)
+        self.manager.add_product(wh_id, "Apple", 5.0)
+        success, _ = self.manager.update_warehouse(wh_id, "New", 1.0)
+        self.assertFalse(success)
+        self.assertFalse(self.manager.name_exists("New"))
+        self.assertTrue(self.manager.name_exists("Main"))
+
+    def test_delete_releases_name(self):
+        """Test deleting a warehouse releases its name."""
+        wh_id = self.manager.create_warehouse("Main", 10.0)
+        self.assertTrue(self.manager.delete_warehouse(wh_id))
+        self.assertIsNotNone(self.manager.create_warehouse("Main", 10.0))
+
+    def test_aggregates_over_shards(self):
+        """Test totals and verification combine all shards."""
+        for number in range(4):
+            wh_id = self.manager.create_warehouse(f"Warehouse {number}", 10.0)
+            self.manager.add_product(wh_id, "Apple", 0.1)
+            self.manager.add_product(wh_id, f"Item {number % 2}", 1.0)
+        self.assertEqual(self.manager.product_totals(),
+                         {'Apple': 0.4, 'Item 0': 2, 'Item 1': 2})
+        report = self.manager.verify_and_repair()
+        self.assertEqual((report['checked'], report['mismatches']), (4, {}))
+        with self.assertRaises(ValueError):
+            self.manager.verify_and_repair(batch_size=0)
+
+    def test_catalog_and_history_over_shards(self):
+        """Test catalog searches and history queries cover all shards."""
+        first = self.manager.create_warehouse("First", 10.0)
+        second = self.manager.create_warehouse("Second", 10.0)
+        self.manager.add_product(first, "Bolt", 1.0)
+        self.manager.add_product(second, "Bolt nut", 1.0)
+        self.assertEqual(self.manager.catalog.search("bolt"),
+                         ['Bolt', 'Bolt nut'])
+        self.assertEqual(self.manager.catalog.fuzzy_search("Bolx")[0], 'Bolt')
+        self.assertIn('Apple', self.manager.catalog.suggested())
+        end = int(self.manager.history.clock()) + 1
+        self.assertEqual(set(self.manager.history.query(end - 60, end)),
+                         {first, second})
+        self.assertEqual(
+            set(self.manager.history.query(end - 60, end, [second])),
+            {second}
+        )
+
+    def test_bulk_operations(self):
+        """Test bulk deletes and moves span shards."""
+        ids = [self.manager.create_warehouse(f"Warehouse {number}", 10.0)
+               for number in range(4)]
+        self.manager.add_product(ids[0], "Apple", 1.0)
+        self.assertEqual(self.manager.move_products(ids[0], ids[1], ["Apple"]),
+                         (True, "Success"))
+        self.assertEqual(self.manager.get_warehouse(ids[1])['products'],
+                         {'Apple': 1})
+        self.assertEqual(self.manager.move_products(ids[1], ids[3], ["Apple"],
+                                                    expected_version=0),
+                         (False, CONFLICT))
+        self.assertEqual(self.manager.move_products(ids[1], ids[3], ["Apple"]),
+                         (True, "Success"))
+        self.assertEqual(self.manager.move_products(ids[0], ids[3], ["Apple"]),
+                         (False, "Nothing to move"))
+        self.assertEqual(self.manager.remove_products(ids[3], ["Apple"]), 1)
+        self.assertEqual(self.manager.delete_warehouses(ids[:3] + [99]), 3)
+        self.assertFalse(self.manager.name_exists("Warehouse 0"))
+        self.assertEqual(len(self.manager.get_all_warehouses()), 1)
+
+    def test_snapshot_round_trip(self):
+        """Test a sharded snapshot imports into a working sharded store."""
+        ids = [self.manager.create_warehouse(f"Warehouse {number}", 10.0)
+               for number in range(5)]
+        self.manager.add_product(ids[0], "Apple", 1.5)
+        self.manager.add_product(ids[4], "Pear", 2.0)
+        self.manager.delete_warehouse(ids[4])
+        snapshot = os.path.join(self.temp_dir, 'snap.bin')
+        counts = self.manager.export_snapshot(snapshot, compress=True)
+        self.assertEqual((counts['warehouses'], counts['products']), (4, 1))
+        copy_path = os.path.join(self.temp_dir, 'copy.db')
+        self.assertEqual(import_sharded_snapshot(snapshot, copy_path, 3),
+                         counts)
+        copy = ShardedWarehouseManager(copy_path, shards=3)
+        try:
+            self.assertEqual(_state(copy), _state(self.manager))
+            self.assertTrue(copy.name_exists("warehouse 3"))
+            self.assertIsNone(copy.create_warehouse("Warehouse 0", 1.0))
+            self.assertEqual(copy.create_warehouse("New", 1.0), ids[4] + 1)
+        finally:
+            copy.close()
+
+    def test_snapshot_of_other_shard_count(self):
+        """Test importing with another number of shards leaves no files."""
+        for number in range(3):
+            self.manager.create_warehouse(f"Warehouse {number}", 10.0)
+        snapshot = os.path.join(self.temp_dir, 'snap.bin')
+        self.manager.export_snapshot(snapshot)
+        copy_path = os.path.join(self.temp_dir, 'copy.db')
+        for shards in (2, 4):
+            with self.assertRaises(ValueError):
+                import_sharded_snapshot(snapshot, copy_path, shards)
+        self.assertFalse([name for name in os.listdir(self.temp_dir)
+                          if name.startswith('copy')])
+
+    def test_snapshot_cli_commands(self):
+        """Test the snapshot commands export and import every shard."""
+        self.manager.create_warehouse("Main", 10.0)
+        runner = create_app({'TESTING': True},
+                            manager=self.manager).test_cli_runner()
+        snapshot = os.path.join(self.temp_dir, 'snap.bin')
+        result = runner.invoke(args=['export-snapshot', snapshot])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("1 warehouses", result.output)
+        copy_path = os.path.join(self.temp_dir, 'copy.db')
+        result = runner.invoke(args=['import-snapshot', '--shards', '3',
+                                     snapshot, copy_path])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("1 warehouses", result.output)
+        result = runner.invoke(args=['import-snapshot', '--shards', '3',
+                                     snapshot, copy_path])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("already exists", result.output)
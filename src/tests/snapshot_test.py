@@ -0,0 +1,143 @@
+"""Unit tests for binary snapshots."""
+import unittest
+import tempfile
+import shutil
+import sqlite3
+import os
+from app import create_app
+from memory_store import MemoryWarehouseManager
+from snapshot import SnapshotReader, export_snapshot, import_snapshot
+from warehouse_manager import WarehouseManager
+
+
+def _dump(db_path):
+    """Get the rows of the snapshot tables of a database."""
+    conn = sqlite3.connect(db_path)
+    try:
+        return {
+            table: conn.execute(f"SELECT * FROM {table} ORDER BY 1").fetchall()
+            for table in ('catalog', 'warehouses', 'products',
+                          'sqlite_sequence')
+        }
+    finally:
+        conn.close()
+
+
+class TestSnapshot(unittest.TestCase):
+    """Tests for snapshot export and import."""
+
+    def setUp(self):
+        """Set up a database with warehouses and products."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = self.path('warehouse.db')
+        self.manager = WarehouseManager(self.db_path)
+        self.ids = [self.manager.create_warehouse(f"Varasto {number}", 100.0)
+                    for number in range(3)]
+        self.manager.add_product(self.ids[0], "Apple", 1.5)
+        self.manager.add_product(self.ids[0], "Mustikka ä", 2.0)
+        self.manager.add_product(self.ids[2], "Apple", 0.001)
+        self.manager.delete_warehouse(self.ids[1])
+
+    def tearDown(self):
+        """Stop the manager and remove temporary files."""
+        self.manager.holds.stop()
+        shutil.rmtree(self.temp_dir)
+
+    def path(self, name):
+        """Get the path of a file in the temporary directory."""
+        return os.path.join(self.temp_dir, name)
+
+    def round_trip(self, compress, chunk_rows=2):
+        """Export and import the database, returning the new database."""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            counts = export_snapshot(conn, self.path('snap.bin'), compress,
+                                     chunk_rows)
+        finally:
+            conn.close()
+        self.assertEqual(counts['products'], 3)
+        self.assertEqual(
+            import_snapshot(self.path('snap.bin'), self.path('copy.db')),
+            counts
+        )
+        return self.path('copy.db')
+
+    def test_round_trip(self):
+        """Test a database is restored exactly, raw and compressed."""
+        for compress in (False, True):
+            with self.subTest(compress=compress):
+                copy = self.round_trip(compress)
+                self.assertEqual(_dump(copy), _dump(self.db_path))
+                os.remove(copy)
+
+    def test_imported_database_is_usable(self):
+        """Test indexes, search and new ids work after an import."""
+        restored = WarehouseManager(self.round_trip(False))
+        self.assertEqual(restored.catalog.search("must"), ["Mustikka ä"])
+        self.assertEqual(restored.get_products(self.ids[0]),
+                         {'Apple': 1.5, 'Mustikka ä': 2})
+        # The deleted id is not reused
+        self.assertGreater(restored.create_warehouse("New", 1.0), self.ids[2])
+        conn = sqlite3.connect(restored.db_path)
+        indexes = {row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        )}
+        conn.close()
+        self.assertIn('idx_products_warehouse_id', indexes)
+        self.assertEqual(restored.find_drift(), {})
+
+    def test_reader_columns(self):
+        """Test integers are read as views and NULLs are kept."""
+        self.manager.export_snapshot(self.path('snap.bin'))
+        with SnapshotReader(self.path('snap.bin')) as reader:
+            chunks = list(reader.chunks())
+            tables = [table for table, _columns in chunks]
+            catalog = chunks[tables.index('catalog')][1]
+            products = chunks[tables.index('products')][1]
+            self.assertIsInstance(products['quantity'], memoryview)
+            self.assertEqual(list(products['quantity']), [1500, 2000, 1])
+            self.assertIn(None, catalog['default_quantity'])
+            self.assertEqual(catalog['name'][-1], "Mustikka ä")
+            del chunks, catalog, products
+
+    def test_import_refuses_existing_database(self):
+        """Test importing never overwrites a database."""
+        self.manager.export_snapshot(self.path('snap.bin'))
+        with self.assertRaises(FileExistsError):
+            import_snapshot(self.path('snap.bin'), self.db_path)
+
+    def test_import_rejects_other_files(self):
+        """Test a file that is not a snapshot is rejected."""
+        with self.assertRaises(ValueError):
+            import_snapshot(self.db_path, self.path('copy.db'))
+        self.assertFalse(os.path.exists(self.path('copy.db')))
+
+    def test_memory_store_flushes_before_export(self):
+        """Test a memory store snapshot includes unflushed changes."""
+        memory = MemoryWarehouseManager(self.db_path, start=False)
+        try:
+            memory.add_product(self.ids[2], "Pear", 3.0)
+            memory.export_snapshot(self.path('snap.bin'))
+        finally:
+            memory.close()
+        import_snapshot(self.path('snap.bin'), self.path('copy.db'))
+        restored = WarehouseManager(self.path('copy.db'))
+        self.assertEqual(restored.get_products(self.ids[2]),
+                         {'Apple': 0.001, 'Pear': 3})
+
+    def test_cli_commands(self):
+        """Test the export-snapshot and import-snapshot commands."""
+        runner = create_app({'TESTING': True},
+                            manager=self.manager).test_cli_runner()
+        result = runner.invoke(
+            args=['export-snapshot', '--compress', self.path('snap.bin')]
+        )
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("2 warehouses, 3 products", result.output)
+        result = runner.invoke(args=['import-snapshot', self.path('snap.bin'),
+                                     self.path('copy.db')])
+        self.assertEqual(result.exit_code, 0)
+        result = runner.invoke(args=['import-snapshot', self.path('snap.bin'),
+                                     self.path('copy.db')])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("already exists", result.output)
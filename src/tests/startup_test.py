@@ -0,0 +1,42 @@
+"""Tests for application startup and import cost."""
+import unittest
+import subprocess
+import sys
+import os
+
+# Seconds allowed for a fresh interpreter to import the app module
+IMPORT_TIME_BUDGET = float(os.environ.get('IMPORT_TIME_BUDGET', '1.5'))
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+print(elapsed)
+print('warehouse_manager' in app.app.extensions)
+"""
+
+
+class TestStartup(unittest.TestCase):
+    """Tests that importing the app stays cheap."""
+
+    def _import_app(self):
+        """Import the app in a fresh interpreter and report the results."""
+        result = subprocess.run(
+            [sys.executable, '-c', IMPORT_SCRIPT],
+            cwd=SRC_DIR, capture_output=True, text=True, check=True
+        )
+        elapsed, manager_created = result.stdout.split()
+        return float(elapsed), manager_created == 'True'
+
+    def test_import_does_not_create_manager(self):
+        """Test importing the app does not touch the database."""
+        _elapsed, manager_created = self._import_app()
+        self.assertFalse(manager_created)
+
+    def test_import_time_budget(self):
+        """Test importing the app stays within the time budget."""
+        elapsed, _manager_created = self._import_app()
+        self.assertLess(elapsed, IMPORT_TIME_BUDGET)
@@ -0,0 +1,44 @@
+"""Base of the test cases run against each storage mode."""
+import tempfile
+import shutil
+import os
+from memory_store import MemoryWarehouseManager
+from sharding import ShardedWarehouseManager
+from warehouse_manager import WarehouseManager
+
+
+class StorageModeTests:
+    """Mixin giving each test a manager of one storage mode.
+
+    Test cases set mode to 'sqlite', 'memory' (without a flusher) or
+    'sharded' (over self.shards databases). setUp creates self.manager on a
+    new temporary database, tearDown stops it and removes the database.
+    """
+
+    mode = 'sqlite'
+    shards = 3
+
+    def create_manager(self, db_path):
+        """Create the manager of the storage mode."""
+        if self.mode == 'memory':
+            return MemoryWarehouseManager(db_path, start=False)
+        if self.mode == 'sharded':
+            return ShardedWarehouseManager(db_path, shards=self.shards)
+        return WarehouseManager(db_path)
+
+    def setUp(self):
+        """Create the manager on a temporary database."""
+        self.temp_dir = tempfile.mkdtemp()
+        self.manager = self.create_manager(
+            os.path.join(self.temp_dir, 'warehouse.db')
+        )
+
+    def tearDown(self):
+        """Stop the manager and remove temporary files."""
+        if self.mode == 'sqlite':
+            self.manager.holds.stop()
+            self.manager.alerts.dispatcher.stop()
+            self.manager.reads.close()
+        else:
+            self.manager.close()
+        shutil.rmtree(self.temp_dir)
@@ -0,0 +1,242 @@
+"""Unit tests for stock transfers between warehouses."""
+import unittest
+import threading
+from unittest import mock
+from app import create_app
+from cross_shard import ShardTransaction
+from tests.storage_modes import StorageModeTests
+
+# Transfers made by each thread of the concurrency test
+ROUNDS = 50
+
+
+class TransferTests(StorageModeTests):
+    """Transfer tests run against each storage mode."""
+
+    def new_warehouse(self, name, capacity):
+        """Create a warehouse that others can transfer to and from."""
+        return self.manager.create_warehouse(name, capacity)
+
+    def setUp(self):
+        """Set up a stocked warehouse and two empty ones."""
+        super().setUp()
+        self.source = self.new_warehouse("Source", 100.0)
+        self.target = self.new_warehouse("Target", 20.0)
+        self.small = self.new_warehouse("Small", 5.0)
+        self.manager.add_product(self.source, "Apple", 10.0)
+        self.manager.add_product(self.source, "Pear", 10.0)
+
+    def stock(self, warehouse_id):
+        """Get the balance and products of a warehouse."""
+        warehouse = self.manager.get_warehouse(warehouse_id)
+        return warehouse['varasto'].saldo, dict(warehouse['products'])
+
+    def test_transfer(self):
+        """Test a quantity is moved, and a product moved out is removed."""
+        self.assertEqual(self.manager.transfer(self.source, self.target,
+                                               "Apple", 4.5),
+                         (True, "Success"))
+        self.assertEqual(self.stock(self.source),
+                         (15.5, {"Apple": 5.5, "Pear": 10}))
+        self.assertEqual(self.stock(self.target), (4.5, {"Apple": 4.5}))
+        self.manager.transfer(self.source, self.target, "Apple", 5.5)
+        self.assertEqual(self.stock(self.source), (10, {"Pear": 10}))
+        self.assertEqual(self.stock(self.target), (10, {"Apple": 10}))
+
+    def test_refused_transfers(self):
+        """Test invalid transfers fail without changing anything."""
+        self.manager.reserve(self.source, "Pear", 8.0)
+        refused = {
+            (self.source, self.small, "Apple", 6.0):
+                "Not enough space in target warehouse",
+            (self.source, self.target, "Apple", 11.0):
+                "Not enough stock in source warehouse",
+            (self.source, self.target, "Pear", 3.0):
+                "Not enough stock in source warehouse",
+            (self.source, self.target, "Kiwi", 1.0):
+                "Not enough stock in source warehouse",
+            (self.source, self.source, "Apple", 1.0):
+                "Cannot transfer to the same warehouse",
+            (self.source, 1000, "Apple", 1.0): "Warehouse not found",
+            (self.source, self.target, "Apple", 0): "Quantity must be positive",
+        }
+        for transfer, message in refused.items():
+            self.assertEqual(self.manager.transfer(*transfer),
+                             (False, message))
+        self.assertEqual(self.stock(self.source),
+                         (20, {"Apple": 10, "Pear": 10}))
+        self.assertEqual(self.stock(self.target), (0, {}))
+
+    def test_batches_are_atomic(self):
+        """Test a batch is made in order, all or nothing."""
+        chain = [(self.source, self.target, "Apple", 4.0),
+                 (self.target, self.small, "Apple", 4.0)]
+        self.assertEqual(
+            self.manager.transfer_many(chain + [
+                (self.source, self.small, "Pear", 2.0)
+            ]),
+            (False, "Transfer 3: Not enough space in target warehouse")
+        )
+        self.assertEqual(self.stock(self.small), (0, {}))
+        self.assertEqual(self.manager.transfer_many(chain),
+                         (True, "Success"))
+        self.assertEqual(self.stock(self.source),
+                         (16, {"Apple": 6, "Pear": 10}))
+        self.assertEqual(self.stock(self.target), (0, {}))
+        self.assertEqual(self.stock(self.small), (4, {"Apple": 4}))
+        self.assertEqual(self.manager.transfer_many([]),
+                         (False, "Nothing to transfer"))
+
+    def test_concurrent_opposing_transfers(self):
+        """Test opposing transfers neither deadlock nor lose stock."""
+        self.manager.add_product(self.target, "Apple", 10.0)
+        results = []
+
+        def transfer_back_and_forth(source_id, target_id):
+            for _ in range(ROUNDS):
+                results.append(self.manager.transfer_many([
+                    (source_id, target_id, "Apple", 1.0),
+                    (target_id, source_id, "Apple", 1.0),
+                ]))
+
+        threads = [threading.Thread(target=transfer_back_and_forth,
+                                    args=ids)
+                   for ids in ((self.source, self.target),
+                               (self.target, self.source))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [(True, "Success")] * 2 * ROUNDS)
+        self.assertEqual(self.stock(self.source),
+                         (20, {"Apple": 10, "Pear": 10}))
+        self.assertEqual(self.stock(self.target), (10, {"Apple": 10}))
+
+
+class TestTransfer(TransferTests, unittest.TestCase):
+    """Tests for transfers with SQLite storage."""
+
+    mode = 'sqlite'
+
+    def test_routes(self):
+        """Test the transfer form and the JSON batch route."""
+        client = create_app({'TESTING': True},
+                            manager=self.manager).test_client()
+        response = client.post(f'/warehouse/{self.source}/transfer', data={
+            'product_name': 'Apple', 'quantity': '2',
+            'target_id': str(self.target),
+        }, follow_redirects=True)
+        self.assertIn(b'Transferred 2.0 units of Apple', response.data)
+        response = client.post('/transfers', json={'transfers': [
+            {'source_id': self.source, 'target_id': self.target,
+             'product': 'Pear', 'quantity': 1},
+            {'source_id': self.target, 'target_id': self.small,
+             'product': 'Apple', 'quantity': 2},
+        ]})
+        self.assertEqual(response.json, {'success': True,
+                                         'message': 'Success'})
+        response = client.post('/transfers', json={'transfers': [
+            {'source_id': self.source, 'target_id': self.small,
+             'product': 'Pear', 'quantity': 9},
+        ]})
+        self.assertEqual(response.status_code, 409)
+        response = client.post('/transfers', json={'transfers': [
+            {'source_id': self.source, 'product': 'Pear', 'quantity': 1},
+        ]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stock(self.target), (1, {"Pear": 1}))
+        self.assertEqual(self.stock(self.small), (2, {"Apple": 2}))
+
+    def test_routes_reject_invalid_quantities(self):
+        """Test non-finite, huge and non-positive quantities are refused."""
+        client = create_app({'TESTING': True},
+                            manager=self.manager).test_client()
+        for quantity in ('nan', 'inf', '-inf', '1e300', '0', '-1'):
+            response = client.post(f'/warehouse/{self.source}/transfer',
+                                   data={'product_name': 'Apple',
+                                         'quantity': quantity,
+                                         'target_id': str(self.target)},
+                                   follow_redirects=True)
+            self.assertIn(b'Invalid transfer!', response.data)
+        for quantity in ('NaN', 'Infinity', '1e300', '"inf"', '0', '-1'):
+            response = client.post(
+                '/transfers', content_type='application/json',
+                data=f'{{"transfers": [{{"source_id": {self.source}, '
+                     f'"target_id": {self.target}, "product": "Apple", '
+                     f'"quantity": {quantity}}}]}}'
+            )
+            self.assertEqual(response.status_code, 400, quantity)
+        self.assertEqual(self.stock(self.target), (0, {}))
+
+    def test_form_rejects_invalid_target(self):
+        """Test target ids that are not storable integers are refused."""
+        client = create_app({'TESTING': True},
+                            manager=self.manager).test_client()
+        for target_id in ('\u00b2', str(2 ** 63), 'x'):
+            response = client.post(f'/warehouse/{self.source}/transfer',
+                                   data={'product_name': 'Apple',
+                                         'quantity': '1',
+                                         'target_id': target_id},
+                                   follow_redirects=True)
+            self.assertIn(b'Invalid transfer!', response.data)
+
+    def test_json_rejects_invalid_ids(self):
+        """Test ids that are not storable JSON integers are refused."""
+        client = create_app({'TESTING': True},
+                            manager=self.manager).test_client()
+        for bad_id in (10 ** 30, 2 ** 63, -1, 0, 1.5, True, str(self.target),
+                       None):
+            for field in ('source_id', 'target_id'):
+                transfer = {'source_id': self.source,
+                            'target_id': self.target, 'product': 'Apple',
+                            'quantity': 1, field: bad_id}
+                response = client.post('/transfers',
+                                       json={'transfers': [transfer]})
+                self.assertEqual(response.status_code, 400, (field, bad_id))
+        self.assertEqual(self.stock(self.target), (0, {}))
+
+
+class TestMemoryTransfer(TransferTests, unittest.TestCase):
+    """Tests for transfers with memory storage."""
+
+    mode = 'memory'
+
+
+class TestShardedTransfer(TransferTests, unittest.TestCase):
+    """Tests for transfers with sharded storage, between shards."""
+
+    mode = 'sharded'
+    shards = 2
+
+    def test_between_shards(self):
+        """Test the warehouses of the tests are on different shards."""
+        self.assertEqual({self.manager.shard_for(warehouse_id)
+                          for warehouse_id in (self.source, self.small)},
+                         {self.manager.shard_for(self.source)})
+        self.assertNotEqual(self.manager.shard_for(self.source),
+                            self.manager.shard_for(self.target))
+
+    def test_interrupted_change_is_completed(self):
+        """Test a change committed on only some shards is completed."""
+
+        def commit_first_shard(transaction):
+            next(iter(transaction._conns.values())).commit()
+            raise RuntimeError("Stopped")
+
+        with mock.patch.object(ShardTransaction, 'commit',
+                               commit_first_shard):
+            with self.assertRaises(RuntimeError):
+                self.manager.transfer(self.source, self.target, "Apple", 4.0)
+        self.assertEqual(len(self.manager._cross_shard.pending()), 1)
+        self.manager.close()
+        self.manager = self.create_manager(self.manager.db_path)
+        self.assertEqual(self.manager._cross_shard.pending(), [])
+        self.assertEqual(self.stock(self.source),
+                         (16, {"Apple": 6, "Pear": 10}))
+        self.assertEqual(self.stock(self.target), (4, {"Apple": 4}))
+        self.manager.close()
+        self.manager = self.create_manager(self.manager.db_path)
+        self.assertEqual(self.stock(self.target), (4, {"Apple": 4}))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -94,3 +94,30 @@ class TestVarasto(unittest.TestCase):
         """Testaa merkkijonoesitystä"""
         self.varasto.lisaa_varastoon(5)
         self.assertEqual(str(self.varasto), "saldo = 5, vielä tilaa 5")
+
+    def test_lisays_ja_otto_pysyy_tarkkana(self):
+        """Testaa, ettei saldo ala ajelehtia toistuvissa lisäyksissä
+        ja otoissa."""
+        varasto = Varasto(100.0)
+        for _ in range(10000):
+            varasto.lisaa_varastoon(50.7)
+            varasto.ota_varastosta(3.14)
+            varasto.ota_varastosta(47.56)
+
+        self.assertEqual(varasto.saldo, 0)
+        self.assertEqual(varasto.saldo_yks, 0)
+
+    def test_yksikoista(self):
+        """Testaa varaston luominen tuhannesosayksiköistä."""
+        varasto = Varasto.yksikoista(10000, 2500)
+
+        self.assertEqual(varasto.tilavuus, 10)
+        self.assertEqual(varasto.saldo, 2.5)
+
+    def test_lisaa_ja_ota_yksikoita(self):
+        """Testaa lisäämistä ja ottamista tuhannesosayksikköinä."""
+        self.varasto.lisaa_yksikoita(1500)
+        saatu_maara = self.varasto.ota_yksikoita(500)
+
+        self.assertEqual(saatu_maara, 500)
+        self.assertEqual(self.varasto.saldo_yks, 1000)
@@ -3,7 +3,36 @@ import unittest
 import tempfile
 import os
 import sqlite3
-from warehouse_manager import WarehouseManager
+import time
+import threading
+from unittest import mock
+from warehouse_manager import (CONFLICT, MAX_ATTEMPTS, ConflictError,
+                               WarehouseManager)
+
+# Schema of databases created before the product catalog was added
+LEGACY_SCHEMA = """
+CREATE TABLE warehouses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    capacity REAL NOT NULL DEFAULT 0.0,
+    balance REAL NOT NULL DEFAULT 0.0,
+    type TEXT NOT NULL DEFAULT 'fruit',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE products (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    warehouse_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    quantity REAL NOT NULL DEFAULT 0.0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (warehouse_id) REFERENCES warehouses(id) ON DELETE CASCADE,
+    UNIQUE(warehouse_id, name)
+);
+CREATE INDEX idx_products_warehouse_id ON products(warehouse_id);
+CREATE INDEX idx_warehouses_name ON warehouses(name);
+"""
 
 
 class TestWarehouseManager(unittest.TestCase):
@@ -50,6 +79,49 @@ class TestWarehouseManager(unittest.TestCase):
         warehouse = self.manager.get_warehouse(999)
         self.assertIsNone(warehouse)
 
+    def test_get_warehouse_products_loaded_lazily(self):
+        """Test products are only queried when first accessed."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 10.0)
+        statements = []
+        self.manager.trace_callback = statements.append
+        warehouse = self.manager.get_warehouse(wh_id)
+        self.assertFalse(any('products' in s for s in statements))
+        self.assertAlmostEqual(warehouse['products']['Apple'], 10.0)
+        self.assertEqual(dict(warehouse['products']), {'Apple': 10.0})
+        queries = [s for s in statements if 'FROM products' in s]
+        self.assertEqual(len(queries), 1)
+
+    def test_get_warehouse_header_projection(self):
+        """Test header projection omits products."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        warehouse = self.manager.get_warehouse(wh_id, projection='header')
+        self.assertEqual(warehouse['name'], 'Test')
+        self.assertAlmostEqual(warehouse['varasto'].tilavuus, 100.0)
+        self.assertNotIn('products', warehouse)
+
+    def test_get_warehouse_column_projection(self):
+        """Test column projection returns only requested columns."""
+        wh_id = self.manager.create_warehouse("Test", 100.0, "custom")
+        warehouse = self.manager.get_warehouse(wh_id, projection=('type',))
+        self.assertEqual(warehouse, {'type': 'custom'})
+
+    def test_get_warehouse_column_projection_not_found(self):
+        """Test column projection of a non-existent warehouse."""
+        self.assertIsNone(self.manager.get_warehouse(999, projection=['id']))
+
+    def test_get_warehouse_invalid_projection(self):
+        """Test unknown projection columns are rejected."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        with self.assertRaises(ValueError):
+            self.manager.get_warehouse(wh_id, projection=('password',))
+
+    def test_get_products(self):
+        """Test getting the products of a warehouse."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 10.0)
+        self.assertEqual(self.manager.get_products(wh_id), {'Apple': 10.0})
+
     def test_get_all_warehouses(self):
         """Test getting all warehouses."""
         self.manager.create_warehouse("First", 100.0)
@@ -57,6 +129,19 @@ class TestWarehouseManager(unittest.TestCase):
         warehouses = self.manager.get_all_warehouses()
         self.assertEqual(len(warehouses), 2)
 
+    def test_iter_warehouses(self):
+        """Test iterating warehouses with their products in id order."""
+        first = self.manager.create_warehouse("First", 100.0)
+        second = self.manager.create_warehouse("Second", 200.0)
+        self.manager.add_product(second, "Apple", 1.5)
+        self.manager.add_product(second, "Pear", 2.0)
+        warehouses = self.manager.iter_warehouses()
+        self.assertEqual(next(warehouses)['id'], first)
+        self.assertEqual(next(warehouses)['products'],
+                         {"Apple": 1.5, "Pear": 2.0})
+        self.assertIsNone(next(warehouses, None))
+        self.assertEqual(self.manager.get_all_warehouses()[0]['products'], {})
+
     def test_name_exists_true(self):
         """Test name_exists returns True for existing name."""
         self.manager.create_warehouse("Existing", 100.0)
@@ -157,6 +242,94 @@ class TestWarehouseManager(unittest.TestCase):
         self.assertTrue(result)
         self.assertIsNone(self.manager.get_warehouse(wh_id))
 
+    def test_delete_warehouses(self):
+        """Test deleting several warehouses at once."""
+        ids = [self.manager.create_warehouse(f"Test {n}", 10.0)
+               for n in range(3)]
+        self.manager.add_product(ids[0], "Apple", 1.0)
+        self.assertEqual(self.manager.delete_warehouses(ids[:2] + [999]), 2)
+        self.assertEqual([w['id'] for w in self.manager.get_all_warehouses()],
+                         ids[2:])
+        self.assertEqual(self.manager.product_totals(), {})
+
+    def test_remove_products(self):
+        """Test removing several products at once."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        for name in ("Apple", "Pear", "Plum"):
+            self.manager.add_product(wh_id, name, 10.0)
+        removed = self.manager.remove_products(
+            wh_id, ["Apple", "Pear", "Pear", "Missing"]
+        )
+        self.assertEqual(removed, 2)
+        warehouse = self.manager.get_warehouse(wh_id)
+        self.assertEqual(dict(warehouse['products']), {"Plum": 10})
+        self.assertEqual(warehouse['varasto'].saldo, 10)
+        self.assertEqual(warehouse['version'], 4)
+        self.assertEqual(self.manager.remove_products(wh_id, ["Missing"]), 0)
+        with self.assertRaises(ConflictError):
+            self.manager.remove_products(wh_id, ["Plum"], expected_version=3)
+
+    def test_move_products(self):
+        """Test moving products to another warehouse."""
+        source = self.manager.create_warehouse("Source", 100.0)
+        target = self.manager.create_warehouse("Target", 20.0)
+        self.manager.add_product(source, "Apple", 10.0)
+        self.manager.add_product(source, "Pear", 5.0)
+        self.manager.add_product(target, "Apple", 1.0)
+        self.assertEqual(
+            self.manager.move_products(source, target, ["Apple", "Pear"]),
+            (True, "Success")
+        )
+        self.assertEqual(self.manager.get_products(source), {})
+        self.assertEqual(self.manager.get_products(target),
+                         {"Apple": 11, "Pear": 5})
+        self.assertEqual(
+            self.manager.get_warehouse(target)['varasto'].saldo, 16
+        )
+        self.assertEqual(self.manager.find_drift(), {})
+
+    def test_move_products_all_or_nothing(self):
+        """Test nothing is moved unless all products fit in the target."""
+        source = self.manager.create_warehouse("Source", 100.0)
+        target = self.manager.create_warehouse("Target", 10.0)
+        self.manager.add_product(source, "Apple", 6.0)
+        self.manager.add_product(source, "Pear", 5.0)
+        self.assertEqual(
+            self.manager.move_products(source, target, ["Apple", "Pear"]),
+            (False, "Not enough space in target warehouse")
+        )
+        self.assertEqual(self.manager.get_products(source),
+                         {"Apple": 6, "Pear": 5})
+        self.assertEqual(self.manager.get_products(target), {})
+
+    def test_move_products_invalid(self):
+        """Test moves that are not possible."""
+        source = self.manager.create_warehouse("Source", 100.0)
+        target = self.manager.create_warehouse("Target", 10.0)
+        self.manager.add_product(source, "Apple", 1.0)
+        self.assertEqual(self.manager.move_products(source, source, ["Apple"]),
+                         (False, "Cannot move to the same warehouse"))
+        self.assertEqual(self.manager.move_products(source, 999, ["Apple"]),
+                         (False, "Warehouse not found"))
+        self.assertEqual(self.manager.move_products(source, target, ["Pear"]),
+                         (False, "Nothing to move"))
+        self.assertEqual(
+            self.manager.move_products(source, target, ["Apple"], 0),
+            (False, CONFLICT)
+        )
+
+    def test_move_products_keeps_reserved_stock(self):
+        """Test reserved stock stays for its reservation when moving."""
+        source = self.manager.create_warehouse("Source", 100.0)
+        target = self.manager.create_warehouse("Target", 100.0)
+        self.manager.add_product(source, "Apple", 10.0)
+        hold = self.manager.reserve(source, "Apple", 4.0)
+        self.manager.move_products(source, target, ["Apple"])
+        self.assertEqual(self.manager.get_products(source), {"Apple": 4})
+        self.assertEqual(self.manager.get_products(target), {"Apple": 6})
+        self.assertTrue(self.manager.confirm(hold))
+        self.manager.holds.stop()
+
     def test_available_products_exists(self):
         """Test AVAILABLE_PRODUCTS class attribute exists."""
         self.assertIn("Apple", WarehouseManager.AVAILABLE_PRODUCTS)
@@ -167,12 +340,264 @@ class TestWarehouseManager(unittest.TestCase):
         self.assertIsNotNone(manager.db_path)
         self.assertTrue(manager.db_path.endswith('warehouse.db'))
 
+    def test_products_share_catalog_entry(self):
+        """Test the same product in two warehouses uses one catalog row."""
+        first = self.manager.create_warehouse("First", 100.0)
+        second = self.manager.create_warehouse("Second", 100.0)
+        self.manager.add_product(first, "Widget", 1.0)
+        self.manager.add_product(second, "Widget", 2.0)
+        conn = sqlite3.connect(self.temp_db.name)
+        rows = conn.execute(
+            "SELECT COUNT(DISTINCT product_id) FROM products"
+        ).fetchone()[0]
+        conn.close()
+        self.assertEqual(rows, 1)
+
+    def test_product_totals(self):
+        """Test per-product totals over all warehouses."""
+        first = self.manager.create_warehouse("First", 100.0)
+        second = self.manager.create_warehouse("Second", 100.0)
+        self.manager.add_product(first, "Apple", 10.0)
+        self.manager.add_product(second, "Apple", 5.0)
+        self.manager.add_product(second, "Pear", 1.0)
+        self.assertEqual(self.manager.product_totals(),
+                         {"Apple": 15.0, "Pear": 1.0})
+
+    def test_quantities_do_not_drift(self):
+        """Test repeated adds and removes keep balance exact."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        for _ in range(50):
+            self.manager.add_product(wh_id, "Juice", 50.7)
+            self.manager.add_product(wh_id, "Beer", 3.14)
+            self.manager.remove_product(wh_id, "Juice")
+            self.manager.remove_product(wh_id, "Beer")
+        warehouse = self.manager.get_warehouse(wh_id)
+        self.assertEqual(warehouse['varasto'].saldo, 0)
+        self.assertEqual(self.manager.find_drift(), {})
+
+    def test_quantities_stored_as_integers(self):
+        """Test quantities are stored as integer milli-units."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 2.5)
+        conn = sqlite3.connect(self.temp_db.name)
+        row = conn.execute(
+            """SELECT typeof(w.balance), w.balance, typeof(p.quantity)
+               FROM warehouses w JOIN products p ON p.warehouse_id = w.id"""
+        ).fetchone()
+        conn.close()
+        self.assertEqual(row, ('integer', 2500, 'integer'))
+
+    def test_add_product_non_positive_quantity(self):
+        """Test adding zero or negative quantities fails."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.assertFalse(self.manager.add_product(wh_id, "Apple", 0))
+        self.assertFalse(self.manager.add_product(wh_id, "Apple", -1.0))
+
+    def test_add_product_fills_exactly(self):
+        """Test a warehouse can be filled exactly to capacity."""
+        wh_id = self.manager.create_warehouse("Test", 0.3)
+        self.assertTrue(self.manager.add_product(wh_id, "Apple", 0.1))
+        self.assertTrue(self.manager.add_product(wh_id, "Pear", 0.2))
+        self.assertFalse(self.manager.add_product(wh_id, "Pear", 0.001))
+
+    def test_find_drift(self):
+        """Test drift between balance and product sum is detected."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 10.0)
+        conn = sqlite3.connect(self.temp_db.name)
+        conn.execute("UPDATE warehouses SET balance = 12000")
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.manager.find_drift(), {wh_id: (12, 10)})
+
+    def _set_balance(self, warehouse_id, units):
+        """Overwrite a balance directly in the database."""
+        conn = sqlite3.connect(self.temp_db.name)
+        conn.execute("UPDATE warehouses SET balance = ? WHERE id = ?",
+                     (units, warehouse_id))
+        conn.commit()
+        conn.close()
+
+    def test_verify_in_batches(self):
+        """Test verification checks every warehouse over several ranges."""
+        ids = [self.manager.create_warehouse(f"W{n}", 100.0) for n in range(5)]
+        for wh_id in ids:
+            self.manager.add_product(wh_id, "Apple", 1.5)
+        self._set_balance(ids[1], 0)
+        self._set_balance(ids[4], 2000)
+        report = self.manager.verify_and_repair(batch_size=2)
+        self.assertEqual(report, {
+            'checked': 5,
+            'mismatches': {ids[1]: (0, 1.5), ids[4]: (2, 1.5)},
+            'repaired': 0
+        })
+
+    def test_verify_invalid_batch_size(self):
+        """Test batches of fewer than one warehouse are refused."""
+        for batch_size in (0, -1):
+            with self.assertRaises(ValueError):
+                self.manager.verify_and_repair(batch_size=batch_size)
+
+    def test_verify_and_repair(self):
+        """Test repair sets balances to the product sums."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        empty_id = self.manager.create_warehouse("Empty", 100.0)
+        self.manager.add_product(wh_id, "Apple", 10.0)
+        self._set_balance(wh_id, 12000)
+        self._set_balance(empty_id, 500)
+        report = self.manager.verify_and_repair(repair=True, batch_size=1)
+        self.assertEqual(report['repaired'], 2)
+        self.assertEqual(self.manager.find_drift(), {})
+        warehouse = self.manager.get_warehouse(wh_id, projection='header')
+        self.assertEqual(warehouse['varasto'].saldo, 10)
+
+    def test_verify_pauses_between_batches(self):
+        """Test the pause is applied between id ranges."""
+        for number in range(3):
+            self.manager.create_warehouse(f"W{number}", 10.0)
+        started = time.monotonic()
+        report = self.manager.verify_and_repair(batch_size=1, pause=0.05)
+        self.assertEqual(report['checked'], 3)
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+
+    def _version(self, warehouse_id):
+        """Get the current version of a warehouse."""
+        return self.manager.get_warehouse(warehouse_id, ('version',))['version']
+
+    def _bump_version_on_read(self, times):
+        """Make the next reads of a warehouse row see a concurrent change."""
+        read = self.manager._get_warehouse  # pylint: disable=protected-access
+
+        def stale_read(conn, warehouse_id):
+            row = read(conn, warehouse_id)
+            if stale_read.remaining:
+                stale_read.remaining -= 1
+                self._set_version(warehouse_id, row['version'] + 1)
+            return row
+
+        stale_read.remaining = times
+        return mock.patch.object(self.manager, '_get_warehouse', stale_read)
+
+    def _set_version(self, warehouse_id, version):
+        """Change a version directly in the database."""
+        conn = sqlite3.connect(self.temp_db.name)
+        conn.execute("UPDATE warehouses SET version = ? WHERE id = ?",
+                     (version, warehouse_id))
+        conn.commit()
+        conn.close()
+
+    def test_changes_increment_version(self):
+        """Test every change of a warehouse increments its version."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.assertEqual(self.manager.get_warehouse(wh_id)['version'], 0)
+        self.manager.add_product(wh_id, "Apple", 1.0)
+        self.manager.update_warehouse(wh_id, "Renamed", 50.0)
+        self.manager.remove_product(wh_id, "Apple")
+        self.assertEqual(self._version(wh_id), 3)
+
+    def test_update_with_stale_version_conflicts(self):
+        """Test an update based on an old version is rejected."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 1.0)
+        self.assertEqual(
+            self.manager.update_warehouse(wh_id, "New", 50.0,
+                                          expected_version=0),
+            (False, CONFLICT)
+        )
+        self.assertEqual(
+            self.manager.update_warehouse(wh_id, "New", 50.0,
+                                          expected_version=1),
+            (True, "Success")
+        )
+
+    def test_stale_version_conflicts_without_retry(self):
+        """Test add and remove based on an old version raise a conflict."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        self.manager.add_product(wh_id, "Apple", 1.0)
+        with self.assertRaises(ConflictError):
+            self.manager.add_product(wh_id, "Apple", 1.0, expected_version=0)
+        with self.assertRaises(ConflictError):
+            self.manager.remove_product(wh_id, "Apple", expected_version=0)
+        with self._bump_version_on_read(1), self.assertRaises(ConflictError):
+            self.manager.add_product(wh_id, "Apple", 1.0, expected_version=1)
+        self.assertEqual(self.manager.get_products(wh_id), {"Apple": 1})
+
+    def test_lost_race_is_retried(self):
+        """Test changes losing a compare-and-swap race are retried."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        with self._bump_version_on_read(2):
+            self.assertTrue(self.manager.add_product(wh_id, "Apple", 1.0))
+        with self._bump_version_on_read(2):
+            self.assertEqual(self.manager.update_warehouse(wh_id, "A", 50.0),
+                             (True, "Success"))
+        with self._bump_version_on_read(2):
+            self.assertTrue(self.manager.remove_product(wh_id, "Apple"))
+        self.assertEqual(self._version(wh_id), 9)
+        self.assertEqual(self.manager.find_drift(), {})
+
+    def test_retries_are_bounded(self):
+        """Test a conflict is raised when every attempt loses its race."""
+        wh_id = self.manager.create_warehouse("Test", 100.0)
+        with self._bump_version_on_read(MAX_ATTEMPTS):
+            with self.assertRaises(ConflictError):
+                self.manager.add_product(wh_id, "Apple", 1.0)
+        with self._bump_version_on_read(MAX_ATTEMPTS):
+            self.assertEqual(self.manager.update_warehouse(wh_id, "A", 50.0),
+                             (False, CONFLICT))
+        self.assertEqual(self.manager.get_products(wh_id), {})
+
+    def test_concurrent_increments_are_not_lost(self):
+        """Test concurrent stock increments all reach the balance."""
+        wh_id = self.manager.create_warehouse("Test", 1000.0)
+
+        def add_many():
+            for _ in range(20):
+                self.manager.add_product(wh_id, "Apple", 0.5)
+
+        threads = [threading.Thread(target=add_many) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.manager.get_products(wh_id), {"Apple": 40})
+        self.assertEqual(self.manager.find_drift(), {})
+
+    def test_migrate_name_based_products(self):
+        """Test a database with name-based products is migrated."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = os.path.join(temp_dir, 'legacy.db')
+            conn = sqlite3.connect(db_path)
+            conn.executescript(LEGACY_SCHEMA)
+            conn.execute("""INSERT INTO warehouses (name, capacity, balance)
+                            VALUES ('Old', 100.0, 15.0)""")
+            conn.execute("""INSERT INTO products (warehouse_id, name, quantity)
+                            VALUES (1, 'Apple', 10.0), (1, 'Gizmo', 5.0)""")
+            conn.commit()
+            conn.close()
+
+            manager = WarehouseManager(db_path=db_path)
+            self.assertEqual(manager.get_products(1),
+                             {'Apple': 10.0, 'Gizmo': 5.0})
+            self.assertAlmostEqual(manager.get_warehouse(1)['varasto'].saldo,
+                                   15.0)
+            self.assertTrue(manager.remove_product(1, 'Gizmo'))
+            self.assertEqual(manager.catalog.search('Giz'), ['Gizmo'])
+            self.assertEqual(manager.get_warehouse(1)['version'], 1)
+            self.assertEqual(manager.search_warehouses('old')['total'], 1)
+
+    def test_schema_created_on_first_use(self):
+        """Test constructing a manager does not open the database."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = os.path.join(temp_dir, 'deferred.db')
+            manager = WarehouseManager(db_path=db_path)
+            self.assertFalse(os.path.exists(db_path))
+            self.assertEqual(manager.get_all_warehouses(), [])
+            self.assertTrue(os.path.exists(db_path))
+
     def test_create_warehouse_integrity_error(self):
         """Test IntegrityError handling during warehouse creation."""
-        from unittest import mock
-
         with mock.patch.object(
-            self.manager, 'name_exists', return_value=False
+            self.manager, '_name_taken', return_value=False
         ):
             with mock.patch.object(
                 self.manager, '_get_connection'
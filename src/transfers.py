@@ -0,0 +1,37 @@
+"""Validation and messages of stock transfers between warehouses."""
+
+
+class TransferError(Exception):
+    """A transfer of stock cannot be made, the message tells why.
+
+    number is the position of the failed transfer in a batch, from 1.
+    """
+
+    def __init__(self, message, number=None):
+        """Initialize with the reason and the number of the transfer."""
+        super().__init__(message)
+        self.number = number
+
+
+def check_transfer(quantity, available, room):
+    """Raise TransferError unless a quantity can be transferred.
+
+    available is the unreserved stock in the source and room the free
+    capacity of the target, all in milli-units.
+    """
+    if quantity <= 0:
+        raise TransferError("Quantity must be positive")
+    if quantity > available:
+        raise TransferError("Not enough stock in source warehouse")
+    if quantity > room:
+        raise TransferError("Not enough space in target warehouse")
+
+
+def transfer_message(transfers, error):
+    """Get the failure message of a TransferError raised by transfers.
+
+    Failures of batches tell the number of the failed transfer.
+    """
+    if len(transfers) > 1:
+        return f"Transfer {error.number}: {error}"
+    return str(error)
@@ -1,54 +1,89 @@
 """Tämä moduuli sisältää luokan Varasto."""
+from quantity import from_units, to_units
 
 class Varasto:
     """Varasto on luokka, joka tarjoaa metodeja tavaroiden
     lisäämiseen varastoon,tavaroiden ottamiseen varastosta
     ja antamaan tiedon varaston
     saldosta.
+
+    Määrät tallennetaan kokonaislukuina tuhannesosayksikköinä
+    (tilavuus_yks, saldo_yks), joten laskenta on tarkkaa eikä
+    liukulukuvirhe kasaannu.
     """
     def __init__(self, tilavuus, alku_saldo = 0):
         """_Alustaa Varasto-olion tilavuudella ja alkusaldolla"""
-        self.tilavuus = tilavuus if tilavuus > 0.0 else 0.0
+        tilavuus_yks = to_units(tilavuus)
+        alku_saldo_yks = to_units(alku_saldo)
+        self.tilavuus_yks = tilavuus_yks if tilavuus_yks > 0 else 0
 
-        if alku_saldo < 0.0:
+        if alku_saldo_yks < 0:
             # virheellinen, nollataan
-            self.saldo = 0.0
-        elif alku_saldo <= tilavuus:
+            self.saldo_yks = 0
+        elif alku_saldo_yks <= tilavuus_yks:
             # mahtuu
-            self.saldo = alku_saldo
+            self.saldo_yks = alku_saldo_yks
         else:
             # täyteen ja ylimäärä hukkaan!
-            self.saldo = tilavuus
+            self.saldo_yks = tilavuus_yks
+
+    @classmethod
+    def yksikoista(cls, tilavuus_yks, saldo_yks):
+        """Luo Varasto-olion suoraan tuhannesosayksiköistä
+        ilman muunnoksia."""
+        varasto = cls.__new__(cls)
+        varasto.tilavuus_yks = tilavuus_yks
+        varasto.saldo_yks = saldo_yks
+        return varasto
+
+    @property
+    def tilavuus(self):
+        """Varaston tilavuus."""
+        return from_units(self.tilavuus_yks)
+
+    @property
+    def saldo(self):
+        """Varaston saldo."""
+        return from_units(self.saldo_yks)
 
     # huom: ominaisuus voidaan myös laskea. Ei tarvita erillistä
     #kenttää viela_tilaa tms.
     def paljonko_mahtuu(self):
         """Palauttaa tiedon, paljonko varastossa on tilaa jäljellä."""
-        return self.tilavuus - self.saldo
+        return from_units(self.tilavuus_yks - self.saldo_yks)
 
     def lisaa_varastoon(self, maara):
         """Lisää tavaroita varastoon."""
-        if maara < 0:
+        self.lisaa_yksikoita(to_units(maara))
+
+    def lisaa_yksikoita(self, maara_yks):
+        """Lisää tavaroita varastoon tuhannesosayksikköinä."""
+        if maara_yks < 0:
             return
-        if maara <= self.paljonko_mahtuu():
-            self.saldo = self.saldo + maara
+        if maara_yks <= self.tilavuus_yks - self.saldo_yks:
+            self.saldo_yks = self.saldo_yks + maara_yks
         else:
-            self.saldo = self.tilavuus
+            self.saldo_yks = self.tilavuus_yks
 
     def ota_varastosta(self, maara):
         """Ota tavaroita varastosta.
         Palauttaa, paljonko tavaroita voidaan ottaa"""
-        if maara < 0:
-            return 0.0
-        if maara > self.saldo:
-            kaikki_mita_voidaan = self.saldo
-            self.saldo = 0.0
+        return from_units(self.ota_yksikoita(to_units(maara)))
+
+    def ota_yksikoita(self, maara_yks):
+        """Ota tavaroita varastosta tuhannesosayksikköinä.
+        Palauttaa, paljonko yksiköitä voidaan ottaa"""
+        if maara_yks < 0:
+            return 0
+        if maara_yks > self.saldo_yks:
+            kaikki_mita_voidaan = self.saldo_yks
+            self.saldo_yks = 0
 
             return kaikki_mita_voidaan
 
-        self.saldo = self.saldo - maara
+        self.saldo_yks = self.saldo_yks - maara_yks
 
-        return maara
+        return maara_yks
 
     def __str__(self):
         """Palauttaa Varasto-oliosta merkkijonoesityksen,
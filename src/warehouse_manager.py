@@ -1,13 +1,120 @@
 """Manages multiple warehouses and products using SQLite database."""
 import sqlite3
 import os
+import threading
+import time
+from collections import Counter
+from collections.abc import Mapping
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
 from varasto import Varasto
+from catalog import ProductCatalog
+from alerts import AlertEngine
+from history import CapacityHistory
+from replica import ReadPool
+from reservations import HOLD_SECONDS, HoldTimer
+from search import PER_PAGE, search_warehouses
+from snapshot import export_snapshot
+from quantity import from_units, to_units
+from transfers import TransferError, check_transfer, transfer_message
+from migrations import apply_schema, read_schema
+
+# Columns of the warehouses table that projections may select
+WAREHOUSE_COLUMNS = (
+    'id', 'name', 'capacity', 'balance', 'type', 'created_at', 'updated_at',
+    'version'
+)
+# Columns needed to build a warehouse header (without products)
+HEADER_COLUMNS = ('id', 'name', 'capacity', 'balance', 'type', 'version')
+# Columns holding quantities in integer milli-units
+QUANTITY_COLUMNS = ('capacity', 'balance')
+# Warehouses checked per transaction by verify_and_repair
+VERIFY_BATCH_SIZE = 500
+# Attempts of a compare-and-swap change before a conflict is reported
+MAX_ATTEMPTS = 5
+# update_warehouse message for a conflicting concurrent change
+CONFLICT = "Warehouse was modified concurrently"
+
+
+class ConflictError(Exception):
+    """A warehouse changed since the version a change was based on."""
+
+
+def check_version(version, expected_version):
+    """Raise ConflictError unless version is the expected one (if any)."""
+    if expected_version is not None and version != expected_version:
+        raise ConflictError(
+            f"Expected version {expected_version}, found {version}"
+        )
+
+
+def check_batch_size(batch_size):
+    """Raise ValueError unless batch_size is at least 1."""
+    if batch_size < 1:
+        raise ValueError(f"Batch size must be at least 1, not {batch_size}")
+
+
+def default_db_path():
+    """Get the default database path, warehouse.db next to this file."""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(base_dir, 'warehouse.db')
+
+
+def project_row(row):
+    """Convert a projected row to a dict with quantities in whole units."""
+    return {
+        column: from_units(value) if column in QUANTITY_COLUMNS else value
+        for column, value in dict(row).items()
+    }
+
+
+def record_verified(report, checked, drifted):
+    """Add the result of a verified id range to a verify_and_repair report.
+
+    drifted holds (warehouse id, balance, product total) in milli-units.
+    """
+    report['checked'] += checked
+    for warehouse_id, balance, total in drifted:
+        report['mismatches'][warehouse_id] = (from_units(balance),
+                                              from_units(total))
+
+
+class LazyProducts(Mapping):
+    """Read-only mapping of a warehouse's products, loaded on first access."""
+
+    def __init__(self, manager, warehouse_id):
+        """Initialize with the manager used to load the products."""
+        self._manager = manager
+        self._warehouse_id = warehouse_id
+        self._products = None
+
+    def _load(self):
+        """Load the products from the database if not loaded yet."""
+        if self._products is None:
+            self._products = self._manager.get_products(self._warehouse_id)
+        return self._products
+
+    def __getitem__(self, name):
+        return self._load()[name]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
 
+    def __repr__(self):
+        if self._products is None:
+            return f"LazyProducts(warehouse_id={self._warehouse_id})"
+        return repr(self._products)
 
-class WarehouseManager:
+
+class WarehouseManager:  # pylint: disable=too-many-public-methods
     """Manages multiple warehouses and their products using SQLite database."""
+    # pylint: disable=too-many-instance-attributes
 
-    # Predefined products list with default capacities (for fruit warehouses)
+    # Catalog seed entries with default capacities (for fruit warehouses)
     AVAILABLE_PRODUCTS = {
         "Apple": 5.0,
         "Banana": 3.0,
@@ -23,63 +130,95 @@ class WarehouseManager:
 
     def __init__(self, db_path=None):
         """Initialize the warehouse manager with SQLite database."""
-        if db_path is None:
-            # Get the directory where this file is located
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-            db_path = os.path.join(base_dir, 'warehouse.db')
-        self.db_path = db_path
-        self._init_db()
+        self.db_path = db_path if db_path is not None else default_db_path()
+        # Optional callable receiving each executed SQL statement
+        self.trace_callback = None
+        # The schema is applied on first connection, not at construction
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+        self.catalog = ProductCatalog(self._get_connection)
+        self.history = CapacityHistory(self._get_connection)
+        # Read-only connections of the query methods, see replica.py
+        self.reads = ReadPool(self.db_path)
+        self.holds = self._create_holds()
+        self.alerts = self._create_alerts()
+
+    def _create_holds(self):
+        """Create the timer reclaiming expired reservations."""
+        return HoldTimer(self._get_connection)
+
+    def _create_alerts(self):
+        """Create the engine evaluating threshold alert rules."""
+        return AlertEngine(self._get_connection, self.catalog)
 
     def _get_connection(self):
         """Get a database connection."""
         conn = sqlite3.connect(self.db_path)
         conn.row_factory = sqlite3.Row
         conn.execute("PRAGMA foreign_keys = ON")
+        if self.trace_callback is not None:
+            conn.set_trace_callback(self.trace_callback)
+        if not self._schema_ready:
+            self._ensure_schema(conn)
         return conn
 
-    def _init_db(self):
+    @contextmanager
+    def _read_connection(self):
+        """Lend a read-only connection from self.reads."""
+        if not self._schema_ready:
+            self._get_connection().close()
+        with self.reads.connection() as conn:
+            conn.set_trace_callback(self.trace_callback)
+            yield conn
+
+    def _ensure_schema(self, conn):
+        """Initialize the schema once, on the first connection."""
+        with self._schema_lock:
+            if not self._schema_ready:
+                self._init_db(conn)
+                self._schema_ready = True
+
+    def _init_db(self, conn):
         """Initialize the database with schema."""
-        # Get the schema file path
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        schema_path = os.path.join(base_dir, 'schema.sql')
-
-        conn = self._get_connection()
-        try:
-            with open(schema_path, 'r', encoding='utf-8') as f:
-                conn.executescript(f.read())
-            conn.commit()
-        finally:
-            conn.close()
+        # Readers see the last commit without blocking writers
+        conn.execute("PRAGMA journal_mode = WAL")
+        apply_schema(conn, read_schema())
+        self.catalog.add_defaults(conn, self.AVAILABLE_PRODUCTS)
+        conn.commit()
 
     def name_exists(self, name, exclude_id=None):
         """Check if a warehouse name already exists."""
-        conn = self._get_connection()
-        try:
-            if exclude_id is None:
-                cursor = conn.execute(
-                    "SELECT id FROM warehouses WHERE LOWER(name) = LOWER(?)",
-                    (name,)
-                )
-            else:
-                query = """SELECT id FROM warehouses
-                           WHERE LOWER(name) = LOWER(?) AND id != ?"""
-                cursor = conn.execute(query, (name, exclude_id))
-            return cursor.fetchone() is not None
-        finally:
-            conn.close()
+        with self._read_connection() as conn:
+            return self._name_taken(conn, name, exclude_id)
+
+    def _name_taken(self, conn, name, exclude_id=None):
+        """Check on a connection if another warehouse has the name."""
+        cursor = conn.execute(
+            """SELECT id FROM warehouses
+               WHERE LOWER(name) = LOWER(?) AND id IS NOT ?""",
+            (name, exclude_id)
+        )
+        return cursor.fetchone() is not None
 
     def create_warehouse(self, name, capacity, warehouse_type='fruit'):
         """Create a new warehouse with given name, capacity and type."""
-        if self.name_exists(name):
-            return None  # Name already exists
+        return self._insert_warehouse(None, name, capacity, warehouse_type)
 
+    def _insert_warehouse(self, warehouse_id, name, capacity, warehouse_type):
+        """Insert a warehouse under an id, or a new id if None.
+
+        Returns the id, or None if the name or id is taken.
+        """
         conn = self._get_connection()
         try:
+            if self._name_taken(conn, name):
+                return None  # Name already exists
             cursor = conn.execute(
-                """INSERT INTO warehouses (name, capacity, balance, type)
-                   VALUES (?, ?, 0.0, ?)""",
-                (name, capacity, warehouse_type)
+                """INSERT INTO warehouses (id, name, capacity, balance, type)
+                   VALUES (?, ?, ?, 0, ?)""",
+                (warehouse_id, name, to_units(capacity), warehouse_type)
             )
+            self._changed(conn, cursor.lastrowid)
             conn.commit()
             return cursor.lastrowid
         except sqlite3.IntegrityError:
@@ -87,110 +226,330 @@ class WarehouseManager:
         finally:
             conn.close()
 
-    def _build_warehouse_dict(self, row, products):
-        """Build a warehouse dictionary from database row."""
-        varasto = Varasto(row['capacity'], row['balance'])
-        return {
+    def _build_warehouse_dict(self, row, products=None):
+        """Build a warehouse dictionary from database row.
+
+        The 'products' key is only present when products are given.
+        """
+        varasto = Varasto.yksikoista(row['capacity'], row['balance'])
+        warehouse = {
             'id': row['id'],
             'name': row['name'],
             'varasto': varasto,
-            'products': products,
-            'type': row['type']
+            'type': row['type'],
+            'version': row['version']
         }
-
-    def get_warehouse(self, warehouse_id):
-        """Get a warehouse by ID."""
-        conn = self._get_connection()
-        try:
+        if products is not None:
+            warehouse['products'] = products
+        return warehouse
+
+    def get_warehouse(self, warehouse_id, projection='full'):
+        """Get a warehouse by ID.
+
+        The projection selects how much is read:
+        - 'full': header plus products, loaded lazily on first access
+        - 'header': id, name, type and Varasto, without products
+        - a sequence of column names: a plain dict of just those columns
+        """
+        columns = self._projection_columns(projection)
+        with self._read_connection() as conn:
             cursor = conn.execute(
-                "SELECT * FROM warehouses WHERE id = ?",
+                f"SELECT {', '.join(columns)} FROM warehouses WHERE id = ?",
                 (warehouse_id,)
             )
             row = cursor.fetchone()
-            if row is None:
-                return None
 
-            # Get products for this warehouse
-            products_cursor = conn.execute(
-                "SELECT name, quantity FROM products WHERE warehouse_id = ?",
-                (warehouse_id,)
-            )
-            products = {
-                p['name']: p['quantity'] for p in products_cursor.fetchall()
-            }
+        if row is None:
+            return None
+        return self._project(row, projection)
 
+    def _project(self, row, projection):
+        """Build the result of get_warehouse for the given projection."""
+        if projection == 'full':
+            products = LazyProducts(self, row['id'])
             return self._build_warehouse_dict(row, products)
+        if projection == 'header':
+            return self._build_warehouse_dict(row)
+        return project_row(row)
+
+    def _projection_columns(self, projection):
+        """Get the columns to read, validating explicit column names."""
+        if projection in ('full', 'header'):
+            return HEADER_COLUMNS
+        columns = tuple(projection)
+        unknown = set(columns) - set(WAREHOUSE_COLUMNS)
+        if unknown or not columns:
+            raise ValueError(f"Invalid projection columns: {sorted(unknown)}")
+        return columns
+
+    def get_products(self, warehouse_id):
+        """Get the products of a warehouse as a name to quantity dict."""
+        with self._read_connection() as conn:
+            return self._read_products(conn, warehouse_id)
+
+    def _read_products(self, conn, warehouse_id):
+        """Read the products of a warehouse with their catalog names."""
+        cursor = conn.execute(
+            """SELECT c.name, p.quantity FROM products p
+               JOIN catalog c ON c.id = p.product_id
+               WHERE p.warehouse_id = ?""",
+            (warehouse_id,)
+        )
+        return {p['name']: from_units(p['quantity']) for p in cursor.fetchall()}
+
+    def product_totals(self):
+        """Get the total quantity of each product over all warehouses."""
+        with self._read_connection() as conn:
+            # The inner aggregate is answered from idx_products_product_id
+            cursor = conn.execute(
+                """SELECT c.name, t.total FROM (
+                       SELECT product_id, SUM(quantity) AS total
+                       FROM products GROUP BY product_id
+                   ) t JOIN catalog c ON c.id = t.product_id
+                   ORDER BY c.name"""
+            )
+            return {row['name']: from_units(row['total']) for row in cursor}
+
+    def search_warehouses(self, query='', filters=None, page=1,
+                          per_page=PER_PAGE):
+        """Search warehouses by their name and product names, see search.py.
+
+        filters maps facets ('type', 'fill', 'product') to the value the
+        results must have. Raises ValueError for invalid filters. Returns
+        a dict with the total number of matches, the warehouses (without
+        products) of the page in id order and the counts of each facet.
+        """
+        with self._read_connection() as conn:
+            found = search_warehouses(conn, query, filters, per_page,
+                                      (page - 1) * per_page)
+        return {'total': found['total'],
+                'warehouses': [self._build_warehouse_dict(row)
+                               for row in found['rows']],
+                'facets': found['facets']}
+
+    def export_snapshot(self, path, compress=False):
+        """Write a binary snapshot of the database, see snapshot.py.
+
+        Returns a dict of table -> number of rows.
+        """
+        conn = self._get_connection()
+        try:
+            return export_snapshot(conn, path, compress)
         finally:
             conn.close()
 
-    def get_all_warehouses(self):
-        """Get all warehouses."""
+    def find_drift(self):
+        """Find warehouses whose balance differs from their products' sum.
+
+        Returns a dict of warehouse id -> (balance, product total).
+        """
+        return self.verify_and_repair()['mismatches']
+
+    def verify_and_repair(self, repair=False, batch_size=VERIFY_BATCH_SIZE,
+                          pause=0.0):
+        """Compare warehouse balances with the sums of their products.
+
+        Warehouses are checked in id ranges of batch_size, each with one
+        grouped query in its own transaction, sleeping pause seconds
+        between ranges to limit the load on a live database. With repair,
+        mismatched balances are set to the product sum in the same
+        transaction as the check.
+
+        Returns a dict with the number of warehouses 'checked', the
+        'mismatches' as warehouse id -> (balance, product total) and the
+        number of balances 'repaired'. Raises ValueError if batch_size is
+        less than 1.
+        """
+        check_batch_size(batch_size)
+        report = {'checked': 0, 'mismatches': {}, 'repaired': 0}
+        last_id = self._verify_range(report, 0, batch_size, repair)
+        while last_id is not None:
+            time.sleep(pause)
+            last_id = self._verify_range(report, last_id, batch_size, repair)
+        return report
+
+    def _verify_range(self, report, after_id, batch_size, repair):
+        """Verify the next id range into report.
+
+        Returns the last id checked, or None when no warehouses were left.
+        """
         conn = self._get_connection()
         try:
-            cursor = conn.execute("SELECT * FROM warehouses ORDER BY id")
-            warehouses = []
-            for row in cursor.fetchall():
-                # Get products for this warehouse
-                query = """SELECT name, quantity FROM products
-                           WHERE warehouse_id = ?"""
-                products_cursor = conn.execute(query, (row['id'],))
-                products = {
-                    p['name']: p['quantity'] for p in products_cursor.fetchall()
-                }
-                warehouses.append(self._build_warehouse_dict(row, products))
-            return warehouses
+            with self.alerts.collect():
+                rows, drifted = self._check_range(conn, after_id, batch_size,
+                                                  repair)
+                conn.commit()
         finally:
             conn.close()
+        if repair:
+            report['repaired'] += len(drifted)
+        record_verified(report, len(rows), drifted)
+        return rows[-1]['id'] if rows else None
+
+    def _check_range(self, conn, after_id, batch_size, repair):
+        """Check (and repair) a range, returning its rows and drifted ids."""
+        if repair:
+            # Hold the write lock so the sums stay valid until fixed
+            conn.execute("BEGIN IMMEDIATE")
+        rows = self._balance_totals(conn, after_id, batch_size)
+        drifted = [(row['id'], row['balance'], row['total'])
+                   for row in rows if row['balance'] != row['total']]
+        if repair:
+            self._repair_balances(conn, drifted)
+        return rows, drifted
+
+    def _balance_totals(self, conn, after_id, limit):
+        """Read balances and product sums of the next limit warehouses."""
+        return conn.execute(
+            """SELECT w.id, w.balance, COALESCE(SUM(p.quantity), 0) AS total
+               FROM warehouses w
+               LEFT JOIN products p ON p.warehouse_id = w.id
+               WHERE w.id > ? GROUP BY w.id ORDER BY w.id LIMIT ?""",
+            (after_id, limit)
+        ).fetchall()
+
+    def _repair_balances(self, conn, drifted):
+        """Set drifted balances to their product sums.
+
+        drifted holds (warehouse id, balance, product total) tuples.
+        """
+        conn.executemany(
+            """UPDATE warehouses
+               SET balance = ?, version = version + 1,
+                   updated_at = CURRENT_TIMESTAMP
+               WHERE id = ?""",
+            [(total, warehouse_id) for warehouse_id, _, total in drifted]
+        )
+        for warehouse_id, _balance, _total in drifted:
+            self._changed(conn, warehouse_id)
 
-    def _validate_update(self, conn, warehouse_id, name, capacity):
-        """Validate warehouse update parameters."""
-        row = self._get_warehouse(conn, warehouse_id)
-        if row is None:
-            return None, "Warehouse not found"
+    def get_all_warehouses(self):
+        """Get all warehouses."""
+        return list(self.iter_warehouses())
+
+    def iter_warehouses(self):
+        """Iterate over all warehouses with their products, in id order.
+
+        The rows of one query are read as the iteration proceeds, so only
+        the current warehouse is held in memory. The read connection is
+        borrowed until the iteration ends or the iterator is closed.
+        """
+        with self._read_connection() as conn:
+            # Scans warehouses in id order, so no sort waits for all rows
+            cursor = conn.execute(
+                """SELECT w.id, w.name, w.capacity, w.balance, w.type,
+                          w.version, c.name AS product, p.quantity
+                   FROM warehouses w
+                   LEFT JOIN products p ON p.warehouse_id = w.id
+                   LEFT JOIN catalog c ON c.id = p.product_id
+                   ORDER BY w.id"""
+            )
+            for _warehouse_id, rows in groupby(cursor, itemgetter('id')):
+                yield self._warehouse_from_rows(list(rows))
+
+    def _warehouse_from_rows(self, rows):
+        """Build a warehouse from its rows of product joined to header."""
+        products = {row['product']: from_units(row['quantity'])
+                    for row in rows if row['product'] is not None}
+        return self._build_warehouse_dict(rows[0], products)
 
-        if self.name_exists(name, exclude_id=warehouse_id):
-            return None, "Name already exists"
+    def _validate_update(self, conn, row, name, capacity):
+        """Validate warehouse update parameters, returning an error or None."""
+        if self._name_taken(conn, name, exclude_id=row['id']):
+            return "Name already exists"
 
         if capacity < row['balance']:
-            return None, "Capacity cannot be less than current balance"
+            return "Capacity cannot be less than current balance"
 
-        return row, None
+        return None
 
-    def update_warehouse(self, warehouse_id, name, capacity):
-        """Update warehouse name and capacity."""
+    def update_warehouse(self, warehouse_id, name, capacity,
+                         expected_version=None):
+        """Update warehouse name and capacity.
+
+        With expected_version the update fails with the CONFLICT message if
+        the warehouse has changed since that version was read. Without it,
+        an update losing a race is validated again and retried.
+        """
+        capacity = to_units(capacity)
         conn = self._get_connection()
         try:
-            _warehouse_row, error = self._validate_update(
-                conn, warehouse_id, name, capacity
-            )
-            if error:
-                return False, error
-
-            conn.execute(
-                """UPDATE warehouses
-                   SET name = ?, capacity = ?, updated_at = CURRENT_TIMESTAMP
-                   WHERE id = ?""",
-                (name, capacity, warehouse_id)
-            )
-            conn.commit()
-            return True, "Success"
+            return self._optimistic(conn, expected_version, lambda: (
+                self._try_update(conn, warehouse_id, name, capacity,
+                                 expected_version)
+            ))
+        except ConflictError:
+            return False, CONFLICT
         finally:
             conn.close()
 
-    def _update_warehouse_balance(self, conn, warehouse_id, new_balance):
-        """Update warehouse balance."""
-        conn.execute(
-            """UPDATE warehouses
-               SET balance = ?, updated_at = CURRENT_TIMESTAMP
-               WHERE id = ?""",
-            (new_balance, warehouse_id)
+    def _try_update(self, conn, warehouse_id, name, capacity,
+                    expected_version):
+        """Attempt a compare-and-swap update of name and capacity."""
+        row = self._get_warehouse(conn, warehouse_id)
+        if row is None:
+            return False, "Warehouse not found"
+        check_version(row['version'], expected_version)
+
+        error = self._validate_update(conn, row, name, capacity)
+        if error:
+            return False, error
+
+        self._swap(conn, row, name=name, capacity=capacity)
+        self._changed(conn, warehouse_id)
+        return True, "Success"
+
+    def _optimistic(self, conn, expected_version, attempt):
+        """Commit the result of attempt(), retrying on version conflicts.
+
+        A change based on an expected version is not retried; otherwise
+        up to MAX_ATTEMPTS attempts are made. Raises ConflictError if
+        none succeeds.
+        """
+        attempts = 1 if expected_version is not None else MAX_ATTEMPTS
+        for remaining in reversed(range(attempts)):
+            try:
+                with self.alerts.collect():
+                    result = attempt()
+                    conn.commit()
+                return result
+            except ConflictError:
+                conn.rollback()
+                if not remaining:
+                    raise
+        return None  # Not reached, the last conflict is raised
+
+    def _changed(self, conn, warehouse_id):
+        """Record the history and evaluate the alerts of a changed warehouse.
+
+        Called in the transaction of the change; the caller commits in
+        self.alerts.collect() so the alerts are sent once committed.
+        """
+        self.history.record(conn, warehouse_id)
+        self.alerts.evaluate(conn, warehouse_id)
+
+    def _swap(self, conn, row, **changes):
+        """Update a warehouse row only if its version is unchanged.
+
+        Increments the version. Raises ConflictError if the row changed
+        since it was read.
+        """
+        assignments = ''.join(f"{column} = ?, " for column in changes)
+        cursor = conn.execute(
+            f"""UPDATE warehouses
+                SET {assignments}version = version + 1,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND version = ?""",
+            (*changes.values(), row['id'], row['version'])
         )
+        if cursor.rowcount == 0:
+            raise ConflictError(f"Warehouse {row['id']} changed concurrently")
 
-    def _upsert_product(self, conn, warehouse_id, product_name, quantity):
+    def _upsert_product(self, conn, warehouse_id, product_id, quantity):
         """Insert or update a product in the warehouse."""
         query = """SELECT * FROM products
-                   WHERE warehouse_id = ? AND name = ?"""
-        cursor = conn.execute(query, (warehouse_id, product_name))
+                   WHERE warehouse_id = ? AND product_id = ?"""
+        cursor = conn.execute(query, (warehouse_id, product_id))
         existing = cursor.fetchone()
 
         if existing:
@@ -198,16 +557,23 @@ class WarehouseManager:
             conn.execute(
                 """UPDATE products
                    SET quantity = ?, updated_at = CURRENT_TIMESTAMP
-                   WHERE warehouse_id = ? AND name = ?""",
-                (new_qty, warehouse_id, product_name)
+                   WHERE id = ?""",
+                (new_qty, existing['id'])
             )
         else:
             conn.execute(
-                """INSERT INTO products (warehouse_id, name, quantity)
+                """INSERT INTO products (warehouse_id, product_id, quantity)
                    VALUES (?, ?, ?)""",
-                (warehouse_id, product_name, quantity)
+                (warehouse_id, product_id, quantity)
             )
 
+    def _store_product(self, conn, row, product_name, quantity):
+        """Add quantity (milli-units) of a product to a warehouse's stock."""
+        product_id = self.catalog.intern(product_name)
+        self._swap(conn, row, balance=row['balance'] + quantity)
+        self._upsert_product(conn, row['id'], product_id, quantity)
+        self._changed(conn, row['id'])
+
     def _get_warehouse(self, conn, warehouse_id):
         """Get a warehouse by ID from the database."""
         cursor = conn.execute(
@@ -216,50 +582,370 @@ class WarehouseManager:
         )
         return cursor.fetchone()
 
-    def add_product(self, warehouse_id, product_name, quantity):
-        """Add a product to a warehouse."""
+    def add_product(self, warehouse_id, product_name, quantity,
+                    expected_version=None):
+        """Add a product to a warehouse.
+
+        Stock increments commute, so an increment losing a race with
+        another change is retried, unless it was based on expected_version.
+        Raises ConflictError if the warehouse has changed since
+        expected_version or all attempts conflicted.
+        """
+        quantity = to_units(quantity)
+        if quantity <= 0:
+            return False
+
         conn = self._get_connection()
         try:
-            row = self._get_warehouse(conn, warehouse_id)
-            if row is None or quantity > row['capacity'] - row['balance']:
-                return False
-
-            new_balance = row['balance'] + quantity
-            self._update_warehouse_balance(conn, warehouse_id, new_balance)
-            self._upsert_product(conn, warehouse_id, product_name, quantity)
-            conn.commit()
-            return True
+            return self._optimistic(conn, expected_version, lambda: (
+                self._try_add(conn, warehouse_id, product_name, quantity,
+                              expected_version)
+            ))
         finally:
             conn.close()
 
+    def _try_add(self, conn, warehouse_id, product_name, quantity,
+                 expected_version):
+        """Attempt a compare-and-swap addition of a product."""
+        row = self._get_warehouse(conn, warehouse_id)
+        if row is None or quantity > row['capacity'] - row['balance']:
+            return False
+        check_version(row['version'], expected_version)
+
+        self._store_product(conn, row, product_name, quantity)
+        return True
+
     def _get_product(self, conn, warehouse_id, product_name):
         """Get a product from the database."""
         cursor = conn.execute(
-            "SELECT * FROM products WHERE warehouse_id = ? AND name = ?",
+            """SELECT p.* FROM products p
+               JOIN catalog c ON c.id = p.product_id
+               WHERE p.warehouse_id = ? AND c.name = ?""",
             (warehouse_id, product_name)
         )
         return cursor.fetchone()
 
-    def remove_product(self, warehouse_id, product_name):
-        """Remove a product from a warehouse."""
+    def _get_products(self, conn, warehouse_id, product_names):
+        """Get the existing products of a warehouse with given names."""
+        products = [self._get_product(conn, warehouse_id, name)
+                    for name in dict.fromkeys(product_names)]
+        return [product for product in products if product is not None]
+
+    def remove_product(self, warehouse_id, product_name,
+                       expected_version=None):
+        """Remove a product from a warehouse.
+
+        Raises ConflictError if the warehouse has changed since
+        expected_version or all attempts conflicted.
+        """
         conn = self._get_connection()
         try:
-            product = self._get_product(conn, warehouse_id, product_name)
-            if product is None:
-                return False
+            return self._optimistic(conn, expected_version, lambda: (
+                self._try_remove(conn, warehouse_id, product_name,
+                                 expected_version)
+            ))
+        finally:
+            conn.close()
 
-            conn.execute(
-                """UPDATE warehouses
-                   SET balance = balance - ?, updated_at = CURRENT_TIMESTAMP
-                   WHERE id = ?""",
-                (product['quantity'], warehouse_id)
-            )
-            conn.execute(
-                "DELETE FROM products WHERE warehouse_id = ? AND name = ?",
-                (warehouse_id, product_name)
+    def _try_remove(self, conn, warehouse_id, product_name,
+                    expected_version):
+        """Attempt a compare-and-swap removal of a product."""
+        return self._try_remove_many(conn, warehouse_id, [product_name],
+                                     expected_version) > 0
+
+    def remove_products(self, warehouse_id, product_names,
+                        expected_version=None):
+        """Remove several products from a warehouse in one transaction.
+
+        Returns the number of products removed. Raises ConflictError like
+        remove_product().
+        """
+        conn = self._get_connection()
+        try:
+            return self._optimistic(conn, expected_version, lambda: (
+                self._try_remove_many(conn, warehouse_id, product_names,
+                                      expected_version)
+            ))
+        finally:
+            conn.close()
+
+    def _try_remove_many(self, conn, warehouse_id, product_names,
+                         expected_version):
+        """Attempt a compare-and-swap removal of products, return count."""
+        row = self._get_warehouse(conn, warehouse_id)
+        products = self._get_products(conn, warehouse_id, product_names)
+        if row is None or not products:
+            return 0
+        check_version(row['version'], expected_version)
+
+        self._swap(conn, row, balance=row['balance'] - sum(
+            product['quantity'] for product in products
+        ))
+        conn.executemany("DELETE FROM products WHERE id = ?",
+                         [(product['id'],) for product in products])
+        # Nothing is left to pick for the holds of the products
+        conn.executemany(
+            """DELETE FROM reservations
+               WHERE warehouse_id = ? AND product_id = ?""",
+            [(warehouse_id, product['product_id']) for product in products]
+        )
+        self._changed(conn, warehouse_id)
+        return len(products)
+
+    def move_products(self, source_id, target_id, product_names,
+                      expected_version=None):
+        """Move the stock of products to another warehouse.
+
+        The unreserved quantity of each product is moved in one
+        transaction, and only if all of it fits in the target. With
+        expected_version the move fails with the CONFLICT message if the
+        source has changed since that version was read.
+        Returns (success, message) like update_warehouse().
+        """
+        if source_id == target_id:
+            return False, "Cannot move to the same warehouse"
+        conn = self._get_connection()
+        try:
+            return self._optimistic(conn, expected_version, lambda: (
+                self._try_move(conn, (source_id, target_id), product_names,
+                               expected_version)
+            ))
+        except ConflictError:
+            return False, CONFLICT
+        finally:
+            conn.close()
+
+    def _try_move(self, conn, warehouse_ids, product_names,
+                  expected_version):
+        """Attempt a compare-and-swap move between (source, target) ids."""
+        source, target = (self._get_warehouse(conn, warehouse_id)
+                          for warehouse_id in warehouse_ids)
+        if source is None or target is None:
+            return False, "Warehouse not found"
+        check_version(source['version'], expected_version)
+
+        moves = self._movable(conn, source['id'], product_names)
+        if not moves:
+            return False, "Nothing to move"
+        total = sum(quantity for _product_id, quantity in moves)
+        if total > target['capacity'] - target['balance']:
+            return False, "Not enough space in target warehouse"
+        self._move_stock(conn, source, target, moves)
+        return True, "Success"
+
+    def _movable(self, conn, warehouse_id, product_names):
+        """Get (product id, unreserved quantity) of products to move."""
+        rows = [self._availability(conn, warehouse_id, name)
+                for name in dict.fromkeys(product_names)]
+        return [(row['product_id'], row['available']) for row in rows
+                if row is not None and row['available'] > 0]
+
+    def _move_stock(self, conn, source, target, moves):
+        """Move (product id, quantity) moves from source to target rows."""
+        for product_id, quantity in moves:
+            self._take_stock(conn, source['id'], product_id, quantity)
+            self._upsert_product(conn, target['id'], product_id, quantity)
+        total = sum(quantity for _product_id, quantity in moves)
+        self._swap(conn, source, balance=source['balance'] - total)
+        self._swap(conn, target, balance=target['balance'] + total)
+        self._changed(conn, source['id'])
+        self._changed(conn, target['id'])
+
+    def transfer(self, source_id, target_id, product_name, quantity):
+        """Move a quantity of a product to another warehouse.
+
+        See transfer_many(); returns (success, message).
+        """
+        return self.transfer_many([(source_id, target_id, product_name,
+                                    quantity)])
+
+    def transfer_many(self, transfers):
+        """Make (source id, target id, product name, quantity) transfers.
+
+        The transfers are made in order in one transaction, all or none.
+        Each must take unreserved stock of the source and fit in the free
+        capacity of the target at that point. The write lock is taken up
+        front, so opposing transfers wait for each other instead of
+        deadlocking, and balances are updated in ascending id order.
+        Returns (success, message) like move_products().
+        """
+        if not transfers:
+            return False, "Nothing to transfer"
+        conn = self._get_connection()
+        try:
+            with self.alerts.collect():
+                self._transfer_all(conn, transfers)
+        except TransferError as error:
+            conn.rollback()
+            return False, transfer_message(transfers, error)
+        finally:
+            conn.close()
+        return True, "Success"
+
+    def _transfer_all(self, conn, transfers):
+        """Make and commit transfers, raising TransferError."""
+        conn.execute("BEGIN IMMEDIATE")
+        rows, deltas = {}, Counter()
+        for number, transfer in enumerate(transfers, 1):
+            try:
+                self._transfer(conn, rows, deltas, transfer)
+            except TransferError as error:
+                raise TransferError(str(error), number) from None
+        self._apply_deltas(conn, rows, deltas)
+        conn.commit()
+
+    def _apply_deltas(self, conn, rows, deltas):
+        """Add balance deltas to warehouse rows, in ascending id order."""
+        for warehouse_id in sorted(deltas):
+            row = rows[warehouse_id]
+            self._swap(conn, row,
+                       balance=row['balance'] + deltas[warehouse_id])
+            self._changed(conn, warehouse_id)
+
+    def _transfer(self, conn, rows, deltas, transfer):
+        """Move the stock of a transfer, adding it to the balance deltas.
+
+        rows caches the warehouse rows read in the transaction.
+        """
+        source_id, target_id, product_name, quantity = transfer
+        target = self._transfer_target(conn, rows, source_id, target_id)
+        quantity = to_units(quantity)
+        stock = self._availability(conn, source_id, product_name)
+        check_transfer(quantity, stock['available'] if stock else 0,
+                       target['capacity'] - target['balance']
+                       - deltas[target_id])
+        self._take_stock(conn, source_id, stock['product_id'], quantity)
+        self._upsert_product(conn, target_id, stock['product_id'], quantity)
+        deltas[source_id] -= quantity
+        deltas[target_id] += quantity
+
+    def _transfer_target(self, conn, rows, source_id, target_id):
+        """Read the rows of a transfer into rows, returning the target's."""
+        if source_id == target_id:
+            raise TransferError("Cannot transfer to the same warehouse")
+        for warehouse_id in (source_id, target_id):
+            if warehouse_id not in rows:
+                rows[warehouse_id] = self._get_warehouse(conn, warehouse_id)
+        if rows[source_id] is None or rows[target_id] is None:
+            raise TransferError("Warehouse not found")
+        return rows[target_id]
+
+    def _take_stock(self, conn, warehouse_id, product_id, quantity):
+        """Lower the quantity of a product, deleting it when none is left."""
+        conn.execute(
+            """UPDATE products
+               SET quantity = quantity - ?, updated_at = CURRENT_TIMESTAMP
+               WHERE warehouse_id = ? AND product_id = ?""",
+            (quantity, warehouse_id, product_id)
+        )
+        conn.execute(
+            """DELETE FROM products
+               WHERE warehouse_id = ? AND product_id = ? AND quantity = 0""",
+            (warehouse_id, product_id)
+        )
+
+    def _availability(self, conn, warehouse_id, product_name):
+        """Read the product id and unreserved quantity of a product."""
+        return conn.execute(
+            """SELECT p.product_id, p.quantity - COALESCE((
+                       SELECT SUM(r.quantity) FROM reservations r
+                       WHERE r.warehouse_id = p.warehouse_id
+                         AND r.product_id = p.product_id
+                         AND r.expires_at > ?
+                   ), 0) AS available
+               FROM products p JOIN catalog c ON c.id = p.product_id
+               WHERE p.warehouse_id = ? AND c.name = ?""",
+            (self.holds.clock(), warehouse_id, product_name)
+        ).fetchone()
+
+    def available(self, warehouse_id, product_name):
+        """Get the quantity of a product not held by reservations."""
+        conn = self._get_connection()
+        try:
+            row = self._availability(conn, warehouse_id, product_name)
+        finally:
+            conn.close()
+        return from_units(row['available']) if row else 0
+
+    def reserve(self, warehouse_id, product_name, quantity, ttl=HOLD_SECONDS):
+        """Hold a quantity of a product for ttl seconds.
+
+        Holds count against the available quantity, so stock is never
+        promised twice. Returns the reservation id, or None if not enough
+        of the product is available.
+        """
+        expires_at = self.holds.clock() + ttl
+        conn = self._get_connection()
+        try:
+            reservation_id = self._hold(conn, warehouse_id, product_name,
+                                        to_units(quantity), expires_at)
+            conn.commit()
+        finally:
+            conn.close()
+        if reservation_id is not None:
+            self.holds.schedule(reservation_id, expires_at)
+        return reservation_id
+
+    def _hold(self, conn, warehouse_id, product_name, quantity, expires_at):
+        """Insert a hold if enough is available, returning its id or None."""
+        # Hold the write lock so availability stays valid until held
+        conn.execute("BEGIN IMMEDIATE")
+        row = self._availability(conn, warehouse_id, product_name)
+        if row is None or not 0 < quantity <= row['available']:
+            return None
+        return conn.execute(
+            """INSERT INTO reservations
+                   (warehouse_id, product_id, quantity, expires_at)
+               VALUES (?, ?, ?, ?)""",
+            (warehouse_id, row['product_id'], quantity, expires_at)
+        ).lastrowid
+
+    def confirm(self, reservation_id):
+        """Pick the held stock, removing it from the warehouse.
+
+        Returns False if the reservation does not exist or has expired.
+        """
+        conn = self._get_connection()
+        try:
+            with self.alerts.collect():
+                return self._confirm(conn, reservation_id)
+        finally:
+            conn.close()
+
+    def _confirm(self, conn, reservation_id):
+        """Pick and commit an unexpired hold, False if there is none."""
+        conn.execute("BEGIN IMMEDIATE")
+        hold = conn.execute(
+            "SELECT * FROM reservations WHERE id = ? AND expires_at > ?",
+            (reservation_id, self.holds.clock())
+        ).fetchone()
+        if hold is None:
+            return False
+        self._pick(conn, hold)
+        conn.commit()
+        return True
+
+    def _pick(self, conn, hold):
+        """Take the quantity of a hold from its product and warehouse."""
+        row = self._get_warehouse(conn, hold['warehouse_id'])
+        self._take_stock(conn, row['id'], hold['product_id'], hold['quantity'])
+        self._swap(conn, row, balance=row['balance'] - hold['quantity'])
+        conn.execute("DELETE FROM reservations WHERE id = ?", (hold['id'],))
+        self._changed(conn, row['id'])
+
+    def release(self, reservation_id):
+        """Release a hold, making its quantity available again.
+
+        Returns False if the reservation does not exist or has expired.
+        """
+        conn = self._get_connection()
+        try:
+            cursor = conn.execute(
+                "DELETE FROM reservations WHERE id = ? AND expires_at > ?",
+                (reservation_id, self.holds.clock())
             )
             conn.commit()
-            return True
+            return cursor.rowcount > 0
         finally:
             conn.close()
 
@@ -283,3 +969,20 @@ class WarehouseManager:
             return cursor.rowcount > 0
         finally:
             conn.close()
+
+    def delete_warehouses(self, warehouse_ids):
+        """Delete several warehouses in one transaction.
+
+        Returns the number of warehouses deleted.
+        """
+        params = [(warehouse_id,) for warehouse_id in set(warehouse_ids)]
+        conn = self._get_connection()
+        try:
+            conn.executemany("DELETE FROM products WHERE warehouse_id = ?",
+                             params)
+            cursor = conn.executemany("DELETE FROM warehouses WHERE id = ?",
+                                      params)
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()